@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks full round-robin-backup cycles against a local stand-in for
+the backup destination.
+
+    python -m benchmarks.benchmark run --days 30 --output head.json
+    python -m benchmarks.benchmark compare base.json head.json
+
+run generates a synthetic source tree, puts benchmarks/bin/ssh first on
+PATH so every ssh command runs locally against a temporary "remote"
+directory, and runs one RoundRobinBackup cycle per simulated day, changing
+the tree between days. Per-phase timings and metrics of every day are
+written to a JSON results file. compare reads two results files, e.g. from
+two commits, and flags phases whose median duration regressed. rsync, tar
+and the selected compressor must be installed locally.
+'''
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from benchmarks.sourcetree import SyntheticSourceTree
+from lib.optionsparser import OptionsParser
+from roundrobinbackup import RoundRobinBackup
+
+
+class BenchmarkRunner:
+
+    def __init__(self, options):
+        self.options = options
+
+    def run(self):
+        work_dir = tempfile.mkdtemp(prefix='rrbackup-benchmark-',
+                                    dir=self.options.get('work_dir'))
+        try:
+            self._use_ssh_shim()
+            return self._run_days(work_dir)
+        finally:
+            if not self.options.get('keep'):
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    def _use_ssh_shim(self):
+        shim_dir = os.path.join(ROOT, 'benchmarks', 'bin')
+        path = os.environ.get('PATH', '')
+        if not path.startswith(shim_dir + os.pathsep):
+            os.environ['PATH'] = shim_dir + os.pathsep + path
+
+    def _run_days(self, work_dir):
+        source = os.path.join(work_dir, 'source')
+        remote = os.path.join(work_dir, 'remote')
+        tree = SyntheticSourceTree(source, self.options['tree'])
+        started = time.time()
+        source_bytes = tree.create()
+        results = self._create_results(source_bytes, time.time() - started)
+        start_date = date(*[int(part) for part in
+                            self.options['start_date'].split('-')])
+        for day in range(self.options['days']):
+            changes = tree.advance_day() if day else {}
+            backup_date = (start_date + timedelta(days=day)).isoformat()
+            day_result = self._run_day(work_dir, source, remote, backup_date)
+            day_result['changes'] = changes
+            results['days'].append(day_result)
+            self._print_day(day_result)
+        results['summary'] = self._summarize(results['days'])
+        return results
+
+    def _create_results(self, source_bytes, create_duration):
+        results = {
+            'commit': self._get_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'options': self.options,
+            'source_bytes': source_bytes,
+            'create_duration': create_duration,
+            'days': []
+        }
+        return results
+
+    def _get_commit(self):
+        try:
+            commit = subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+                close_fds=True
+            )
+            return commit.decode('ascii').strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def _run_day(self, work_dir, source, remote, backup_date):
+        arguments = [
+            source,
+            'benchmark@localhost:{0}'.format(remote),
+            '--date', backup_date,
+            '--metrics-file', os.path.join(work_dir, 'run.json')
+        ] + self.options['backup_arguments']
+        options = OptionsParser().get_options(arguments)
+        rrbackup = RoundRobinBackup(options)
+        try:
+            rrbackup.backup()
+        except Exception:
+            pass
+        record = rrbackup.get_run_record()
+        day_result = {
+            'date': backup_date,
+            'duration': record['duration'],
+            'success': record['success'],
+            'error': record['error'],
+            'phases': [
+                {
+                    'phase': phase['phase'],
+                    'duration': phase['duration'],
+                    'metrics': phase['metrics']
+                }
+                for phase in record['phases']
+            ]
+        }
+        return day_result
+
+    def _print_day(self, day_result):
+        phases = ', '.join('{0} {1:.3f}s'.format(phase['phase'],
+                                                 phase['duration'])
+                           for phase in day_result['phases'])
+        status = 'ok' if day_result['success'] else 'FAILED'
+        line = '{0} [{1}] {2:.3f}s: {3}'.format(day_result['date'], status,
+                                                day_result['duration'], phases)
+        if day_result['error']:
+            line = '{0}\n    {1}'.format(line, day_result['error'])
+        print(line)
+
+    def _summarize(self, days):
+        durations = {'run': [day['duration'] for day in days]}
+        for day in days:
+            for phase in day['phases']:
+                durations.setdefault(phase['phase'], []).append(
+                    phase['duration']
+                )
+        summary = {}
+        for name, values in durations.items():
+            summary[name] = {
+                'count': len(values),
+                'total': sum(values),
+                'mean': sum(values) / len(values),
+                'median': get_median(values),
+                'max': max(values)
+            }
+        return summary
+
+
+class BenchmarkComparer:
+
+    '''
+    Compares the median durations of two results files. A phase regressed
+    when it became slower by more than threshold, as a fraction, and by
+    more than min_duration seconds, so noise in very short phases is not
+    flagged.
+    '''
+
+    def __init__(self, threshold=0.1, min_duration=0.05):
+        self.threshold = threshold
+        self.min_duration = min_duration
+
+    def compare(self, baseline, candidate):
+        rows = []
+        names = sorted(set(baseline['summary']) & set(candidate['summary']))
+        for name in names:
+            before = baseline['summary'][name]['median']
+            after = candidate['summary'][name]['median']
+            change = (after - before) / before if before else 0.0
+            regression = (change > self.threshold and
+                          after - before > self.min_duration)
+            rows.append({
+                'name': name,
+                'baseline': before,
+                'candidate': after,
+                'change': change,
+                'regression': regression
+            })
+        return rows
+
+    def get_warnings(self, baseline, candidate):
+        'Differences that make the comparison less meaningful'
+        warnings = []
+        if baseline['options'] != candidate['options']:
+            warnings.append('Benchmark options differ between the results')
+        for results in [baseline, candidate]:
+            failures = [day['date'] for day in results['days']
+                        if not day['success']]
+            if failures:
+                warnings.append('{0} has failed runs on {1}'.format(
+                    results.get('commit'), ', '.join(failures)
+                ))
+        return warnings
+
+    def format(self, rows, baseline, candidate):
+        lines = ['{0:<10} {1:>12} {2:>12} {3:>9}'.format(
+            'median', baseline.get('commit') or 'baseline',
+            candidate.get('commit') or 'candidate', 'change'
+        )]
+        for row in rows:
+            flag = '  REGRESSION' if row['regression'] else ''
+            lines.append('{0:<10} {1:>11.3f}s {2:>11.3f}s {3:>+8.1%}{4}'.format(
+                row['name'], row['baseline'], row['candidate'], row['change'],
+                flag
+            ))
+        return '\n'.join(lines)
+
+
+def get_median(values):
+    ordered = sorted(values)
+    middle = len(ordered) // 2
+    if len(ordered) % 2:
+        return ordered[middle]
+    return (ordered[middle - 1] + ordered[middle]) / 2.0
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark round-robin-backup against a local ssh '
+                    'stand-in'
+    )
+    subparsers = parser.add_subparsers(dest='command')
+
+    run = subparsers.add_parser('run', help='Run the benchmark')
+    run.add_argument('--days', type=int, default=14,
+                     help='Simulated days to back up. Default is 14')
+    run.add_argument('--start-date', default='2020-01-01',
+                     help='First simulated day, YYYY-MM-DD')
+    run.add_argument('--files', type=int, default=1000)
+    run.add_argument('--files-per-dir', type=int, default=100)
+    run.add_argument('--size-distribution', default='lognormal',
+                     choices=['fixed', 'uniform', 'lognormal'])
+    run.add_argument('--mean-size', type=int, default=16384,
+                     help='Mean file size in bytes')
+    run.add_argument('--change-rate', type=float, default=0.05,
+                     help='Fraction of files rewritten per day')
+    run.add_argument('--add-rate', type=float, default=0.01,
+                     help='Fraction of files added per day')
+    run.add_argument('--delete-rate', type=float, default=0.01,
+                     help='Fraction of files deleted per day')
+    run.add_argument('--compressible', type=float, default=0.5,
+                     help='Fraction of each file that compresses to nothing')
+    run.add_argument('--seed', type=int, default=1)
+    run.add_argument('--work-dir',
+                     help='Directory for the source and remote trees')
+    run.add_argument('--keep', action='store_true',
+                     help='Keep the source and remote trees afterwards')
+    run.add_argument('--output', help='Write the results to this JSON file')
+    run.add_argument('backup_arguments', nargs=argparse.REMAINDER,
+                     help='Extra round-robin-backup options after --, e.g. '
+                          '-- --archive-mode snapshot')
+
+    compare = subparsers.add_parser('compare',
+                                    help='Compare two results files')
+    compare.add_argument('baseline')
+    compare.add_argument('candidate')
+    compare.add_argument('--threshold', type=float, default=0.1,
+                         help='Relative slowdown flagged as a regression. '
+                              'Default is 0.1')
+    compare.add_argument('--min-duration', type=float, default=0.05,
+                         help='Absolute slowdown in seconds below which '
+                              'nothing is flagged. Default is 0.05')
+    return parser
+
+
+def create_runner_options(args):
+    tree_options = dict((key, getattr(args, key)) for key in [
+        'files', 'files_per_dir', 'size_distribution', 'mean_size',
+        'change_rate', 'add_rate', 'delete_rate', 'compressible', 'seed'
+    ])
+    backup_arguments = [argument for argument in args.backup_arguments
+                        if argument != '--']
+    options = {
+        'days': args.days,
+        'start_date': args.start_date,
+        'tree': tree_options,
+        'backup_arguments': backup_arguments,
+        'work_dir': args.work_dir,
+        'keep': args.keep
+    }
+    return options
+
+
+def main(arguments=None):
+    args = get_parser().parse_args(arguments)
+    if args.command == 'run':
+        results = BenchmarkRunner(create_runner_options(args)).run()
+        if args.output:
+            with open(args.output, 'w') as output_file:
+                json.dump(results, output_file, indent=2, sort_keys=True)
+        return 0 if all(day['success'] for day in results['days']) else 1
+    if args.command == 'compare':
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        with open(args.candidate) as candidate_file:
+            candidate = json.load(candidate_file)
+        comparer = BenchmarkComparer(args.threshold, args.min_duration)
+        rows = comparer.compare(baseline, candidate)
+        for warning in comparer.get_warnings(baseline, candidate):
+            print('Warning: {0}'.format(warning))
+        print(comparer.format(rows, baseline, candidate))
+        return 1 if any(row['regression'] for row in rows) else 0
+    get_parser().print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+
+'''
+Benchmarks BackupArchivePruner's classification of a huge destination
+directory, without any remote commands.
+
+    python -m benchmarks.pruner --files 1000000
+
+Generates the listing of a shared destination directory: one archive per
+day for this job, full on Mondays and incremental otherwise, in a mix of
+codecs, next to archives of other jobs, partial uploads and unrelated
+files. The pruner lists, parses and classifies it, and the time of each
+step is reported.
+'''
+
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import date, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+from lib.backuparchivepruner import BackupArchivePruner
+from lib.optionsparser import OptionsParser
+
+
+class ListingCommandLine:
+
+    ' Streams a prepared listing and records every other command '
+
+    def __init__(self, listing):
+        self.listing = listing
+        self.commands = []
+
+    def execute(self, command, **extra_params_not_used_in_benchmark):
+        self.commands.append(command)
+        return ''
+
+    def execute_lines(self, command, **extra_params_not_used_in_benchmark):
+        return ('f/0/1500000000.0/{0}'.format(name) for name in self.listing)
+
+
+def generate_listing(files, end_date, backup_prefix='automated-backup-'):
+    '''
+    Of every eight names, five are archives of this job, one belongs to
+    another job, one is a partial upload and one is an unrelated file.
+    '''
+    extensions = ['.tar.bzip2', '.tar.gz', '.tar.zst', '.tar.xz']
+    listing = []
+    day = end_date
+    while len(listing) < files:
+        for i in range(5):
+            day_string = day.isoformat()
+            marker = '' if day.isoweekday() == 1 else '.incremental'
+            listing.append('{0}{1}{2}{3}'.format(
+                backup_prefix, day_string, marker,
+                extensions[day.toordinal() % len(extensions)]
+            ))
+            day = day - timedelta(days=1)
+        listing.append('other-job-{0}.tar.gz'.format(day_string))
+        listing.append('{0}{1}.tar.gz.partial'.format(backup_prefix,
+                                                      day_string))
+        listing.append('notes-{0}.txt'.format(len(listing)))
+    return listing[:files]
+
+
+def run(files, end_date):
+    started = time.time()
+    listing = generate_listing(files, end_date)
+    timings = {'generate': time.time() - started}
+    options = OptionsParser().get_options([
+        '/local/files', 'user@target.com:/some/path',
+        '--date', end_date.isoformat(), '--years', '100'
+    ])
+    pruner = BackupArchivePruner()
+    pruner.set_options(options)
+    pruner.set_command_line_library(ListingCommandLine(listing))
+
+    started = time.time()
+    pruner._get_existing_backups()
+    timings['list_and_parse'] = time.time() - started
+    started = time.time()
+    pruner._classify_existing_backups()
+    timings['classify'] = time.time() - started
+
+    results = {
+        'files': files,
+        'backups': len(pruner.existing_backups),
+        'to_remove': len(pruner.files_to_remove),
+        'timings': timings,
+        'files_per_second': files / max(timings['list_and_parse'] +
+                                        timings['classify'], 1e-9)
+    }
+    return results
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(
+        description='Benchmark retention classification of a huge '
+                    'destination directory'
+    )
+    parser.add_argument('--files', type=int, default=1000000,
+                        help='Names in the listing. Default is 1000000')
+    parser.add_argument('--end-date', default='9000-01-01',
+                        help='Date of the newest archive, YYYY-MM-DD')
+    parser.add_argument('--output', help='Write the results to this file')
+    args = parser.parse_args(arguments)
+    end_date = date(*[int(part) for part in args.end_date.split('-')])
+    results = run(args.files, end_date)
+    for step in ['generate', 'list_and_parse', 'classify']:
+        print('{0:<15} {1:>8.3f}s'.format(step, results['timings'][step]))
+    print('{0} names, {1} backups, {2} to remove, {3:.0f} names/s'.format(
+        results['files'], results['backups'], results['to_remove'],
+        results['files_per_second']
+    ))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
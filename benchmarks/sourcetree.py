@@ -0,0 +1,116 @@
+import math
+import os
+import random
+
+
+class SyntheticSourceTree:
+
+    '''
+    Generates a source tree to back up, and changes it from one simulated
+    day to the next. Options:
+
+        files: number of files to create
+        files_per_dir: files per subdirectory
+        size_distribution: fixed, uniform or lognormal
+        mean_size: mean file size in bytes
+        change_rate: fraction of files rewritten each day
+        add_rate: fraction of files added each day
+        delete_rate: fraction of files deleted each day
+        compressible: fraction of each file that is zeros rather than
+                      random bytes
+        seed: seed for file sizes and the choice of changed files
+
+    File contents are random, so two trees with the same seed have the
+    same layout and sizes but not the same bytes.
+    '''
+
+    default_options = {
+        'files': 1000,
+        'files_per_dir': 100,
+        'size_distribution': 'lognormal',
+        'mean_size': 16384,
+        'change_rate': 0.05,
+        'add_rate': 0.01,
+        'delete_rate': 0.01,
+        'compressible': 0.5,
+        'seed': 1
+    }
+
+    def __init__(self, path, options=None):
+        self.path = path
+        self.options = self.default_options.copy()
+        self.options.update(options or {})
+        self.random = random.Random(self.options['seed'])
+        self.files = []
+        self.next_file_number = 0
+
+    def get_options(self):
+        return self.options.copy()
+
+    def create(self):
+        'Write the initial tree and return its size in bytes'
+        total_bytes = 0
+        for i in range(self.options['files']):
+            total_bytes += self._add_file()
+        return total_bytes
+
+    def advance_day(self):
+        '''
+        Rewrite, add and delete files according to the daily rates. Returns
+        a dictionary with the number of files changed, added and deleted
+        and the bytes written.
+        '''
+        changes = {'changed': 0, 'added': 0, 'deleted': 0, 'bytes': 0}
+        for filename in self._sample_files('delete_rate'):
+            os.remove(filename)
+            self.files.remove(filename)
+            changes['deleted'] += 1
+        for filename in self._sample_files('change_rate'):
+            changes['bytes'] += self._write_file(filename)
+            changes['changed'] += 1
+        for i in range(self._get_count('add_rate')):
+            changes['bytes'] += self._add_file()
+            changes['added'] += 1
+        return changes
+
+    def _sample_files(self, rate_option):
+        count = min(self._get_count(rate_option), len(self.files))
+        return self.random.sample(self.files, count)
+
+    def _get_count(self, rate_option):
+        return int(round(self.options['files'] * self.options[rate_option]))
+
+    def _add_file(self):
+        number = self.next_file_number
+        self.next_file_number += 1
+        directory = os.path.join(self.path, 'dir{0:05d}'.format(
+            number // self.options['files_per_dir']
+        ))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        filename = os.path.join(directory, 'file{0:07d}.dat'.format(number))
+        self.files.append(filename)
+        return self._write_file(filename)
+
+    def _write_file(self, filename):
+        size = self._get_file_size()
+        zeros = int(size * self.options['compressible'])
+        with open(filename, 'wb') as data_file:
+            data_file.write(os.urandom(size - zeros))
+            data_file.write(b'\0' * zeros)
+        return size
+
+    def _get_file_size(self):
+        distribution = self.options['size_distribution']
+        mean_size = self.options['mean_size']
+        if distribution == 'fixed':
+            return int(mean_size)
+        if distribution == 'uniform':
+            return self.random.randint(0, int(2 * mean_size))
+        if distribution == 'lognormal':
+            # Many small files and a long tail of large ones. With sigma
+            # 1.5, mu is chosen so the mean is mean_size
+            sigma = 1.5
+            mu = math.log(mean_size) - sigma ** 2 / 2
+            return int(self.random.lognormvariate(mu, sigma))
+        raise Exception("Unknown size distribution '{0}'".format(distribution))
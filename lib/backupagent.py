@@ -1,12 +1,328 @@
+import inspect
+import json
+import os
+import tempfile
+try:
+    from shlex import quote
+except ImportError:
+    from pipes import quote
+from utilities import archivewriter, remotehelper, roundrobindate
+from utilities.asynccommandline import AsyncCommand
+from utilities.compression import CompressionCommand
+from utilities.roundrobindate import RoundRobinBackupClassifier, \
+                                    RoundRobinDate
+from utilities.sshutilities import SSHCommand
+
+
 class BackupAgent:
 
     "Base class and shared behavior holder for more specific backup agents."
 
     def set_options(self, options):
         self.options = options
+        self.metrics = {}
+
+    def get_metrics(self):
+        '''
+        Measurements taken by the last execute, like bytes transferred.
+        Only collected when a --metrics-file or --prometheus-dir is written.
+        '''
+        return self.metrics.copy()
+
+    def _is_collecting_metrics(self):
+        return bool(self.options.get('metrics_file') or
+                    self.options.get('prometheus_dir'))
 
     def set_command_line_library(self, command_line_library):
         self.cli = command_line_library
 
     def _execute_command(self, command, *args, **kwargs):
         return self.cli.execute(command, *args, **kwargs)
+
+    def _execute_command_async(self, command, *args, **kwargs):
+        '''
+        Start a command without waiting for it. Returns an AsyncCommand
+        whose result() matches _execute_command. Command line libraries
+        without submit support run the command before returning.
+        '''
+        if hasattr(self.cli, 'submit'):
+            return self.cli.submit(command, *args, **kwargs)
+        return AsyncCommand.from_callable(command, self.cli.execute, command,
+                                          *args, **kwargs)
+
+    def _execute_command_queue(self, commands, *args, **kwargs):
+        return self.cli.execute_queue(commands, *args, **kwargs)
+
+    def _get_ssh_command_options(self, subcommand=''):
+        '''
+        Options for utilities.sshutilities.SSHCommand targeting the backup
+        destination. Includes the control path of a multiplexed master
+        connection when one has been opened for this run.
+        '''
+        ssh_command_options = {
+            'user': self.options['destination_user'],
+            'host': self.options['destination_host'],
+            'port': self.options['ssh_port'],
+            'identity_file': self.options['ssh_identity_file'],
+            'control_path': self.options.get('ssh_control_path'),
+            'subcommand': subcommand
+        }
+        return ssh_command_options
+
+    def _iterate_command(self, command, *args, **kwargs):
+        return self.cli.execute_lines(command, *args, **kwargs)
+
+    def _is_local_destination(self):
+        '''
+        Destinations without a host, like a mounted NAS, are worked on in
+        process with the operations of utilities.remotehelper, instead of
+        with commands run over ssh.
+        '''
+        return not self.options.get('destination_host')
+
+    def _make_destination_dir(self, path):
+        if self._is_local_destination():
+            self._execute_remote_helper([{'op': 'mkdir', 'path': path}])
+            return
+        remote_command = '/bin/mkdir -p {0}'.format(path)
+        ssh_command_options = self._get_ssh_command_options(remote_command)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        self._execute_command(ssh_command)
+
+    def _get_remote_backup_dir_files_list(self):
+        '''
+        Lazily yields the names in the destination directory as the remote
+        listing streams in, instead of buffering the whole listing.
+        '''
+        for entry in self._get_remote_backup_dir_entries():
+            yield entry['name']
+
+    def _get_remote_backup_dir_entries(self, remote_path=None):
+        '''
+        Lazily yields a dictionary per entry in the destination directory,
+        or in remote_path when given, with its name, type (f for files, d
+        for directories), size in bytes and mtime. Entries are NUL delimited
+        and their fields separated by slashes, the two characters a name can
+        not contain, so names with spaces or newlines are listed correctly.
+        '''
+        if self._is_local_destination():
+            return self._get_local_backup_dir_entries(remote_path)
+        command = self._get_remote_list_command(remote_path)
+        command_results = self._iterate_command(command, delimiter='\0')
+        remote_entries = self._parse_entries_from_results(command_results)
+        return remote_entries
+
+    def _get_local_backup_dir_entries(self, path=None):
+        path = path or self.options['destination_path']
+        results = self._execute_remote_helper([{'op': 'list', 'path': path}])
+        entries = results[0]['entries'] if results else []
+        return iter(entries)
+
+    def _get_remote_list_command(self, remote_path=None):
+        remote_path = remote_path or self.options['destination_path']
+        find_subcommand = '/usr/bin/find {0} -mindepth 1 -maxdepth 1 ' \
+                          '-printf \'%y/%s/%T@/%f\\0\''.format(
+                              quote(remote_path))
+        ssh_command_options = self._get_ssh_command_options(find_subcommand)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        return ssh_command
+
+    def _parse_entries_from_results(self, remote_command_results):
+        for record in remote_command_results:
+            fields = record.split('/', 3)
+            if len(fields) != 4:
+                continue
+            entry_type, size, mtime, name = fields
+            yield {
+                'name': name,
+                'type': entry_type,
+                'size': int(size),
+                'mtime': float(mtime)
+            }
+
+    def _get_remote_sizes(self, fullpaths):
+        'Sizes in bytes of remote files and directories, with one du'
+        if not fullpaths:
+            return {}
+        if self._is_local_destination():
+            results = self._execute_remote_helper([{'op': 'sizes',
+                                                    'paths': fullpaths}])
+            return results[0]['sizes'] if results else {}
+        subcommand = '/usr/bin/du -sb {0}'.format(
+            self._quote_remote_paths(fullpaths)
+        )
+        ssh_command_options = self._get_ssh_command_options(subcommand)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        output = self._execute_command(ssh_command) or ''
+        sizes = {}
+        for line in output.splitlines():
+            size, _, fullpath = line.partition('\t')
+            if size.isdigit():
+                sizes[fullpath] = int(size)
+        return sizes
+
+    def _execute_command_with_records(self, command, records):
+        '''
+        Executes command with the records written NUL delimited to its
+        stdin, and returns the NUL delimited records of its output. Large
+        lists of paths go to remote commands this way instead of on their
+        command line, which is limited by ARG_MAX.
+        '''
+        data = ''.join(record + '\0' for record in records)
+        output = self._execute_command_with_input(command, data)
+        output_records = [record for record in (output or '').split('\0')
+                          if record]
+        return output_records
+
+    def _execute_command_with_input(self, command, data):
+        stdin = tempfile.TemporaryFile()
+        try:
+            if not isinstance(data, bytes):
+                data = data.encode('utf-8')
+            stdin.write(data)
+            stdin.seek(0)
+            output = self._execute_command(command, stdin=stdin)
+        finally:
+            stdin.close()
+        return output
+
+    def _is_using_remote_helper(self):
+        return bool(self.options.get('remote_helper')) or \
+               self._is_local_destination()
+
+    def _execute_remote_helper(self, operations):
+        '''
+        Runs the operations in one ssh session with utilities.remotehelper,
+        piped with its dependencies' source to the destination's Python, and
+        returns their results. Raises an exception naming the first failed
+        operation. Each operation's wall time on the destination is
+        recorded in the remote_operations metric. Local destinations run
+        the operations in process.
+        '''
+        if self._is_local_destination():
+            output = self._run_local_helper(operations)
+        else:
+            output = self._run_remote_helper(operations)
+        if not output:
+            return []
+        results = output['results']
+        if self._is_collecting_metrics():
+            self.metrics.setdefault('remote_operations', []).extend(
+                {'op': result['op'], 'duration': result['duration'],
+                 'success': result['success']}
+                for result in results
+            )
+        for result in results:
+            if result['error']:
+                raise Exception('Remote helper operation {0} failed: '
+                                '{1}'.format(result['op'], result['error']))
+        return results
+
+    def _run_local_helper(self, operations):
+        'Nothing is changed in --debug mode, the operations are printed'
+        if self.options.get('debug'):
+            print('\n# Debug flag set, in noop mode. Would have run locally:')
+            print(json.dumps(operations))
+            return None
+        return remotehelper.RemoteHelper().run({'operations': operations})
+
+    def _run_remote_helper(self, operations):
+        subcommand = '{0} - {1}'.format(
+            self.options.get('remote_python') or 'python',
+            remotehelper.encode_batch({'operations': operations})
+        )
+        ssh_command_options = self._get_ssh_command_options(subcommand)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        output = self._execute_command_with_input(
+            ssh_command, self._get_remote_helper_program()
+        )
+        if not output:
+            return None
+        return json.loads(output)
+
+    def _get_remote_helper_program(self):
+        '''
+        The helper depends on utilities.roundrobindate and
+        ParallelArchiveWriter, which are shipped ahead of it
+        '''
+        if not hasattr(BackupAgent, 'remote_helper_program'):
+            BackupAgent.remote_helper_program = '\n\n'.join([
+                inspect.getsource(roundrobindate),
+                inspect.getsource(archivewriter),
+                inspect.getsource(remotehelper)
+            ])
+        return BackupAgent.remote_helper_program
+
+    def _get_trash_path(self):
+        'Stale archives are moved here by --prune-mode trash'
+        return os.path.join(self.options['destination_path'], '.trash')
+
+    def _quote_remote_paths(self, paths):
+        'Shell quoted for the remote shell that runs ssh subcommands'
+        return ' '.join(quote(path) for path in paths)
+
+    def _is_backup_date(self, date):
+        'Ignore files sharing the prefix that are not dated backups'
+        return RoundRobinBackupClassifier().is_backup_date(date)
+
+    def _get_date_from_backup_filename(self, filename):
+        '''
+        Parse date from backup filename like
+        automated-backup-2012-02-01.tar.bzip2
+        <prefix><date><ext>
+        Recognizes the extension of every compression codec, so retention
+        keeps working after switching codecs.
+        '''
+        backup_prefix = self.options['backup_prefix']
+        prefix_length = len(backup_prefix)
+        filename_less_prefix = filename[prefix_length:]
+        date = self._strip_archive_extension(filename_less_prefix)
+        return date
+
+    def _strip_archive_extension(self, filename):
+        '''
+        Removes the codec extension and any archive type marker, like the
+        .incremental in <date>.incremental.tar.bzip2
+        '''
+        for extension in self._get_archive_extensions():
+            if filename.endswith(extension):
+                filename = filename[:-len(extension)]
+                break
+        if '.' in filename:
+            first_period = filename.index('.')
+            filename = filename[:first_period]
+        return filename
+
+    def _get_archive_extensions(self):
+        'Looked up once per agent, as it is consulted for every filename'
+        if not hasattr(self, 'archive_extensions'):
+            self.archive_extensions = CompressionCommand().get_extensions()
+        return self.archive_extensions
+
+    def _is_partial_backup(self, filename):
+        'Archives still being uploaded, or left behind by a failed upload'
+        return filename.endswith('.partial')
+
+    def _is_incremental_backup(self, filename):
+        return '.incremental.' in filename or filename.endswith('.incremental')
+
+    def _get_today(self):
+        'The --date override when set, otherwise the current date'
+        return self._create_round_robin_date().get_today()
+
+    def _create_round_robin_date(self, anchor_date=''):
+        options = self._get_round_robin_date_options()
+        options['anchor_date'] = anchor_date
+        date_library = RoundRobinDate(options)
+        return date_library
+
+    def _get_round_robin_date_options(self):
+        options = {
+            'days_to_retain': self.options['days'],
+            'weeks_to_retain': self.options['weeks'],
+            'months_to_retain': self.options['months'],
+            'years_to_retain': self.options['years']
+        }
+        if self.options.get('date'):
+            options['current_date'] = self.options['date']
+        return options
@@ -1,6 +1,6 @@
 import os
 from lib.backupagent import BackupAgent
-from utilities.roundrobindate import RoundRobinDate
+from utilities.roundrobindate import RoundRobinBackupClassifier
 from utilities.sshutilities import SSHCommand
 
 
@@ -8,136 +8,188 @@ class BackupArchivePruner(BackupAgent):
     
     def execute(self):
         'Remove stale archives based on round-robin dates'
+        if self._is_using_remote_helper():
+            self._prune_with_remote_helper()
+            return
         self._get_existing_backups()
+        self._classify_existing_backups()
         self._remove_stale_backups()
 
+    def _prune_with_remote_helper(self):
+        '''
+        Lists, classifies and removes stale archives on the destination in
+        one ssh session, see utilities.remotehelper.
+        '''
+        results = self._execute_remote_helper([self._get_prune_operation()])
+        result = results[0] if results else {}
+        self.failed_removals = [failure['path']
+                                for failure in result.get('failed', [])]
+        self.files_to_remove = result.get('removed', []) + \
+                               self.failed_removals
+        if result and self._is_collecting_metrics():
+            for key in ['pruned_count', 'pruned_bytes', 'retained_count',
+                        'retained_bytes']:
+                self.metrics[key] = result[key]
+            self.metrics['prune_failed_count'] = len(self.failed_removals)
+            self.metrics['prune_failed'] = sorted(self.failed_removals)
+
+    def _get_prune_operation(self):
+        operation = {
+            'op': 'prune',
+            'path': self.options['destination_path'],
+            'prefix': self.options['backup_prefix'],
+            'extensions': self._get_archive_extensions(),
+            'retention': {
+                'days': self.options['days'],
+                'weeks': self.options['weeks'],
+                'months': self.options['months'],
+                'years': self.options['years'],
+                'current_date': self.options.get('date')
+            },
+            'mode': self.options.get('prune_mode') or 'delete',
+            'trash_path': self._get_trash_path(),
+            'sizes': self._is_collecting_metrics()
+        }
+        return operation
+
     def _get_existing_backups(self):
+        self.stale_partial_backups = []
         existing_backups = self._get_list_of_existing_backups()
         self.existing_backups = existing_backups
 
     def _get_list_of_existing_backups(self):
-        list_of_files = self._get_remote_backup_dir_files_list()
+        '''
+        Entries are parsed as the remote listing streams in, and only
+        dated archives are kept, so time and memory grow linearly with the
+        number of files in the destination directory. Partial archives are
+        never treated as backups. Those dated today may still be uploading,
+        older ones were left by a failed run and are removed as stale.
+        '''
         backup_prefix = self.options['backup_prefix']
-        backup_filenames = [name for name in list_of_files if backup_prefix in name]
+        today = self._get_today()
         backup_files = []
-        for filename in backup_filenames:
-            backup_file = self._create_backup_file_dictionary(filename)
+        for entry in self._get_remote_backup_dir_entries():
+            filename = entry['name']
+            if backup_prefix not in filename:
+                continue
+            backup_file = self._create_backup_file_dictionary(filename, entry)
+            if not self._is_backup_date(backup_file['date']):
+                continue
+            if self._is_partial_backup(filename):
+                if backup_file['date'] < today:
+                    self.stale_partial_backups.append(backup_file)
+                continue
             backup_files.append(backup_file)
         return backup_files
 
-    def _get_remote_backup_dir_files_list(self):
-        command = self._get_remote_list_command()
-        command_results = self._execute_command(command)
-        remote_files = self._parse_files_from_results(command_results)
-        return remote_files
-        
-    def _get_remote_list_command(self):
-        remote_path = self.options['destination_path']
-        ls_subcommand = '/bin/ls {0}'.format(remote_path)
-        ssh_command_options = {
-            'user': self.options['destination_user'],
-            'host': self.options['destination_host'],
-            'port': self.options['ssh_port'],
-            'identity_file': self.options['ssh_identity_file'],
-            'subcommand': ls_subcommand
-        }
-        ssh_command = SSHCommand().create(ssh_command_options)
-        return ssh_command
+    def _classify_existing_backups(self):
+        self.files_to_remove = self._get_files_to_remove() + \
+                               [backup['fullpath']
+                                for backup in self.stale_partial_backups]
 
-    def _parse_files_from_results(self, remote_command_results):
-        files = []
-        if remote_command_results:
-            files_as_list = remote_command_results.split('\n')
-            files = [x for x in files_as_list if x]
-        return files
-
-    def _create_backup_file_dictionary(self, filename):
+    def _create_backup_file_dictionary(self, filename, entry=None):
         date = self._get_date_from_backup_filename(filename)
         path = self.options['destination_path']
+        entry = entry or {}
         backup_dict = {}
         backup_dict['filename'] = filename
         backup_dict['fullpath'] = os.path.join(path, filename)
         backup_dict['date'] = date
+        backup_dict['incremental'] = self._is_incremental_backup(filename)
+        backup_dict['directory'] = entry.get('type') == 'd'
+        backup_dict['size'] = entry.get('size')
+        backup_dict['mtime'] = entry.get('mtime')
         return backup_dict
 
-    def _get_date_from_backup_filename(self, filename):
+    def _remove_stale_backups(self):
+        if self._is_collecting_metrics():
+            sizes = self._get_backup_sizes()
+        self.failed_removals = self._remove_files(self.files_to_remove)
+        if self._is_collecting_metrics():
+            self._record_backup_sizes(sizes)
+
+    def _remove_files(self, files):
         '''
-        Parse date from backup filename like
-        automated-backup-2012-02-01.tar.bzip2
-        <prefix><date><ext>
+        The paths are streamed NUL delimited over stdin to a remote xargs,
+        so no command line grows with the number of stale archives. xargs
+        runs bounded batches in parallel, and every path that could not be
+        removed is written back NUL delimited instead of failing the prune.
+        Returns the paths that could not be removed.
         '''
-        backup_prefix = self.options['backup_prefix']
-        prefix_length = len(backup_prefix)
-        if '.' in filename:
-            first_period = filename.index('.')
-            filename_less_extension = filename[:first_period]
-        else:
-            filename_less_extension = filename
-        date = filename_less_extension[prefix_length:]
-        return date
-
-    def _remove_stale_backups(self):
+        if not files:
+            return []
         remove_files_command = self._get_remove_files_command()
-        if remove_files_command:
-            self._execute_command(remove_files_command)
+        return self._execute_command_with_records(remove_files_command, files)
+
+    def _get_backup_sizes(self):
+        '''
+        Measured before removal. Archive files are sized by the listing
+        itself. Only snapshot directories need a du, one for all of them.
+        '''
+        directories = [backup['fullpath'] for backup in self.existing_backups
+                       if backup['directory']]
+        sizes = self._get_remote_sizes(directories)
+        for backup in self.existing_backups + self.stale_partial_backups:
+            if not backup['directory']:
+                sizes[backup['fullpath']] = backup['size'] or 0
+        return sizes
+
+    def _record_backup_sizes(self, sizes):
+        'Archives that failed to be removed count as retained'
+        failed_removals = set(self.failed_removals)
+        removed = set(self.files_to_remove) - failed_removals
+        pruned_sizes = [size for fullpath, size in sizes.items()
+                        if fullpath in removed]
+        retained_sizes = [size for fullpath, size in sizes.items()
+                          if fullpath not in removed]
+        self.metrics['pruned_count'] = len(removed)
+        self.metrics['pruned_bytes'] = sum(pruned_sizes)
+        self.metrics['retained_count'] = len(self.existing_backups) + \
+                                         len(self.stale_partial_backups) - \
+                                         len(removed)
+        self.metrics['retained_bytes'] = sum(retained_sizes)
+        self.metrics['prune_failed_count'] = len(failed_removals)
+        self.metrics['prune_failed'] = sorted(failed_removals)
 
     def _get_remove_files_command(self):
         subcommand = self._get_remove_files_subcommand()
-        if not subcommand:
-            return ''
-        ssh_command_options = {
-            'user': self.options['destination_user'],
-            'host': self.options['destination_host'],
-            'port': self.options['ssh_port'],
-            'identity_file': self.options['ssh_identity_file'],
-            'subcommand': subcommand
-        }
+        ssh_command_options = self._get_ssh_command_options(subcommand)
         ssh_command = SSHCommand().create(ssh_command_options)
         return ssh_command
-        
+
     def _get_remove_files_subcommand(self):
-        files = self._get_files_to_remove()
-        if not files:
-            return ''
-        files_to_remove = ' '.join(files)
-        rm_command = '/bin/rm -r {0}'.format(files_to_remove)
-        return rm_command
+        '''
+        The inline script handles each path of its batch on its own, so one
+        failure does not stop the rest of the batch. rm's and mv's own error
+        messages are kept on stderr. In trash mode stale archives are only
+        renamed into the trash directory, which is cheap even for huge
+        archives, and deleted later by the trash reaper, see
+        lib.backuptrashreaper.
+        '''
+        xargs_command = '/usr/bin/xargs -0 -r -n {0} -P {1} /bin/sh -c'.format(
+            self._get_prune_batch_size(), self._get_prune_parallelism()
+        )
+        if self.options.get('prune_mode') == 'trash':
+            trash_path = self._get_trash_path()
+            script = 'trash=$1; shift; for path; do ' \
+                     '/bin/mv -- "$path" "$trash"/ || ' \
+                     'printf "%s\\0" "$path"; done'
+            return '/bin/mkdir -p {0} && {1} \'{2}\' sh {0}'.format(
+                trash_path, xargs_command, script
+            )
+        script = 'for path; do /bin/rm -r -- "$path" || ' \
+                 'printf "%s\\0" "$path"; done'
+        return '{0} \'{1}\' sh'.format(xargs_command, script)
+
+    def _get_prune_batch_size(self):
+        return max(int(self.options.get('prune_batch_size') or 100), 1)
+
+    def _get_prune_parallelism(self):
+        return max(int(self.options.get('prune_parallelism') or 4), 1)
 
     def _get_files_to_remove(self):
-        dates_to_keep = self._get_backup_dates_to_keep()
-        files_to_remove = []
-        for backup in self.existing_backups:
-            date = backup.get('date')
-            if date not in dates_to_keep:
-                fullpath = backup.get('fullpath')
-                files_to_remove.append(fullpath)
-        return files_to_remove
-
-    def _get_backup_dates_to_keep(self):
-        date_library = self._create_date_library()
-        dates = date_library.get_dates_as_strings()
-        if self.oldest_backup_date:
-            dates.append(self.oldest_backup_date)
-        return dates
-
-    def _create_date_library(self):
-        self._set_oldest_backup_date()
-        options = {
-            'days_to_retain': self.options['days'],
-            'weeks_to_retain': self.options['weeks'],
-            'months_to_retain': self.options['months'],
-            'years_to_retain': self.options['years'],
-            'anchor_date': self.oldest_backup_date
-        }
-        date_library = RoundRobinDate(options)
-        return date_library
-
-    def _set_oldest_backup_date(self):
-        existing_backups = self.existing_backups
-        if existing_backups:
-            dates = [backup['date'] for backup in existing_backups]
-            dates.sort()
-            oldest_backup_date = dates[0]
-        else:
-            oldest_backup_date = ''
-        self.oldest_backup_date = oldest_backup_date
+        'See utilities.roundrobindate.RoundRobinBackupClassifier'
+        options = self._get_round_robin_date_options()
+        classifier = RoundRobinBackupClassifier(options)
+        stale_backups = classifier.get_stale_backups(self.existing_backups)
+        return [backup['fullpath'] for backup in stale_backups]
@@ -1,6 +1,6 @@
 import os
 from lib.backupagent import BackupAgent
-from utilities.roundrobindate import RoundRobinDate
+from utilities.compression import CompressionCommand
 from utilities.sshutilities import SSHCommand
 
 
@@ -8,35 +8,323 @@ class BackupArchiver(BackupAgent):
 
     def execute(self):
         'Create an archival tar on the remote target'
-        ssh_command = self._get_ssh_command()
-        self._execute_command(ssh_command)
+        if self.options.get('archive_mode') == 'stream':
+            self._stream_archive()
+        elif self._is_using_remote_helper() or \
+                self._is_using_python_writer():
+            self._archive_with_remote_helper()
+            return
+        else:
+            ssh_command = self._get_ssh_command()
+            self._execute_command(ssh_command)
+        if self._is_collecting_metrics():
+            self._record_archive_size()
 
-    def _get_ssh_command(self):
-        subcommand = self._get_tar_subcommand()
-        ssh_command_options = {
-            'user': self.options['destination_user'],
-            'host': self.options['destination_host'],
-            'port': self.options['ssh_port'],
-            'identity_file': self.options['ssh_identity_file'],
-            'subcommand': subcommand
+    def _archive_with_remote_helper(self):
+        '''
+        Creates the archive and flushes it to disk in one ssh session. The
+        helper reports the archive size, so no stat round trip is needed.
+        '''
+        if self._is_using_python_writer():
+            archive_operation = self._get_write_archive_operation()
+        else:
+            subcommand = self._get_archive_subcommand()
+            archive_operation = {'op': 'archive', 'command': subcommand,
+                                 'path': self.archive_fullpath}
+        results = self._execute_remote_helper([
+            archive_operation,
+            {'op': 'fsync', 'paths': [self.archive_fullpath]}
+        ])
+        if results and self._is_collecting_metrics():
+            self.metrics['archive_bytes'] = results[0]['size']
+
+    def _is_using_python_writer(self):
+        return self.options.get('archive_writer') == 'python'
+
+    def _get_write_archive_operation(self):
+        '''
+        The archive is written by utilities.archivewriter, through the
+        helper, instead of by tar and a compressor command. GNU tar's
+        incremental archives have no pure Python counterpart.
+        '''
+        archive_mode = self.options.get('archive_mode') or 'tar'
+        if archive_mode != 'tar':
+            raise Exception('--archive-writer python only creates '
+                            '--archive-mode tar archives, not '
+                            '"{0}"'.format(archive_mode))
+        rsync_dir = self.options['rsync_dir']
+        self.archive_fullpath = self._get_backup_fullpath()
+        operation = {
+            'op': 'write_archive',
+            'source': os.path.join(self.options['destination_path'],
+                                   rsync_dir),
+            'arcname': rsync_dir,
+            'path': self.archive_fullpath,
+            'codec': self.options.get('compression', 'bzip2'),
+            'level': self.options.get('compression_level'),
+            'processes': self.options.get('archive_processes')
         }
+        return operation
+
+    def _record_archive_size(self):
+        if self._is_local_destination():
+            sizes = self._get_remote_sizes([self.archive_fullpath])
+            if self.archive_fullpath in sizes:
+                self.metrics['archive_bytes'] = sizes[self.archive_fullpath]
+            return
+        subcommand = '/usr/bin/stat -c %s {0}'.format(self.archive_fullpath)
+        ssh_command_options = self._get_ssh_command_options(subcommand)
         ssh_command = SSHCommand().create(ssh_command_options)
-        return ssh_command
+        output = self._execute_command(ssh_command)
+        if output and output.strip().isdigit():
+            self.metrics['archive_bytes'] = int(output)
+
+    def _stream_archive(self):
+        '''
+        Pipes a tar of the local source through a local compressor straight
+        into a .partial file on the destination. The partial file is only
+        renamed into place once every stage of the pipeline succeeded, and
+        removed if one failed.
+        '''
+        if self._is_local_destination():
+            self._make_destination_dir(self.options['destination_path'])
+        commands = self._get_stream_archive_commands()
+        try:
+            self._execute_command_queue(commands)
+        except Exception:
+            self._remove_partial_archive()
+            raise
+        if self._is_local_destination():
+            self._execute_remote_helper([{
+                'op': 'rename',
+                'source': self._get_partial_backup_fullpath(),
+                'path': self._get_backup_fullpath()
+            }])
+            return
+        publish_command = self._get_publish_stream_archive_command()
+        self._execute_command(publish_command)
+
+    def _remove_partial_archive(self):
+        '''
+        Best effort, a failure to clean up must not hide the error that
+        caused it. Partial archives left behind are removed by the pruner
+        once they are older than the current date.
+        '''
+        partial_fullpath = self._get_partial_backup_fullpath()
+        if self._is_local_destination():
+            if os.path.exists(partial_fullpath):
+                os.remove(partial_fullpath)
+            return
+        subcommand = '/bin/rm -f {0}'.format(partial_fullpath)
+        ssh_command_options = self._get_ssh_command_options(subcommand)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        self._execute_command(ssh_command, return_boolean=True)
+
+    def _get_stream_archive_commands(self):
+        commands = [self._get_local_tar_command()]
+        compressor = self._get_compressor_command()
+        if compressor:
+            commands.append(compressor)
+        commands.append(self._get_stream_upload_command())
+        return commands
 
-    def _get_tar_subcommand(self):
+    def _get_local_tar_command(self):
+        '''
+        GNU tar exits 1 when a file changed while it was read, which is
+        expected on the live sources this mode archives. Like rsync's
+        vanished files, it is treated as a warning: tar's messages are kept
+        on stderr and only other exit statuses fail the pipeline.
+        '''
+        parent, name = os.path.split(self.options['source'])
+        tar = ['tar', '-C', parent or '.', '-cf', '-']
+        excludes = ['--exclude={0}'.format(item)
+                    for item in self.options['exclude']]
+        script = 'tar "$@"; status=$?; [ $status -eq 1 ] && exit 0; ' \
+                 'exit $status'
+        return ['/bin/sh', '-c', script, 'sh'] + tar[1:] + excludes + \
+               [name or '.']
+
+    def _get_stream_upload_command(self):
+        '''
+        Local destinations are written by a cat of the pipeline's output,
+        as execute_queue only pipes between commands.
+        '''
         backup_path = self.options['destination_path']
+        partial_fullpath = self._get_partial_backup_fullpath()
+        if self._is_local_destination():
+            return ['/bin/sh', '-c', 'exec /bin/cat > "$1"', 'sh',
+                    partial_fullpath]
+        subcommand = '/bin/mkdir -p {0} && /bin/cat > {1}'.format(
+            backup_path, partial_fullpath
+        )
+        ssh_command_options = self._get_ssh_command_options(subcommand)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        return ssh_command
+
+    def _get_publish_stream_archive_command(self):
+        partial_fullpath = self._get_partial_backup_fullpath()
         backup_fullpath = self._get_backup_fullpath()
+        subcommand = '/bin/mv {0} {1}'.format(partial_fullpath, backup_fullpath)
+        ssh_command_options = self._get_ssh_command_options(subcommand)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        return ssh_command
+
+    def _get_partial_backup_fullpath(self, backup_type=''):
+        self.archive_fullpath = self._get_backup_fullpath(backup_type)
+        return '{0}.partial'.format(self.archive_fullpath)
+
+    def _get_ssh_command(self):
+        subcommand = self._get_archive_subcommand()
+        ssh_command_options = self._get_ssh_command_options(subcommand)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        return ssh_command
+
+    def _get_archive_subcommand(self):
+        if self.options.get('archive_mode') == 'incremental':
+            return self._get_incremental_tar_subcommand()
+        return self._get_tar_subcommand()
+
+    def _get_tar_subcommand(self, tar_flags=(), backup_type=''):
+        '''
+        The archive is written to a .partial file and only renamed into
+        place once tar succeeded, or removed if it failed. A compressor
+        pipeline runs under bash with pipefail, as otherwise its exit
+        status would be the compressor's and a failed tar would still
+        publish a truncated archive.
+        '''
+        backup_path = self.options['destination_path']
+        partial_fullpath = self._get_partial_backup_fullpath(backup_type)
         rsync_dir = self.options['rsync_dir']
-        tar_command = '/bin/tar -C {0} -cjf {1} {2}'.format(
-            backup_path, backup_fullpath, rsync_dir
+        tar = ' '.join(['/bin/tar', '-C', backup_path] + list(tar_flags))
+        compressor = self._get_compressor_command()
+        if self._uses_tar_builtin_compression():
+            tar_command = '{0} -cjf {1} {2}'.format(
+                tar, partial_fullpath, rsync_dir
+            )
+        elif not compressor:
+            tar_command = '{0} -cf {1} {2}'.format(
+                tar, partial_fullpath, rsync_dir
+            )
+        else:
+            tar_command = "/bin/bash -c 'set -o pipefail && " \
+                          "{0} -cf - {1} | {2} > {3}'".format(
+                tar, rsync_dir, ' '.join(compressor), partial_fullpath
+            )
+        return '{0} && /bin/mv {1} {2} || {{ /bin/rm -f {1}; false; }}'.format(
+            tar_command, partial_fullpath, self.archive_fullpath
         )
-        return tar_command
 
-    def _get_backup_fullpath(self):
-        date = RoundRobinDate()
+    def _get_incremental_tar_subcommand(self):
+        '''
+        Full archives record a level 0 GNU tar snapshot file. Incremental
+        archives are created against a scratch copy of it, so each one only
+        depends on the latest full archive and not on other incrementals.
+        The new snapshot file only replaces the old one once its full
+        archive was renamed into place, so a failed archive never leaves a
+        snapshot that no published archive matches.
+        '''
+        snapshot_file = self._get_snapshot_file_path()
+        if self._is_full_backup_day():
+            new_snapshot_file = '{0}.new'.format(snapshot_file)
+            tar_flags = ['--listed-incremental={0}'.format(new_snapshot_file)]
+            tar_command = self._get_tar_subcommand(tar_flags)
+            return '/bin/rm -f {0} && {1} && /bin/mv {0} {2}'.format(
+                new_snapshot_file, tar_command, snapshot_file
+            )
+        work_snapshot_file = '{0}.work'.format(snapshot_file)
+        tar_flags = ['--listed-incremental={0}'.format(work_snapshot_file)]
+        tar_command = self._get_tar_subcommand(tar_flags, '.incremental')
+        return '/bin/cp {0} {1} && {2} && /bin/rm {1}'.format(
+            snapshot_file, work_snapshot_file, tar_command
+        )
+
+    def _get_snapshot_file_path(self):
+        backup_path = self.options['destination_path']
+        backup_prefix = self.options['backup_prefix']
+        snapshot_filename = '.{0}level0.snar'.format(backup_prefix)
+        return os.path.join(backup_path, snapshot_filename)
+
+    def _is_full_backup_day(self):
+        '''
+        Full archives are created on the weekly, monthly and yearly anchor
+        dates the pruner retains, and whenever no usable full archive or
+        snapshot file exists yet.
+        '''
+        backups = self._get_existing_backups()
+        full_backup_dates = [date for date, incremental in backups
+                             if not incremental]
+        if not full_backup_dates:
+            return True
+        snapshot_file = self._get_snapshot_file_path()
+        if not self._remote_file_exists(snapshot_file):
+            return True
+        oldest_backup_date = min(date for date, incremental in backups)
+        return self._is_anchor_date(oldest_backup_date)
+
+    def _get_existing_backups(self):
+        backup_prefix = self.options['backup_prefix']
+        backups = []
+        for filename in self._get_remote_backup_dir_files_list():
+            if not filename.startswith(backup_prefix):
+                continue
+            date = self._get_date_from_backup_filename(filename)
+            if not self._is_backup_date(date):
+                continue
+            incremental = self._is_incremental_backup(filename)
+            backups.append((date, incremental))
+        return backups
+
+    def _remote_file_exists(self, path):
+        if self._is_local_destination():
+            return os.path.isfile(path)
+        subcommand = '/usr/bin/test -f {0}'.format(path)
+        ssh_command_options = self._get_ssh_command_options(subcommand)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        return self._execute_command(ssh_command, return_boolean=True)
+
+    def _is_anchor_date(self, oldest_backup_date):
+        date_library = self._create_round_robin_date(oldest_backup_date)
+        date_options = date_library.get_options()
+        today = date_options['current_date']
+        same_day_of_week = (today.isoweekday() ==
+                            date_options['backup_day_of_week'])
+        same_day_of_month = (today.day == date_options['backup_day_of_month'])
+        same_month_of_year = (today.month ==
+                              date_options['backup_month_of_year'])
+        if date_options['weeks_to_retain'] and same_day_of_week:
+            return True
+        if date_options['months_to_retain'] and same_day_of_month:
+            return True
+        if date_options['years_to_retain'] and same_day_of_month and \
+                same_month_of_year:
+            return True
+        return False
+
+    def _uses_tar_builtin_compression(self):
+        'The default codec keeps using tar\'s own bzip2 support'
+        codec = self.options.get('compression', 'bzip2')
+        level = self.options.get('compression_level')
+        return codec == 'bzip2' and level is None
+
+    def _get_compressor_command(self):
+        options = {
+            'codec': self.options.get('compression', 'bzip2'),
+            'level': self.options.get('compression_level')
+        }
+        command = CompressionCommand().create(options)
+        return command
+
+    def _get_backup_fullpath(self, backup_type=''):
         backup_path = self.options['destination_path']
         backup_prefix = self.options['backup_prefix']
-        backup_date = date.get_today()
-        backup_filename = '{0}{1}.tar.bzip2'.format(backup_prefix, backup_date)
+        backup_date = self._get_today()
+        backup_extension = self._get_backup_extension()
+        backup_filename = '{0}{1}{2}{3}'.format(backup_prefix, backup_date,
+                                                backup_type, backup_extension)
         backup_fullpath = os.path.join(backup_path, backup_filename)
         return backup_fullpath
+
+    def _get_backup_extension(self):
+        codec = self.options.get('compression', 'bzip2')
+        extension = CompressionCommand().get_extension(codec)
+        return extension
@@ -1,5 +1,11 @@
+import fnmatch
 import os
+import shutil
+import tempfile
+import threading
 from lib.backupagent import BackupAgent
+from utilities.aimdcontroller import AIMDController
+from utilities.rsyncstats import RsyncStatsParser
 from utilities.sshutilities import SSHCommand
 
 
@@ -11,31 +17,313 @@ class BackupCreator(BackupAgent):
         self._rsync_data()
 
     def _create_remote_backup_dir_if_needed(self):
-        command = self._get_make_backup_dir_command()
-        self._execute_command(command)
-
-    def _get_make_backup_dir_command(self):
         destination_path = self.options['destination_path']
-        rsync_dir = self.options['rsync_dir']
+        rsync_dir = self._get_rsync_dir()
         remote_path = os.path.join(destination_path, rsync_dir)
-        remote_command = "/bin/mkdir -p {0}".format(remote_path)
-        ssh_command_options = {
-            'user': self.options['destination_user'],
-            'host': self.options['destination_host'],
-            'port': self.options['ssh_port'],
-            'identity_file': self.options['ssh_identity_file'],
-            'subcommand': remote_command
-        }
-        ssh_command = SSHCommand().create(ssh_command_options)
-        return ssh_command
+        self._make_destination_dir(remote_path)
 
     def _rsync_data(self):
+        if self.options.get('rsync_read_batch'):
+            self._replay_rsync_batch()
+            return
+        if self._get_rsync_shard_count() > 1:
+            self._rsync_data_in_shards()
+            return
+        rsync_command = self._get_backup_rsync_command()
+        rsync_output = self._execute_command(rsync_command)
+        self._record_rsync_stats(rsync_output)
+
+    def _replay_rsync_batch(self):
+        '''
+        Applies the changes recorded while syncing another destination
+        instead of scanning the source again. Falls back to a regular rsync
+        if the batch does not apply, e.g. when this destination diverged.
+        '''
+        read_batch_command = self._get_read_batch_rsync_command()
+        if self._execute_command(read_batch_command, return_boolean=True):
+            return
         rsync_command = self._get_backup_rsync_command()
-        self._execute_command(rsync_command)
+        rsync_output = self._execute_command(rsync_command)
+        self._record_rsync_stats(rsync_output)
+
+    def _get_rsync_shard_count(self):
+        '''
+        A batch file records a single rsync, so the first of multiple
+        destinations, which writes it, is not sharded.
+        '''
+        if self.options.get('rsync_write_batch'):
+            return 1
+        shards = max(int(self.options.get('rsync_shards') or 1), 1)
+        if shards == 1 and self._is_adaptive_rsync():
+            shards = 4 * self._get_rsync_max_workers()
+        return shards
+
+    def _is_adaptive_rsync(self):
+        return bool(self.options.get('rsync_max_workers'))
+
+    def _get_rsync_max_workers(self):
+        return max(int(self.options.get('rsync_max_workers') or 1),
+                   self._get_rsync_min_workers())
+
+    def _get_rsync_min_workers(self):
+        return max(int(self.options.get('rsync_min_workers') or 1), 1)
+
+    def _rsync_data_in_shards(self):
+        '''
+        The source's top level directories are split into balanced shards,
+        each synced by its own rsync with --files-from, all at once, so file
+        list building and the per-file round trips of a huge tree run in
+        parallel. Deletions stay correct: every shard deletes within its own
+        directories, and a first, non-recursive rsync -d --delete of the top
+        level syncs the top level files and deletes top level entries that
+        are gone from the source.
+        '''
+        base, prefix = self._split_rsync_source()
+        shards = self._get_rsync_shards(base, prefix)
+        top_level_command = self._get_top_level_rsync_command(base, prefix)
+        rsync_outputs = [self._execute_command(top_level_command)]
+        files_from_dir = tempfile.mkdtemp(prefix='rrbackup-shards-')
+        try:
+            commands = []
+            for index, names in enumerate(shards):
+                files_from = os.path.join(files_from_dir,
+                                          'shard-{0}'.format(index))
+                with open(files_from, 'wb') as files_from_file:
+                    files_from_file.write(''.join(
+                        name + '\0' for name in names
+                    ).encode('utf-8'))
+                commands.append(self._get_shard_rsync_command(base,
+                                                              files_from))
+            if self._is_adaptive_rsync():
+                rsync_outputs.extend(
+                    self._execute_commands_adaptively(commands)
+                )
+            else:
+                rsync_outputs.extend(
+                    self._execute_commands_concurrently(commands)
+                )
+        finally:
+            shutil.rmtree(files_from_dir, ignore_errors=True)
+        self._record_sharded_rsync_stats(rsync_outputs)
+
+    def _split_rsync_source(self):
+        '''
+        rsync copies a source without a trailing slash into a directory of
+        its own name. Returns the directory the shards' --files-from paths
+        are relative to, and the prefix of those paths.
+        '''
+        source = self.options['source']
+        if source.endswith('/'):
+            return source, ''
+        base, name = os.path.split(source)
+        return base or '.', name + '/'
+
+    def _get_rsync_shards(self, base, prefix):
+        '''
+        Top level directories are weighed by the number of entries directly
+        inside them, one directory listing each instead of a scan of the
+        whole tree, and assigned, heaviest first, to the lightest shard.
+        Excluded entries do not count. The weights only balance the shards,
+        rsync applies the excludes itself.
+        '''
+        source_dir = os.path.join(base, prefix)
+        weights = []
+        for name in sorted(os.listdir(source_dir)):
+            fullpath = os.path.join(source_dir, name)
+            if os.path.isdir(fullpath) and not os.path.islink(fullpath):
+                weight = self._get_shard_weight(fullpath, prefix + name)
+                weights.append((weight, prefix + name))
+        shard_count = min(self._get_rsync_shard_count(), len(weights))
+        shards = [[] for index in range(shard_count)]
+        loads = [0] * shard_count
+        for weight, name in sorted(weights, reverse=True):
+            lightest = loads.index(min(loads))
+            shards[lightest].append(name)
+            loads[lightest] += weight + 1
+        return shards
+
+    def _get_shard_weight(self, fullpath, relative_path):
+        if self._is_excluded(relative_path):
+            return 0
+        try:
+            names = os.listdir(fullpath)
+        except OSError:
+            return 0
+        return len([name for name in names if not self._is_excluded(
+            '{0}/{1}'.format(relative_path, name)
+        )])
+
+    def _is_excluded(self, relative_path):
+        '''
+        Approximates rsync's --exclude matching of a path relative to the
+        transfer root: a pattern without a slash matches the last path
+        component, a pattern starting with one the whole path, and other
+        patterns the end of the path.
+        '''
+        name = relative_path.rsplit('/', 1)[-1]
+        for pattern in self.options['exclude']:
+            pattern = pattern.rstrip('/')
+            if '/' not in pattern:
+                if fnmatch.fnmatch(name, pattern):
+                    return True
+            elif pattern.startswith('/'):
+                if fnmatch.fnmatch(relative_path, pattern[1:]):
+                    return True
+            elif fnmatch.fnmatch(relative_path, pattern) or \
+                    fnmatch.fnmatch(relative_path, '*/' + pattern):
+                return True
+        return False
+
+    def _get_top_level_rsync_command(self, base, prefix):
+        'rsync -a without recursion, -r, which -d replaces'
+        rsync = ['rsync']
+        flags = ['-dlptgoDz', '--delete'] + \
+                self._get_link_dest_flags(prefix) + self._get_stats_flags()
+        ssh_commands = self._get_ssh_command()
+        source = [os.path.join(base, prefix)]
+        target = [os.path.join(self._get_rsync_target()[0], prefix)]
+        excludes = self._get_exclude_commands()
+        command = rsync + flags + ssh_commands + source + target + excludes
+        return command
+
+    def _get_shard_rsync_command(self, base, files_from):
+        '''
+        --files-from implies --relative and turns off the recursion of -a,
+        so -r is given explicitly.
+        '''
+        rsync = ['rsync']
+        flags = ['-az', '--delete'] + self._get_link_dest_flags() + \
+                self._get_stats_flags() + \
+                ['-r', '--from0', '--files-from={0}'.format(files_from)]
+        ssh_commands = self._get_ssh_command()
+        source = [os.path.join(base, '')]
+        target = self._get_rsync_target()
+        excludes = self._get_exclude_commands()
+        command = rsync + flags + ssh_commands + source + target + excludes
+        return command
+
+    def _execute_commands_concurrently(self, commands):
+        '''
+        Every command is submitted at once, to the reactor of an
+        AsyncCommandLine. Returns their outputs in order once all have
+        finished, or raises the first failure.
+        '''
+        async_commands = [self._execute_command_async(command)
+                          for command in commands]
+        outputs = []
+        errors = []
+        for async_command in async_commands:
+            try:
+                outputs.append(async_command.result())
+            except Exception as error:
+                errors.append(error)
+        if errors:
+            raise errors[0]
+        return outputs
+
+    def _execute_commands_adaptively(self, commands):
+        '''
+        Runs the commands with as many at once as an AIMDController
+        allows, between --rsync-min-workers and --rsync-max-workers. Each
+        finished rsync reports its rate, the bytes it sent and received per
+        second of wall time, from its --stats. Returns the outputs in order
+        once all have finished. After a failure no more commands are
+        started, and the first failure is raised once the running ones
+        have finished.
+
+        Commands are submitted with _execute_command_async and report back
+        through done callbacks, so no thread is started per command.
+        '''
+        controller = AIMDController({
+            'minimum': self._get_rsync_min_workers(),
+            'maximum': self._get_rsync_max_workers()
+        })
+        condition = threading.Condition()
+        queued = list(range(len(commands)))
+        running = []
+        finished = []
+        outputs = [None] * len(commands)
+        errors = []
+        def create_callback(index):
+            def callback(async_command):
+                with condition:
+                    finished.append((index, async_command))
+                    condition.notify()
+            return callback
+        with condition:
+            while running or (queued and not errors):
+                while queued and not errors and \
+                        len(running) < controller.get_level():
+                    index = queued.pop(0)
+                    running.append(index)
+                    async_command = self._execute_command_async(commands[index])
+                    async_command.add_done_callback(create_callback(index))
+                while not finished:
+                    condition.wait()
+                for index, async_command in finished:
+                    running.remove(index)
+                    if async_command.error is not None:
+                        errors.append(async_command.error)
+                        continue
+                    outputs[index] = async_command.value
+                    controller.record(self._get_rsync_rate(
+                        async_command.value, async_command.duration
+                    ))
+                del finished[:]
+        self.rsync_worker_levels = controller.get_history()
+        if errors:
+            raise errors[0]
+        return outputs
+
+    def _get_rsync_rate(self, rsync_output, duration):
+        stats = RsyncStatsParser().parse(rsync_output)
+        transferred = stats.get('bytes_sent', 0) + \
+                      stats.get('bytes_received', 0)
+        return transferred / max(duration, 0.001)
+
+    def _record_sharded_rsync_stats(self, rsync_outputs):
+        '''
+        Counts and byte totals are summed over every rsync. The speedup is
+        recomputed from the sums, as rsync computes it.
+        '''
+        if not self._is_collecting_metrics():
+            return
+        parser = RsyncStatsParser()
+        stats = {}
+        for rsync_output in rsync_outputs:
+            for key, value in parser.parse(rsync_output).items():
+                if key != 'speedup':
+                    stats[key] = stats.get(key, 0) + value
+        transferred = stats.get('bytes_sent', 0) + \
+                      stats.get('bytes_received', 0)
+        if 'total_file_size' in stats and transferred:
+            stats['speedup'] = round(float(stats['total_file_size']) /
+                                     transferred, 2)
+        stats['rsync_shards'] = len(rsync_outputs) - 1
+        if self._is_adaptive_rsync():
+            stats['rsync_worker_levels'] = self.rsync_worker_levels
+            stats['rsync_workers'] = self.rsync_worker_levels[-1]['level']
+        self.metrics.update(stats)
+
+    def _record_rsync_stats(self, rsync_output):
+        if not self._is_collecting_metrics() or not rsync_output:
+            return
+        rsync_stats = RsyncStatsParser().parse(rsync_output)
+        self.metrics.update(rsync_stats)
+
+    def _get_read_batch_rsync_command(self):
+        rsync = ['rsync']
+        batch_file = self.options['rsync_read_batch']
+        flags = ['-az', '--delete', '--read-batch={0}'.format(batch_file)]
+        ssh_commands = self._get_ssh_command()
+        target = self._get_rsync_target()
+        command = rsync + flags + ssh_commands + target
+        return command
 
     def _get_backup_rsync_command(self):
         rsync = ['rsync']
-        flags = ['-az', '--delete']
+        flags = ['-az', '--delete'] + self._get_link_dest_flags() + \
+                self._get_write_batch_flags() + self._get_stats_flags()
         ssh_commands = self._get_ssh_command()
         source = [self.options['source']]
         target = self._get_rsync_target()
@@ -43,10 +331,27 @@ class BackupCreator(BackupAgent):
         command = rsync + flags + ssh_commands + source + target + excludes
         return command
 
+    def _get_stats_flags(self):
+        'Adaptive concurrency measures each rsync by its stats'
+        if not self._is_collecting_metrics() and \
+                not self._is_adaptive_rsync():
+            return []
+        return ['--stats']
+
+    def _get_write_batch_flags(self):
+        batch_file = self.options.get('rsync_write_batch')
+        if not batch_file:
+            return []
+        return ['--write-batch={0}'.format(batch_file)]
+
     def _get_ssh_command(self):
+        'Local destinations are synced to directly, without ssh'
+        if self._is_local_destination():
+            return []
         options = {
             'port': self.options['ssh_port'],
             'identity_file': self.options['ssh_identity_file'],
+            'control_path': self.options.get('ssh_control_path'),
         }
         ssh_command = SSHCommand().create_command_string(options)
         rsync_command = []
@@ -56,7 +361,7 @@ class BackupCreator(BackupAgent):
 
     def _get_rsync_target(self):
         destination = self.options['destination']
-        rsync_dir = self.options['rsync_dir']
+        rsync_dir = self._get_rsync_dir()
         rsync_destination = [os.path.join(destination, rsync_dir)]
         return rsync_destination
 
@@ -66,3 +371,56 @@ class BackupCreator(BackupAgent):
             excludes_command.append('--exclude')
             excludes_command.append(item)
         return excludes_command
+
+    def _is_snapshot_mode(self):
+        return self.options.get('archive_mode') == 'snapshot'
+
+    def _get_rsync_dir(self):
+        '''
+        In snapshot mode each run syncs into its own dated directory,
+        <prefix><date>, instead of the shared rsync_dir.
+        '''
+        if not self._is_snapshot_mode():
+            return self.options['rsync_dir']
+        backup_prefix = self.options['backup_prefix']
+        backup_date = self._get_today()
+        snapshot_dir = '{0}{1}'.format(backup_prefix, backup_date)
+        return snapshot_dir
+
+    def _get_link_dest_flags(self, subdir=''):
+        '''
+        Unchanged files are hardlinked against the previous snapshot, so a
+        snapshot only costs the space and transfer of the changed files.
+        subdir is the target's directory within the snapshot, when rsync
+        targets one.
+        '''
+        if not self._is_snapshot_mode():
+            return []
+        previous_snapshot = self._get_previous_snapshot()
+        if not previous_snapshot:
+            return []
+        destination_path = self.options['destination_path']
+        link_dest = os.path.join(destination_path, previous_snapshot, subdir)
+        return ['--link-dest={0}'.format(link_dest.rstrip('/'))]
+
+    def _get_previous_snapshot(self):
+        'Listed once, as every rsync of a sharded sync links against it'
+        if not hasattr(self, 'previous_snapshot'):
+            self.previous_snapshot = self._find_previous_snapshot()
+        return self.previous_snapshot
+
+    def _find_previous_snapshot(self):
+        backup_prefix = self.options['backup_prefix']
+        prefix_length = len(backup_prefix)
+        current_snapshot = self._get_rsync_dir()
+        snapshots = []
+        for name in self._get_remote_backup_dir_files_list():
+            if not name.startswith(backup_prefix):
+                continue
+            if not self._is_backup_date(name[prefix_length:]):
+                continue
+            if name < current_snapshot:
+                snapshots.append(name)
+        if not snapshots:
+            return ''
+        return max(snapshots)
@@ -0,0 +1,114 @@
+import os
+from lib.backupagent import BackupAgent
+from utilities.sshutilities import SSHCommand
+
+
+class BackupTrashReaper(BackupAgent):
+
+    '''
+    Deletes the archives --prune-mode trash moved into the trash directory,
+    at a limited rate, so the metadata and journal I/O of unlinking huge
+    archives is spread out and can be scheduled outside the backup window.
+
+    The rate is enforced on the destination: the paths are streamed with a
+    delay each to a single remote xargs, which deletes them one at a time,
+    oldest first, sleeping after each. The delay is the longer of the time
+    --reap-files-per-second and --reap-bytes-per-second allow for the file.
+    '''
+
+    def execute(self):
+        'Delete trashed archives at the configured rate'
+        self._create_trash_dir_if_needed()
+        self._get_trashed_files()
+        self._reap_trashed_files()
+
+    def _create_trash_dir_if_needed(self):
+        self._make_destination_dir(self._get_trash_path())
+
+    def _get_trashed_files(self):
+        '''
+        Snapshot directories are listed with the size of the directory
+        itself, so they are measured with du.
+        '''
+        trash_path = self._get_trash_path()
+        trashed_files = []
+        for entry in self._get_remote_backup_dir_entries(trash_path):
+            entry['fullpath'] = os.path.join(trash_path, entry['name'])
+            trashed_files.append(entry)
+        directories = [entry['fullpath'] for entry in trashed_files
+                       if entry['type'] == 'd']
+        sizes = self._get_remote_sizes(directories)
+        for entry in trashed_files:
+            entry['size'] = sizes.get(entry['fullpath'], entry['size'])
+        self.trashed_files = sorted(trashed_files,
+                                    key=lambda entry: entry['mtime'])
+
+    def _reap_trashed_files(self):
+        self.failed_removals = []
+        if self.trashed_files and self._is_local_destination():
+            self._reap_local_trashed_files()
+        elif self.trashed_files:
+            records = []
+            for entry in self.trashed_files:
+                records.append('{0:.3f}'.format(self._get_delay(entry)))
+                records.append(entry['fullpath'])
+            reap_command = self._get_reap_command()
+            self.failed_removals = self._execute_command_with_records(
+                reap_command, records
+            )
+        if self._is_collecting_metrics():
+            self._record_reaped_sizes()
+
+    def _reap_local_trashed_files(self):
+        'Local trash is deleted in process, sleeping between removals'
+        results = self._execute_remote_helper([{
+            'op': 'remove',
+            'paths': [entry['fullpath'] for entry in self.trashed_files],
+            'delays': [self._get_delay(entry) for entry in self.trashed_files]
+        }])
+        if results:
+            self.failed_removals = [failure['path']
+                                    for failure in results[0]['failed']]
+
+    def _get_delay(self, entry):
+        files_per_second = self._get_rate('reap_files_per_second')
+        bytes_per_second = self._get_rate('reap_bytes_per_second')
+        delays = [0]
+        if files_per_second:
+            delays.append(1.0 / files_per_second)
+        if bytes_per_second:
+            delays.append(float(entry['size']) / bytes_per_second)
+        return max(delays)
+
+    def _get_rate(self, option):
+        rate = self.options.get(option)
+        if rate is None:
+            return 0
+        rate = float(rate)
+        if rate < 0:
+            raise Exception('Invalid --{0} "{1}", should not be '
+                            'negative'.format(option.replace('_', '-'), rate))
+        return rate
+
+    def _get_reap_command(self):
+        subcommand = self._get_reap_subcommand()
+        ssh_command_options = self._get_ssh_command_options(subcommand)
+        ssh_command = SSHCommand().create(ssh_command_options)
+        return ssh_command
+
+    def _get_reap_subcommand(self):
+        '''
+        xargs passes one delay and path pair at a time. Paths rm fails to
+        remove are written back NUL delimited.
+        '''
+        script = '/bin/rm -r -- "$2" || printf "%s\\0" "$2"; /bin/sleep "$1"'
+        return '/usr/bin/xargs -0 -r -n 2 /bin/sh -c \'{0}\' sh'.format(script)
+
+    def _record_reaped_sizes(self):
+        failed_removals = set(self.failed_removals)
+        reaped = [entry for entry in self.trashed_files
+                  if entry['fullpath'] not in failed_removals]
+        self.metrics['reaped_count'] = len(reaped)
+        self.metrics['reaped_bytes'] = sum(entry['size'] for entry in reaped)
+        self.metrics['reap_failed_count'] = len(failed_removals)
+        self.metrics['reap_failed'] = sorted(failed_removals)
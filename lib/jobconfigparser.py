@@ -0,0 +1,77 @@
+try:
+    from ConfigParser import RawConfigParser
+except ImportError:
+    from configparser import RawConfigParser
+from lib.optionsparser import OptionsParser
+
+
+class JobConfigParser:
+
+    '''
+    Reads backup jobs from an INI config file. Each section declares one
+    job, named after the section, and each key is the long name of a
+    command line option without the leading dashes:
+
+        [DEFAULT]
+        ssh-identity-file = /root/.ssh/backup
+        days = 7
+
+        [www-files]
+        source = /var/www
+        destination = backup@backup1.example.com:/backups/www
+        exclude = .git/*
+                  *.tmp
+        ssh-multiplex = true
+
+    Values are validated by the same parser as command line arguments.
+    Options that are flags take true or false, exclude takes one pattern
+    per line and destination one destination per line.
+    '''
+
+    def get_jobs(self, config_file):
+        config = self._read_config(config_file)
+        jobs = []
+        for job_name in config.sections():
+            job_options = self._create_job_options(config, job_name)
+            jobs.append(job_options)
+        return jobs
+
+    def _read_config(self, config_file):
+        config = RawConfigParser()
+        read_files = config.read(config_file)
+        if not read_files:
+            raise Exception("Unable to read job config file, "
+                            "'{0}'".format(config_file))
+        return config
+
+    def _create_job_options(self, config, job_name):
+        items = dict(config.items(job_name))
+        for key in ['source', 'destination']:
+            if not items.get(key):
+                raise Exception("Job '{0}' is missing the required '{1}' "
+                                "setting".format(job_name, key))
+        arguments = self._create_arguments(items)
+        options = OptionsParser().get_options(arguments)
+        options['job_name'] = job_name
+        return options
+
+    def _create_arguments(self, items):
+        destinations = items.pop('destination').split()
+        arguments = [items.pop('source')] + destinations
+        for key in sorted(items):
+            option = '--{0}'.format(key.replace('_', '-'))
+            arguments = arguments + self._create_option_arguments(option,
+                                                                  items[key])
+        return arguments
+
+    def _create_option_arguments(self, option, value):
+        if value.lower() == 'true':
+            return [option]
+        if value.lower() == 'false':
+            return []
+        option_arguments = []
+        for line in value.splitlines():
+            if line.strip():
+                option_argument = '{0}={1}'.format(option, line.strip())
+                option_arguments.append(option_argument)
+        return option_arguments
@@ -1,19 +1,24 @@
 import argparse
 import textwrap
 import os
+from utilities.compression import CompressionCommand
 from utilities.sshutilities import SSHParser
 
 
 class OptionsParser:
 
-    def get_options(self):
-        self.args = self._get_args()
+    def get_options(self, arguments=None):
+        '''
+        Parses sys.argv, or the given list of command line arguments
+        when set.
+        '''
+        self.args = self._get_args(arguments)
         options = self._parse_args_and_return_options()
         return options
 
-    def _get_args(self):
+    def _get_args(self, arguments=None):
         parser = ArgParser()
-        args = parser.get_args()
+        args = parser.get_args(arguments)
         return args
 
     def _parse_args_and_return_options(self):
@@ -23,8 +28,11 @@ class OptionsParser:
         return options
 
     def _create_destination_options(self):
+        ssh_string = self.args['destination'] or ''
+        return self.get_destination_options(ssh_string)
+
+    def get_destination_options(self, ssh_string):
         ssh_parser = SSHParser()
-        ssh_string = self.args['destination']
         parsed = ssh_parser.parse(ssh_string)
         new_destination_options = {
             'destination_user': parsed['user'],
@@ -36,20 +44,41 @@ class OptionsParser:
 
 class ArgParser:
 
-    def get_args(self):
-        parsed = self._parse()
+    def get_args(self, arguments=None):
+        parsed = self._parse(arguments)
         processed = self._process(parsed)
         args_dict = vars(processed)
         return args_dict
 
-    def _parse(self):
+    def _parse(self, arguments=None):
         argparse_options = self._get_argparse_options()
         parser = argparse.ArgumentParser(**argparse_options)
         parser = self._add_required_argparse_arguments(parser)
         parser = self._add_optional_runtime_flags(parser)
         parser = self._add_optional_rsync_argparse_arguments(parser)
         parser = self._add_optional_date_argparse_arguments(parser)
-        parsed = parser.parse_args()
+        parser = self._add_optional_scheduler_argparse_arguments(parser)
+        self.parser = parser
+        parsed, extras = parser.parse_known_args(arguments)
+        parsed = self._add_intermixed_positionals(parsed, extras)
+        return parsed
+
+    def _add_intermixed_positionals(self, parsed, extras):
+        '''
+        The source and destination positionals are optional for --config,
+        so argparse fills them from the arguments before the first option
+        only. Positionals placed after options, as in `/src --days 3
+        user@host:/dst`, are left over and assigned here in order.
+        '''
+        unrecognized = [extra for extra in extras if extra.startswith('-')]
+        if unrecognized:
+            self.parser.error('unrecognized arguments: '
+                              '{0}'.format(' '.join(unrecognized)))
+        for extra in extras:
+            if parsed.source is None:
+                parsed.source = extra
+            else:
+                parsed.destination.append(extra)
         return parsed
 
     def _get_argparse_options(self):
@@ -83,11 +112,16 @@ class ArgParser:
     def _add_required_argparse_arguments(self, parser):
         required = parser.add_argument_group('Required Arguments')
         required.add_argument('source',
-            help='The source directory path'
+            nargs='?',
+            help='The source directory path. Not used with --config'
         )
         required.add_argument('destination',
+            nargs='*',
             help='The target destination, in rsync/ssh compatible format:\
-                  user@example.com:/absolute/path/to/backup/dir'
+                  user@example.com:/absolute/path/to/backup/dir. Several \
+                  destinations may be given, the source is then scanned \
+                  once and the changes are replayed to every destination. \
+                  Not used with --config'
         )
         return parser
 
@@ -97,6 +131,24 @@ class ArgParser:
             action='store_true',
             help='Do not execute shell commands and print them out instead.'
         )
+        flags.add_argument('--ssh-multiplex',
+            action='store_true',
+            help='Open one multiplexed SSH master connection per run and \
+                  reuse it for every remote command and rsync transfer.'
+        )
+        flags.add_argument('--remote-helper',
+            action='store_true',
+            help='Archive and prune with a small Python helper piped to \
+                  the destination\'s Python, running each phase\'s remote \
+                  operations in a single ssh session'
+        )
+        flags.add_argument('--reap-trash',
+            action='store_true',
+            help='Instead of a backup, delete the archives --prune-mode \
+                  trash moved into the destination\'s .trash directory, at \
+                  the rate set by --reap-files-per-second and \
+                  --reap-bytes-per-second'
+        )
         return parser
 
     def _add_optional_rsync_argparse_arguments(self, parser):
@@ -122,16 +174,148 @@ class ArgParser:
             help='Directory within destination to keep the latest unzipped \
                   rsync files'
         )
+        configuration.add_argument('--rsync-shards',
+            action='store',
+            type=int,
+            default=1,
+            help='Split the source\'s top level directories into this many \
+                  shards, synced by concurrent rsync processes. Shards are \
+                  balanced by the number of entries directly inside each \
+                  directory, a rough heuristic for its size. Default is 1, \
+                  a single rsync'
+        )
+        configuration.add_argument('--rsync-max-workers',
+            action='store',
+            type=int,
+            help='Adapt the number of shards synced at once to the observed \
+                  throughput, between --rsync-min-workers and this many, \
+                  with additive increase, multiplicative decrease feedback. \
+                  The source is split into four shards per worker unless \
+                  --rsync-shards is given. Off by default'
+        )
+        configuration.add_argument('--rsync-min-workers',
+            action='store',
+            type=int,
+            default=1,
+            help='Lower bound of --rsync-max-workers. Default is 1'
+        )
         configuration.add_argument('--backup-prefix',
             action='store',
             default='automated-backup-',
-            help='Prefix of backup.tar.bzip2 files, e.g. \
-                  <backup-prefix>-<date>.tar.bzip2'
+            help='Prefix of backup archive names, \
+                  <backup-prefix><date><extension>, where the extension \
+                  depends on --compression, e.g. .tar.bzip2 or .tar.zst. \
+                  Default is automated-backup-'
+        )
+        configuration.add_argument('--archive-mode',
+            action='store',
+            default='tar',
+            choices=['tar', 'snapshot', 'incremental', 'stream'],
+            help='tar: archive the rsync dir into a dated tarball. snapshot: \
+                  rsync into a dated directory, hardlinking unchanged files \
+                  against the previous snapshot with rsync --link-dest. \
+                  incremental: full tarballs on weekly, monthly and yearly \
+                  anchor dates, GNU tar --listed-incremental tarballs on \
+                  other days. stream: tar and compress the source locally \
+                  and stream the archive over ssh, skipping rsync. \
+                  Defaults to tar'
+        )
+        configuration.add_argument('--compression',
+            action='store',
+            default='bzip2',
+            choices=CompressionCommand().get_codec_names(),
+            help='Archive compression codec. Parallel codecs (pbzip2, \
+                  lbzip2, pigz, xz and zstd with all cores) must be \
+                  installed on the destination. Defaults to bzip2'
+        )
+        configuration.add_argument('--compression-level',
+            action='store',
+            type=int,
+            help='Compression level passed to the codec, e.g. 1-9 for \
+                  bzip2 and gzip, 1-19 for zstd. Defaults to the codec\'s \
+                  own default'
+        )
+        configuration.add_argument('--archive-writer',
+            action='store',
+            default='tar',
+            choices=['tar', 'python'],
+            help='tar: create archives with tar and the compression codec\'s \
+                  command on the destination. python: with the Python \
+                  standard library instead, compressing bzip2 or gzip \
+                  blocks on every core. Runs through the --remote-helper \
+                  for remote destinations. Defaults to tar'
+        )
+        configuration.add_argument('--archive-processes',
+            action='store',
+            type=int,
+            help='Number of processes compressing with --archive-writer \
+                  python. Defaults to the number of cores'
+        )
+        configuration.add_argument('--prune-parallelism',
+            action='store',
+            type=int,
+            default=4,
+            help='Number of processes removing stale archives at once on \
+                  the destination, rm in delete mode and mv in trash mode. \
+                  Default is 4'
+        )
+        configuration.add_argument('--prune-batch-size',
+            action='store',
+            type=int,
+            default=100,
+            help='Maximum number of stale archives removed by one rm \
+                  process. Default is 100'
+        )
+        configuration.add_argument('--prune-mode',
+            action='store',
+            default='delete',
+            choices=['delete', 'trash'],
+            help='delete: remove stale archives. trash: only rename them \
+                  into a .trash directory in the destination, for \
+                  --reap-trash to delete later. Defaults to delete'
+        )
+        configuration.add_argument('--reap-files-per-second',
+            action='store',
+            type=float,
+            default=10,
+            help='Maximum number of trashed archives --reap-trash deletes \
+                  per second. Default is 10'
+        )
+        configuration.add_argument('--reap-bytes-per-second',
+            action='store',
+            type=int,
+            help='Maximum number of trashed archive bytes --reap-trash \
+                  deletes per second. Unlimited by default'
+        )
+        configuration.add_argument('--remote-python',
+            action='store',
+            default='python',
+            help='Python interpreter on the destination that runs \
+                  --remote-helper, Python 2.6+ or 3. Default is python'
+        )
+        configuration.add_argument('--metrics-file',
+            action='store',
+            help='Write a JSON run record with the duration, exit status and \
+                  command of every phase and remote command, rsync transfer \
+                  statistics, the archive size and the number and size of \
+                  pruned archives to this file'
+        )
+        configuration.add_argument('--prometheus-dir',
+            action='store',
+            help='node_exporter textfile collector directory. After each \
+                  run, atomically write roundrobinbackup_<job>.prom into it \
+                  with the last success time, phase durations, transferred \
+                  bytes, archive size and retained archives'
         )
         return parser
 
     def _add_optional_date_argparse_arguments(self, parser):
         date_options = parser.add_argument_group('Configuration options')
+        date_options.add_argument('--date',
+            action='store',
+            help='Run as if today were this date, YYYY-MM-DD. For testing \
+                  and benchmarks. Defaults to the current date'
+        )
         date_options.add_argument('--days',
             action='store',
             default='6',
@@ -155,11 +339,52 @@ class ArgParser:
         )
         return parser
 
+    def _add_optional_scheduler_argparse_arguments(self, parser):
+        scheduler = parser.add_argument_group('Multiple job options')
+        scheduler.add_argument('--config',
+            action='store',
+            help='Run every job declared in an INI config file instead of a \
+                  single source and destination. Each section is a job, \
+                  each key a long option name without the dashes, e.g. \
+                  ssh-port = 2222. Shared values go in a [DEFAULT] section'
+        )
+        scheduler.add_argument('--max-jobs',
+            action='store',
+            type=int,
+            default=4,
+            help='Maximum number of jobs running at once. Default is 4'
+        )
+        scheduler.add_argument('--max-jobs-per-host',
+            action='store',
+            type=int,
+            default=1,
+            help='Maximum number of jobs running at once against the same \
+                  destination host. Default is 1'
+        )
+        return parser
+
     def _process(self, parsed):
+        parsed = self._split_destinations(parsed)
+        parsed = self._verify_source_and_destination(parsed)
         parsed = self._convert_identity_file_to_absolute_path(parsed)
         parsed = self._flatten_excludes_list(parsed)
         return parsed
 
+    def _split_destinations(self, parsed):
+        'destination holds the first destination, destinations all of them'
+        parsed.destinations = parsed.destination
+        parsed.destination = parsed.destinations[0] if parsed.destinations \
+                             else None
+        return parsed
+
+    def _verify_source_and_destination(self, parsed):
+        if parsed.config:
+            return parsed
+        if not parsed.source or not parsed.destination:
+            self.parser.error('the source and destination arguments are '
+                              'required unless --config is given')
+        return parsed
+
     def _convert_identity_file_to_absolute_path(self, parsed):
         if parsed.ssh_identity_file:
             absolute_file = os.path.abspath(parsed.ssh_identity_file)
@@ -0,0 +1,177 @@
+import os
+import re
+from utilities.atomicfile import AtomicFile
+
+
+class PrometheusExporter:
+
+    '''
+    Renders a run record, see lib.runrecord, in the Prometheus text format
+    for node_exporter's textfile collector. Every job writes its own
+    roundrobinbackup_<job>.prom file into the textfile directory, and all
+    samples are labelled by job, source and destination.
+
+    A failed run keeps the last success timestamp of the previous file, so
+    alerts on the age of the last successful backup keep working.
+    '''
+
+    prefix = 'roundrobinbackup'
+
+    metrics = [
+        ('last_run_timestamp_seconds', 'gauge',
+         'Unix time the last run finished.'),
+        ('last_run_success', 'gauge',
+         'Whether the last run succeeded, 1 or 0.'),
+        ('last_success_timestamp_seconds', 'gauge',
+         'Unix time the last successful run finished.'),
+        ('phase_duration_seconds', 'gauge',
+         'Wall time of each phase in the last run.'),
+        ('phase_success', 'gauge',
+         'Whether each phase in the last run succeeded, 1 or 0.'),
+        ('rsync_sent_bytes', 'gauge',
+         'Bytes sent by rsync in the last run.'),
+        ('rsync_received_bytes', 'gauge',
+         'Bytes received by rsync in the last run.'),
+        ('rsync_speedup', 'gauge',
+         'Rsync speedup, total size divided by bytes transferred.'),
+        ('rsync_workers', 'gauge',
+         'Concurrent rsync workers chosen by the adaptive controller at the '
+         'end of the last run.'),
+        ('archive_size_bytes', 'gauge',
+         'Size of the archive created by the last run.'),
+        ('retained_archives', 'gauge',
+         'Number of archives kept by the last cleanup.'),
+        ('retained_bytes', 'gauge',
+         'Total size of the archives kept by the last cleanup.'),
+        ('pruned_archives', 'gauge',
+         'Number of archives removed by the last cleanup.'),
+        ('pruned_bytes', 'gauge',
+         'Total size of the archives removed by the last cleanup.'),
+        ('prune_failed_archives', 'gauge',
+         'Number of stale archives the last cleanup failed to remove.'),
+        ('reaped_archives', 'gauge',
+         'Number of trashed archives deleted by the last trash reaping.'),
+        ('reaped_bytes', 'gauge',
+         'Total size of the trashed archives deleted by the last trash '
+         'reaping.')
+    ]
+
+    phase_metrics = {
+        'bytes_sent': 'rsync_sent_bytes',
+        'bytes_received': 'rsync_received_bytes',
+        'speedup': 'rsync_speedup',
+        'rsync_workers': 'rsync_workers',
+        'archive_bytes': 'archive_size_bytes',
+        'retained_count': 'retained_archives',
+        'retained_bytes': 'retained_bytes',
+        'pruned_count': 'pruned_archives',
+        'pruned_bytes': 'pruned_bytes',
+        'prune_failed_count': 'prune_failed_archives',
+        'reaped_count': 'reaped_archives',
+        'reaped_bytes': 'reaped_bytes'
+    }
+
+    def write(self, textfile_dir, record):
+        'Atomically write the record to its job file, returning the path'
+        path = self.get_path(textfile_dir, record)
+        previous_content = ''
+        if os.path.exists(path):
+            with open(path) as previous_file:
+                previous_content = previous_file.read()
+        content = self.create(record, previous_content)
+        AtomicFile().write(path, content)
+        return path
+
+    def get_path(self, textfile_dir, record):
+        job = self._get_job_label(record)
+        safe_job = re.sub(r'[^A-Za-z0-9_-]+', '_', job).strip('_')
+        filename = '{0}_{1}.prom'.format(self.prefix, safe_job or 'backup')
+        return os.path.join(textfile_dir, filename)
+
+    def create(self, record, previous_content=''):
+        samples = dict((name, []) for name, _, _ in self.metrics)
+        for destination in record['destinations']:
+            labels = self._get_labels(record, destination)
+            self._add_run_samples(samples, record, labels, previous_content)
+        for phase in record['phases']:
+            labels = self._get_labels(record, phase['destination'])
+            self._add_phase_samples(samples, phase, labels)
+        lines = []
+        for name, metric_type, description in self.metrics:
+            if not samples[name]:
+                continue
+            metric_name = '{0}_{1}'.format(self.prefix, name)
+            lines.append('# HELP {0} {1}'.format(metric_name, description))
+            lines.append('# TYPE {0} {1}'.format(metric_name, metric_type))
+            for labels, value in samples[name]:
+                lines.append('{0}{{{1}}} {2}'.format(
+                    metric_name, self._format_labels(labels),
+                    self._format_value(value)
+                ))
+        return '\n'.join(lines) + '\n'
+
+    def _add_run_samples(self, samples, record, labels, previous_content):
+        samples['last_run_timestamp_seconds'].append(
+            (labels, record['finished'])
+        )
+        samples['last_run_success'].append((labels, int(bool(
+            record['success']
+        ))))
+        if record['success']:
+            last_success = record['finished']
+        else:
+            last_success = self._get_previous_value(
+                previous_content, 'last_success_timestamp_seconds', labels
+            )
+        if last_success is not None:
+            samples['last_success_timestamp_seconds'].append(
+                (labels, last_success)
+            )
+
+    def _add_phase_samples(self, samples, phase, labels):
+        phase_labels = labels + [('phase', phase['phase'])]
+        samples['phase_duration_seconds'].append(
+            (phase_labels, phase['duration'])
+        )
+        samples['phase_success'].append(
+            (phase_labels, int(bool(phase['success'])))
+        )
+        metrics = phase.get('metrics') or {}
+        for key, name in sorted(self.phase_metrics.items()):
+            if key in metrics:
+                samples[name].append((labels, metrics[key]))
+
+    def _get_labels(self, record, destination):
+        labels = [
+            ('job', self._get_job_label(record)),
+            ('source', record['source'] or ''),
+            ('destination', destination or '')
+        ]
+        return labels
+
+    def _get_job_label(self, record):
+        return record.get('job_name') or record['source'] or ''
+
+    def _get_previous_value(self, previous_content, name, labels):
+        sample = '{0}_{1}{{{2}}} '.format(self.prefix, name,
+                                          self._format_labels(labels))
+        for line in previous_content.splitlines():
+            if line.startswith(sample):
+                try:
+                    return float(line[len(sample):])
+                except ValueError:
+                    return None
+        return None
+
+    def _format_labels(self, labels):
+        return ','.join('{0}="{1}"'.format(key, self._escape(value))
+                        for key, value in labels)
+
+    def _escape(self, value):
+        value = str(value).replace('\\', '\\\\')
+        return value.replace('"', '\\"').replace('\n', '\\n')
+
+    def _format_value(self, value):
+        if isinstance(value, float):
+            return repr(value)
+        return str(value)
@@ -0,0 +1,191 @@
+from datetime import date, timedelta
+from utilities.roundrobindate import RoundRobinDate
+
+
+class RetentionSimulator:
+
+    '''
+    Replays years of daily backup runs for many jobs to estimate how many
+    archives, and how many bytes, each job keeps under its retention
+    options.
+
+    Which archives survive depends only on the retention options, so the
+    day each archive is pruned is worked out once per distinct set of
+    options, by replaying the pruner's rules with RoundRobinDate. Archive
+    sizes and footprints are then computed for all jobs at once with NumPy
+    over the date axis: every archive adds its size on the day it is
+    created and subtracts it on the day it is pruned, and a cumulative sum
+    of these differences gives each job's footprint on every day.
+
+    Each archive is modelled as an independent file, as in tar and stream
+    mode. Hardlinked snapshots share unchanged files and incremental
+    archives keep their full archives alive, so both use less or more
+    space than estimated here.
+
+    Options:
+
+        start_date: first simulated day, a date or YYYY-MM-DD string
+        days: number of simulated days
+        steady_state_days: trailing days averaged for the steady state
+
+    Each job is a dictionary with:
+
+        name: job name
+        days, weeks, months, years: retention options, as for
+                                    roundrobinbackup.py
+        archive_size: bytes of the first day's archive
+        growth: yearly growth of the archive size, e.g. 0.2 for 20%
+        churn: relative standard deviation of the daily archive size
+        seed: random seed for the churn
+    '''
+
+    default_options = {
+        'start_date': '2000-01-01',
+        'days': 20 * 365,
+        'steady_state_days': 365
+    }
+
+    def __init__(self, options=None):
+        self.options = self.default_options.copy()
+        self.options.update(options or {})
+        self.start_date = self._parse_date(self.options['start_date'])
+        self.expiry_days = {}
+
+    def simulate(self, jobs):
+        '''
+        Returns one result dictionary per job, in order: name, peak_bytes,
+        steady_state_bytes, final_bytes, peak_archives and
+        steady_state_archives.
+        '''
+        numpy = self._import_numpy()
+        results = [None] * len(jobs)
+        for retention, indexes in self._group_by_retention(jobs).items():
+            group = [jobs[index] for index in indexes]
+            group_results = self._simulate_group(numpy, retention, group)
+            for index, result in zip(indexes, group_results):
+                results[index] = result
+        return results
+
+    def get_expiry_days(self, retention):
+        '''
+        For every simulated day, the day the archive created on it is
+        pruned, or the number of simulated days if it outlives the
+        simulation. Computed once per retention.
+        '''
+        if retention not in self.expiry_days:
+            self.expiry_days[retention] = self._replay_pruner(retention)
+        return self.expiry_days[retention]
+
+    def _replay_pruner(self, retention):
+        '''
+        Each day a new archive is created, then every existing archive that
+        is neither retained by the round-robin dates nor the oldest archive
+        is pruned, as BackupArchivePruner does. Only the few live archives
+        are checked each day.
+        '''
+        days = self.options['days']
+        days_to_retain, weeks_to_retain, months_to_retain, years_to_retain = \
+            retention
+        date_library = RoundRobinDate({
+            'days_to_retain': days_to_retain,
+            'weeks_to_retain': weeks_to_retain,
+            'months_to_retain': months_to_retain,
+            'years_to_retain': years_to_retain,
+            'anchor_date': self.start_date
+        })
+        expiry_days = [days] * days
+        alive = []
+        for day in range(days):
+            current_date = self.start_date + timedelta(days=day)
+            date_library.set_options({'current_date': current_date})
+            alive.append(day)
+            oldest = alive[0]
+            still_alive = []
+            for created in alive:
+                created_date = self.start_date + timedelta(days=created)
+                if created == oldest or \
+                        date_library.is_retained(created_date):
+                    still_alive.append(created)
+                else:
+                    expiry_days[created] = day
+            alive = still_alive
+        return expiry_days
+
+    def _simulate_group(self, numpy, retention, jobs):
+        days = self.options['days']
+        expiry_days = numpy.array(self.get_expiry_days(retention))
+        sizes = self._create_sizes(numpy, jobs)
+
+        # Day by job differences: + on creation, - on pruning. Pruning on
+        # the day after the simulation ends lands in the extra last row.
+        differences = numpy.zeros((days + 1, len(jobs)))
+        differences[:days] += sizes.T
+        numpy.add.at(differences, expiry_days, -sizes.T)
+        footprints = numpy.cumsum(differences, axis=0)[:days]
+
+        archive_differences = numpy.zeros(days + 1)
+        archive_differences[:days] += 1
+        numpy.add.at(archive_differences, expiry_days, -1)
+        archives = numpy.cumsum(archive_differences)[:days]
+
+        steady_state_days = min(self.options['steady_state_days'], days)
+        steady_state_bytes = footprints[-steady_state_days:].mean(axis=0)
+        steady_state_archives = archives[-steady_state_days:].mean()
+        results = []
+        for index, job in enumerate(jobs):
+            results.append({
+                'name': job['name'],
+                'peak_bytes': float(footprints[:, index].max()),
+                'steady_state_bytes': float(steady_state_bytes[index]),
+                'final_bytes': float(footprints[-1, index]),
+                'peak_archives': int(archives.max()),
+                'steady_state_archives': float(steady_state_archives)
+            })
+        return results
+
+    def _create_sizes(self, numpy, jobs):
+        'Job by day archive sizes with compound growth and random churn'
+        days = self.options['days']
+        years = numpy.arange(days) / 365.0
+        archive_size = numpy.array([float(job['archive_size'])
+                                    for job in jobs])[:, None]
+        growth = numpy.array([float(job.get('growth', 0))
+                              for job in jobs])[:, None]
+        churn = numpy.array([float(job.get('churn', 0))
+                             for job in jobs])[:, None]
+        sizes = archive_size * (1 + growth) ** years
+        noise = numpy.vstack([
+            numpy.random.RandomState(job.get('seed', index)).standard_normal(
+                days
+            )
+            for index, job in enumerate(jobs)
+        ])
+        # An archive never shrinks below a tenth of its expected size
+        factor = numpy.maximum(1 + churn * noise, 0.1)
+        return sizes * factor
+
+    def _group_by_retention(self, jobs):
+        groups = {}
+        for index, job in enumerate(jobs):
+            retention = self._get_retention(job)
+            groups.setdefault(retention, []).append(index)
+        return groups
+
+    def _get_retention(self, job):
+        return (int(job['days']), int(job['weeks']), int(job['months']),
+                int(job['years']))
+
+    def _parse_date(self, input_date):
+        if isinstance(input_date, date):
+            return input_date
+        year, month, day = [int(part) for part in input_date.split('-')]
+        return date(year, month, day)
+
+    def _import_numpy(self):
+        'NumPy is only needed for simulations, not for running backups'
+        try:
+            import numpy
+        except ImportError:
+            raise Exception('The retention simulator requires NumPy, '
+                            'e.g. pip install numpy')
+        return numpy
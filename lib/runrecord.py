@@ -0,0 +1,57 @@
+import json
+import threading
+import time
+from utilities.atomicfile import AtomicFile
+
+
+class RunRecord:
+
+    '''
+    Machine readable record of one backup run: when it started and
+    finished, whether it succeeded, and for every phase on every
+    destination its duration, metrics and the commands it executed.
+    Phases may be added from several threads at once.
+    '''
+
+    def __init__(self, options):
+        self.lock = threading.Lock()
+        self.record = {
+            'job_name': options.get('job_name'),
+            'source': options.get('source'),
+            'destinations': options.get('destinations') or
+                            [options.get('destination')],
+            'archive_mode': options.get('archive_mode'),
+            'started': time.time(),
+            'finished': None,
+            'duration': None,
+            'success': None,
+            'error': None,
+            'phases': []
+        }
+
+    def add_phase(self, phase):
+        with self.lock:
+            self.record['phases'].append(phase)
+
+    def finish(self, error=None):
+        finished = time.time()
+        with self.lock:
+            self.record['finished'] = finished
+            self.record['duration'] = finished - self.record['started']
+            self.record['success'] = error is None
+            if error is not None:
+                self.record['error'] = str(error)
+
+    def get_record(self):
+        with self.lock:
+            record = self.record.copy()
+            record['phases'] = list(record['phases'])
+        return record
+
+    def write(self, path):
+        '''
+        Written to a temporary file in the same directory and renamed into
+        place, so readers never see a partially written record.
+        '''
+        content = json.dumps(self.get_record(), indent=2, sort_keys=True)
+        AtomicFile().write(path, content + '\n')
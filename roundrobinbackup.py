@@ -1,21 +1,36 @@
 #!/usr/bin/env python
 
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from lib.jobconfigparser import JobConfigParser
 from lib.optionsparser import OptionsParser
 from lib.backupcreator import BackupCreator
 from lib.backuparchiver import BackupArchiver
 from lib.backuparchivepruner import BackupArchivePruner
-from utilities.commandline import CommandLine
+from lib.backuptrashreaper import BackupTrashReaper
+from lib.prometheusexporter import PrometheusExporter
+from lib.runrecord import RunRecord
+from utilities.asynccommandline import AsyncCommandLine
+from utilities.sshutilities import SSHControlMaster
+from utilities.timedcommandline import TimedCommandLine
 
 
 class RoundRobinBackup:
 
-    def __init__(self):
-        self._set_options()
+    def __init__(self, options=None):
+        self._set_options(options)
         self._set_default_command_line_library()
+        self.run_record = RunRecord(self.options)
 
-    def _set_options(self):
-        parser = OptionsParser()
-        options = parser.get_options()
+    def _set_options(self, options=None):
+        'Options default to those parsed from the command line arguments'
+        if options is None:
+            parser = OptionsParser()
+            options = parser.get_options()
         self.options = options
 
     def get_options(self):
@@ -26,22 +41,241 @@ class RoundRobinBackup:
             from tests.mocksandstubs import CommandLineStubPrinter
             command_line_library = CommandLineStubPrinter()
         else:
-            command_line_library = CommandLine()
+            command_line_library = AsyncCommandLine()
         self.set_command_line_library(command_line_library)
 
     def set_command_line_library(self, command_line_library):
         self.command_line_library = command_line_library
 
     def backup(self):
-        self._execute('backup')
-        self._execute('archive')
-        self._execute('cleanup')
+        destinations = self._get_destination_options()
+        self.ssh_control_masters = []
+        self.run_record = RunRecord(self.options)
+        run_error = None
+        try:
+            for options in destinations:
+                self._open_ssh_connection(options)
+            if len(destinations) == 1:
+                for phase in self._get_phases():
+                    self._execute(phase)
+            else:
+                self._backup_multiple_destinations(destinations)
+        except Exception as error:
+            run_error = error
+            raise
+        finally:
+            self._close_ssh_connections()
+            self.run_record.finish(run_error)
+            self._write_run_record()
 
-    def _execute(self, type):
+    def get_run_record(self):
+        return self.run_record.get_record()
+
+    def _write_run_record(self):
+        '''
+        Called while the outcome of the run is being returned or raised, so
+        a metrics file or Prometheus export that can not be written is only
+        reported on stderr and never replaces that outcome.
+        '''
+        if self.options['debug']:
+            return
+        metrics_file = self.options.get('metrics_file')
+        if metrics_file:
+            self._export_run_record('metrics file', self.run_record.write,
+                                    metrics_file)
+        prometheus_dir = self.options.get('prometheus_dir')
+        if prometheus_dir:
+            record = self.run_record.get_record()
+            self._export_run_record('Prometheus metrics',
+                                    PrometheusExporter().write,
+                                    prometheus_dir, record)
+
+    def _export_run_record(self, description, write, *args):
+        try:
+            write(*args)
+        except Exception as error:
+            sys.stderr.write('Could not write {0}: {1}\n'.format(
+                description, error
+            ))
+
+    def _get_phases(self):
+        '''
+        Snapshot directories are archives themselves and skip tar archiving.
+        Streamed archives are created straight from the source and skip the
+        rsync copy. --reap-trash only deletes trashed archives.
+        '''
+        if self.options.get('reap_trash'):
+            return ['reap']
+        if self.options['archive_mode'] == 'snapshot':
+            return ['backup', 'cleanup']
+        if self.options['archive_mode'] == 'stream':
+            return ['archive', 'cleanup']
+        return ['backup', 'archive', 'cleanup']
+
+    def _get_destination_options(self):
+        '''
+        One options dictionary per destination. A single destination uses
+        the run's own options.
+        '''
+        destinations = self.options.get('destinations') or \
+                       [self.options['destination']]
+        if len(destinations) == 1:
+            return [self.options]
+        destination_options = []
+        for destination in destinations:
+            options = self.options.copy()
+            options['destination'] = destination
+            options.update(OptionsParser().get_destination_options(destination))
+            destination_options.append(options)
+        return destination_options
+
+    def _backup_multiple_destinations(self, destinations):
+        '''
+        The source is scanned once: the rsync to the first destination
+        records its changes with --write-batch, and the batch is replayed to
+        the other destinations in parallel. Snapshot mode syncs every
+        destination directly, since --link-dest targets differ per
+        destination. Archive and cleanup phases then run concurrently for
+        every destination whose sync succeeded. A failed destination does
+        not stop the others, its error is raised once all have finished.
+        '''
+        phases = self._get_phases()
+        batch_dir = tempfile.mkdtemp(prefix='rrbackup-batch-')
+        try:
+            errors = [None] * len(destinations)
+            if 'backup' in phases:
+                errors = self._sync_multiple_destinations(destinations,
+                                                          batch_dir)
+            remaining_phases = [phase for phase in phases if phase != 'backup']
+            synced = [index for index, error in enumerate(errors)
+                      if error is None]
+            phase_errors = self._run_concurrently([
+                self._create_phases_runner(remaining_phases,
+                                           destinations[index])
+                for index in synced
+            ])
+            for index, error in zip(synced, phase_errors):
+                errors[index] = error
+        finally:
+            shutil.rmtree(batch_dir, ignore_errors=True)
+        self._raise_destination_errors(destinations, errors)
+
+    def _sync_multiple_destinations(self, destinations, batch_dir):
+        '''
+        Returns the error of every destination's sync, None for those that
+        succeeded. The others only replay the first destination's batch if
+        it was written, otherwise they are synced directly.
+        '''
+        if self.options['archive_mode'] == 'snapshot':
+            return self._run_concurrently([
+                self._create_phases_runner(['backup'], options)
+                for options in destinations
+            ])
+        batch_file = os.path.join(batch_dir, 'rsync-batch')
+        first, others = destinations[0], destinations[1:]
+        first['rsync_write_batch'] = batch_file
+        first_errors = self._run_concurrently([
+            self._create_phases_runner(['backup'], first)
+        ])
+        if first_errors[0] is None:
+            for options in others:
+                options['rsync_read_batch'] = batch_file
+        return first_errors + self._run_concurrently([
+            self._create_phases_runner(['backup'], options)
+            for options in others
+        ])
+
+    def _create_phases_runner(self, phases, options):
+        def run_phases():
+            for phase in phases:
+                self._execute(phase, options)
+        return run_phases
+
+    def _run_concurrently(self, functions):
+        '''
+        Call every function on its own thread and wait for all of them.
+        Returns the exception each function raised, in order, None for
+        those that succeeded. The functions run a destination's phases,
+        one after the other; their commands all go through the shared
+        AsyncCommandLine.
+        '''
+        errors = [None] * len(functions)
+        def run(index):
+            try:
+                functions[index]()
+            except Exception as error:
+                errors[index] = error
+        threads = [threading.Thread(target=run, args=(index,))
+                   for index in range(len(functions))]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return errors
+
+    def _raise_destination_errors(self, destinations, errors):
+        failures = ['{0}: {1}'.format(options['destination'], error)
+                    for options, error in zip(destinations, errors)
+                    if error is not None]
+        if failures:
+            raise Exception(' | '.join(failures))
+
+    def _open_ssh_connection(self, options):
+        '''
+        With --ssh-multiplex, every agent shares a single SSH master
+        connection per destination instead of negotiating a new session per
+        remote command.
+        '''
+        options['ssh_control_path'] = None
+        if not options['ssh_multiplex']:
+            return
+        if not options['destination_host']:
+            return
+        ssh_options = {
+            'user': options['destination_user'],
+            'host': options['destination_host'],
+            'port': options['ssh_port'],
+            'identity_file': options['ssh_identity_file']
+        }
+        control_master = SSHControlMaster(ssh_options)
+        control_path = control_master.open(self.command_line_library)
+        self.ssh_control_masters.append((options, control_master))
+        options['ssh_control_path'] = control_path
+
+    def _close_ssh_connections(self):
+        for options, control_master in self.ssh_control_masters:
+            control_master.close(self.command_line_library)
+            options['ssh_control_path'] = None
+        self.ssh_control_masters = []
+
+    def _execute(self, type, options=None):
+        '''
+        Every phase runs against a TimedCommandLine, and its duration,
+        outcome, metrics and commands are added to the run record.
+        '''
+        options = options or self.options
         agent = self._backup_agent_simple_factory(type)
-        agent.set_options(self.options)
-        agent.set_command_line_library(self.command_line_library)
-        agent.execute()
+        agent.set_options(options)
+        timed_command_line = TimedCommandLine(self.command_line_library)
+        agent.set_command_line_library(timed_command_line)
+        phase = {
+            'phase': type,
+            'destination': options['destination'],
+            'started': time.time(),
+            'success': False,
+            'error': None
+        }
+        try:
+            agent.execute()
+            phase['success'] = True
+        except Exception as error:
+            phase['error'] = str(error)
+            raise
+        finally:
+            phase['duration'] = time.time() - phase['started']
+            phase['metrics'] = agent.get_metrics()
+            phase['commands'] = timed_command_line.get_commands()
+            self.run_record.add_phase(phase)
 
     def _backup_agent_simple_factory(self, type):
         if type == 'backup':
@@ -50,7 +284,168 @@ class RoundRobinBackup:
             agent = BackupArchiver()
         elif type == 'cleanup':
             agent = BackupArchivePruner()
+        elif type == 'reap':
+            agent = BackupTrashReaper()
         return agent
 
+class RoundRobinBackupScheduler:
+
+    '''
+    Runs every job declared in a --config file from one process with a pool
+    of --max-jobs workers, never running more than --max-jobs-per-host jobs
+    against the same destination host at once. All jobs share one
+    AsyncCommandLine, whose reactor thread multiplexes every child process.
+    '''
+
+    def __init__(self, options):
+        self.options = options
+        self.lock = threading.Condition()
+        self.queued_jobs = []
+        self.running_per_host = {}
+        self.results = []
+        self._set_default_command_line_library()
+
+    def _set_default_command_line_library(self):
+        if self.options['debug']:
+            from tests.mocksandstubs import CommandLineStubPrinter
+            command_line_library = CommandLineStubPrinter()
+        else:
+            command_line_library = AsyncCommandLine()
+        self.set_command_line_library(command_line_library)
+
+    def set_command_line_library(self, command_line_library):
+        self.command_line_library = command_line_library
+
+    def get_jobs(self):
+        jobs = JobConfigParser().get_jobs(self.options['config'])
+        return jobs
+
+    def run(self):
+        '''
+        Run every job and return one result dictionary per job, in config
+        file order: job_name, destination, success, duration and error.
+        '''
+        jobs = self.get_jobs()
+        self.queued_jobs = list(jobs)
+        workers = []
+        for i in range(min(self.options['max_jobs'], len(jobs))):
+            worker = threading.Thread(target=self._run_worker)
+            worker.daemon = True
+            worker.start()
+            workers.append(worker)
+        for worker in workers:
+            worker.join()
+        order = [job['job_name'] for job in jobs]
+        results = sorted(self.results,
+                         key=lambda result: order.index(result['job_name']))
+        return results
+
+    def _run_worker(self):
+        while True:
+            job = self._acquire_next_job()
+            if job is None:
+                return
+            try:
+                result = self._run_job(job)
+            finally:
+                self._release_job(job)
+            with self.lock:
+                self.results.append(result)
+
+    def _acquire_next_job(self):
+        '''
+        Take the first queued job whose destination hosts are all below
+        their concurrency limit, waiting for a running job to finish if
+        every queued job has a busy host. A job takes a slot on each of its
+        hosts at once or on none, so jobs never hold slots while waiting
+        for others. Returns None once the queue is empty.
+        '''
+        with self.lock:
+            while self.queued_jobs:
+                for job in self.queued_jobs:
+                    hosts = self._get_destination_hosts(job)
+                    if not all(self._is_host_available(host)
+                               for host in hosts):
+                        continue
+                    self.queued_jobs.remove(job)
+                    for host in hosts:
+                        self.running_per_host[host] = \
+                            self.running_per_host.get(host, 0) + 1
+                    return job
+                self.lock.wait()
+            return None
+
+    def _is_host_available(self, host):
+        running = self.running_per_host.get(host, 0)
+        return running < self.options['max_jobs_per_host']
+
+    def _get_destination_hosts(self, job):
+        'Every distinct host the job backs up to, counted once per job'
+        destinations = job.get('destinations') or [job['destination']]
+        hosts = set()
+        for destination in destinations:
+            options = OptionsParser().get_destination_options(destination)
+            hosts.add(options['destination_host'])
+        return sorted(hosts)
+
+    def _release_job(self, job):
+        with self.lock:
+            for host in self._get_destination_hosts(job):
+                self.running_per_host[host] -= 1
+            self.lock.notify_all()
+
+    def _run_job(self, job):
+        result = {
+            'job_name': job['job_name'],
+            'destination': job['destination'],
+            'success': False,
+            'duration': 0,
+            'error': None
+        }
+        started = time.time()
+        try:
+            if self.options['debug']:
+                job['debug'] = True
+            rrbackup = RoundRobinBackup(job)
+            if not job['debug']:
+                rrbackup.set_command_line_library(self.command_line_library)
+            rrbackup.backup()
+            result['success'] = True
+        except Exception as error:
+            result['error'] = str(error)
+        result['duration'] = time.time() - started
+        return result
+
+    def get_summary(self, results):
+        succeeded = len([result for result in results if result['success']])
+        failed = len(results) - succeeded
+        lines = ['Backup job summary: {0} succeeded, {1} failed'.format(
+            succeeded, failed
+        )]
+        for result in results:
+            status = 'ok' if result['success'] else 'FAILED'
+            line = '  [{0}] {1} -> {2} ({3:.1f}s)'.format(
+                status, result['job_name'], result['destination'],
+                result['duration']
+            )
+            if result['error']:
+                line = '{0}: {1}'.format(line, result['error'])
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def main():
+    options = OptionsParser().get_options()
+    if not options['config']:
+        RoundRobinBackup(options).backup()
+        return 0
+    scheduler = RoundRobinBackupScheduler(options)
+    results = scheduler.run()
+    print(scheduler.get_summary(results))
+    if all(result['success'] for result in results):
+        return 0
+    return 1
+
+
 if __name__ == "__main__":
-    RoundRobinBackup().backup()
+    sys.exit(main())
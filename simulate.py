@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+
+'''
+Estimates the steady-state archive count and storage footprint of backup
+jobs under their retention options, before changing them across a fleet.
+
+    ./simulate.py --jobs 500 --simulate-years 20 --archive-size 2G \
+        --growth 0.15 --churn 0.1 --weeks 8
+    ./simulate.py --config jobs.ini --archive-size 500M
+
+Requires NumPy.
+'''
+
+import argparse
+import json
+import sys
+from lib.jobconfigparser import JobConfigParser
+from lib.retentionsimulator import RetentionSimulator
+
+SIZE_SUFFIXES = {'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+
+def parse_size(value):
+    'Bytes, optionally with a K, M, G or T suffix'
+    suffix = value[-1:].upper()
+    if suffix in SIZE_SUFFIXES:
+        return int(float(value[:-1]) * SIZE_SUFFIXES[suffix])
+    return int(value)
+
+
+def format_size(value):
+    for suffix in ['T', 'G', 'M', 'K']:
+        if value >= SIZE_SUFFIXES[suffix]:
+            return '{0:.1f}{1}'.format(value / SIZE_SUFFIXES[suffix], suffix)
+    return '{0:.0f}'.format(value)
+
+
+def get_parser():
+    parser = argparse.ArgumentParser(
+        description='Simulate years of daily backups to estimate the '
+                    'archives and bytes each job retains'
+    )
+    simulation = parser.add_argument_group('Simulation options')
+    simulation.add_argument('--simulate-years', type=int, default=20,
+                            help='Years of daily runs to replay. Default '
+                                 'is 20')
+    simulation.add_argument('--start-date', default='2000-01-01',
+                            help='First simulated day, YYYY-MM-DD')
+    simulation.add_argument('--archive-size', type=parse_size, default='1G',
+                            help='Size of the first archive, e.g. 750M. '
+                                 'Default is 1G')
+    simulation.add_argument('--growth', type=float, default=0.0,
+                            help='Yearly archive size growth, e.g. 0.2 for '
+                                 '20%%. Default is 0')
+    simulation.add_argument('--churn', type=float, default=0.0,
+                            help='Relative standard deviation of daily '
+                                 'archive sizes. Default is 0')
+    simulation.add_argument('--output',
+                            help='Write the results to this JSON file')
+    jobs = parser.add_argument_group('Jobs')
+    jobs.add_argument('--config',
+                      help='Simulate the jobs of this job config file, with '
+                           'their own retention options')
+    jobs.add_argument('--jobs', type=int, default=1,
+                      help='Without --config, number of jobs sharing the '
+                           'retention options below. Default is 1')
+    jobs.add_argument('--days', default='6',
+                      help='Days to retain. Default is 6')
+    jobs.add_argument('--weeks', default='5',
+                      help='Weeks to retain. Default is 5')
+    jobs.add_argument('--months', default='6',
+                      help='Months to retain. Default is 6')
+    jobs.add_argument('--years', default='10',
+                      help='Years to retain. Default is 10')
+    return parser
+
+
+def create_jobs(args):
+    if args.config:
+        retentions = [(job['job_name'], job)
+                      for job in JobConfigParser().get_jobs(args.config)]
+    else:
+        retention = dict((key, getattr(args, key))
+                         for key in ['days', 'weeks', 'months', 'years'])
+        retentions = [('job{0}'.format(index + 1), retention)
+                      for index in range(args.jobs)]
+    jobs = []
+    for index, (name, retention) in enumerate(retentions):
+        jobs.append({
+            'name': name,
+            'days': retention['days'],
+            'weeks': retention['weeks'],
+            'months': retention['months'],
+            'years': retention['years'],
+            'archive_size': args.archive_size,
+            'growth': args.growth,
+            'churn': args.churn,
+            'seed': index
+        })
+    return jobs
+
+
+def format_results(results):
+    lines = ['{0:<24} {1:>10} {2:>10} {3:>8} {4:>8}'.format(
+        'job', 'peak', 'steady', 'archives', 'peak')]
+    for result in results:
+        lines.append('{0:<24} {1:>10} {2:>10} {3:>8.1f} {4:>8}'.format(
+            result['name'], format_size(result['peak_bytes']),
+            format_size(result['steady_state_bytes']),
+            result['steady_state_archives'], result['peak_archives']
+        ))
+    total_peak = sum(result['peak_bytes'] for result in results)
+    total_steady = sum(result['steady_state_bytes'] for result in results)
+    lines.append('{0:<24} {1:>10} {2:>10}'.format(
+        'total', format_size(total_peak), format_size(total_steady)))
+    return '\n'.join(lines)
+
+
+def main(arguments=None):
+    args = get_parser().parse_args(arguments)
+    simulator = RetentionSimulator({
+        'start_date': args.start_date,
+        'days': args.simulate_years * 365
+    })
+    results = simulator.simulate(create_jobs(args))
+    print(format_results(results))
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2, sort_keys=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -13,17 +13,66 @@ class CommandLineStubPrinter:
         print(command_as_string)
         print(command)
 
+    def execute_lines(self, command, **extra_params_not_used_in_testing):
+        self.execute(command)
+        return iter([])
+
+    def execute_queue(self, commands, **extra_params_not_used_in_testing):
+        commands_as_string = ' | '.join(' '.join(item) for item in commands)
+        print('\n# Debug flag set, in noop mode. Would have executed commands:')
+        print(commands_as_string)
+        print(commands)
+
+
+class CommandLineRecorder:
+    ' Records every command and returns empty output '
+    def __init__(self):
+        self.commands = []
+
+    def execute(self, command, return_boolean=False,
+                **extra_params_not_used_in_testing):
+        self.commands.append(command)
+        if return_boolean:
+            return True
+        return ''
+
+    def execute_lines(self, command, **extra_params_not_used_in_testing):
+        self.commands.append(command)
+        return iter([])
+
+    def execute_queue(self, commands, **extra_params_not_used_in_testing):
+        self.commands.extend(commands)
+        return ''
+
 
 class CommandLineMock:
 
     def __init__(self, list_of_tuples_of_command_and_return_value):
         self.expected_commands = list_of_tuples_of_command_and_return_value
+        self.stdin = []
 
-    def execute(self, command, *extra_params_not_used_in_testing):
+    def execute(self, command, *extra_params_not_used_in_testing,
+                **extra_named_params_not_used_in_testing):
+        ' Records what a command reads from stdin, when given '
+        stdin = extra_named_params_not_used_in_testing.get('stdin')
+        if stdin:
+            self.stdin.append(stdin.read())
         command_as_string = ' '.join(command)
         output = self._get_output(command_as_string)
         return output
 
+    def execute_lines(self, command, delimiter='\n',
+                      *extra_params_not_used_in_testing,
+                      **extra_named_params_not_used_in_testing):
+        output = self.execute(command)
+        return iter(output.split(delimiter))
+
+    def execute_queue(self, commands, *extra_params_not_used_in_testing,
+                      **extra_named_params_not_used_in_testing):
+        commands_as_string = ' | '.join(' '.join(item) for item in commands)
+        output = self._get_output(commands_as_string)
+        return output
+
     def _get_output(self, given_command):
         expected_command, expected_result = self.expected_commands.pop(0)
         if given_command != expected_command:
@@ -31,3 +80,13 @@ class CommandLineMock:
                             'mock "{0}". Expected: "{1}"'
                             .format(given_command, expected_command))
         return expected_result
+
+
+def create_remote_listing(names, sizes=None):
+    '''
+    The output of BackupAgent's remote find listing for regular files named
+    names, with the given sizes in bytes or 0.
+    '''
+    sizes = sizes or [0] * len(names)
+    return '\0'.join('f/{0}/1500000000.0/{1}'.format(size, name)
+                     for name, size in zip(names, sizes))
@@ -0,0 +1,135 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=benchmarks \
+# --nocapture ./tests
+
+import os
+import shutil
+import subprocess
+import tempfile
+from nose.tools import *
+from datetime import date
+from benchmarks import pruner
+from benchmarks.benchmark import BenchmarkComparer, get_median
+from benchmarks.sourcetree import SyntheticSourceTree
+
+
+class TestSyntheticSourceTree:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        "Tear down test fixtures"
+        shutil.rmtree(self.path)
+
+    def list_files(self):
+        found = []
+        for directory, _, filenames in os.walk(self.path):
+            found.extend(os.path.join(directory, name) for name in filenames)
+        return sorted(found)
+
+    def test_create_writes_files_across_directories(self):
+        options = {'files': 25, 'files_per_dir': 10,
+                   'size_distribution': 'fixed', 'mean_size': 100}
+        tree = SyntheticSourceTree(self.path, options)
+        assert_equal(tree.create(), 2500)
+        assert_equal(len(self.list_files()), 25)
+        assert_equal(len(os.listdir(self.path)), 3)
+
+    def test_advance_day_applies_daily_rates(self):
+        options = {'files': 100, 'change_rate': 0.1, 'add_rate': 0.05,
+                   'delete_rate': 0.02}
+        tree = SyntheticSourceTree(self.path, options)
+        tree.create()
+        changes = tree.advance_day()
+        assert_equal(changes['changed'], 10)
+        assert_equal(changes['added'], 5)
+        assert_equal(changes['deleted'], 2)
+        assert_equal(len(self.list_files()), 103)
+
+    def test_lognormal_sizes_have_requested_mean(self):
+        tree = SyntheticSourceTree(self.path, {'mean_size': 1000})
+        sizes = [tree._get_file_size() for i in range(20000)]
+        mean = sum(sizes) / float(len(sizes))
+        assert_true(800 < mean < 1200)
+
+
+class TestSSHShim:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.shim = os.path.join(os.path.dirname(__file__), '..',
+                                 'benchmarks', 'bin', 'ssh')
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_runs_remote_command_locally(self):
+        output = subprocess.check_output([
+            self.shim, '-p', '22', '-o', 'ControlPath=/tmp/x', 'user@host',
+            '/bin/echo', 'a', '&&', '/bin/echo', 'b'
+        ])
+        assert_equal(output, b'a\nb\n')
+
+    def test_control_commands_succeed(self):
+        returncode = subprocess.call([self.shim, '-O', 'exit', 'user@host'])
+        assert_equal(returncode, 0)
+
+
+class TestBenchmarkComparer:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.comparer = BenchmarkComparer(threshold=0.1, min_duration=0.05)
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def create_results(self, medians):
+        summary = dict((name, {'median': median})
+                       for name, median in medians.items())
+        return {'commit': 'abc', 'options': {}, 'days': [],
+                'summary': summary}
+
+    def test_slower_phases_are_flagged(self):
+        baseline = self.create_results({'archive': 2.0, 'backup': 1.0})
+        candidate = self.create_results({'archive': 2.5, 'backup': 1.05})
+        rows = self.comparer.compare(baseline, candidate)
+        flagged = dict((row['name'], row['regression']) for row in rows)
+        assert_equal(flagged, {'archive': True, 'backup': False})
+
+    def test_small_absolute_changes_are_not_flagged(self):
+        baseline = self.create_results({'cleanup': 0.01})
+        candidate = self.create_results({'cleanup': 0.03})
+        rows = self.comparer.compare(baseline, candidate)
+        assert_false(rows[0]['regression'])
+
+    def test_median(self):
+        assert_equal(get_median([3, 1, 2]), 2)
+        assert_equal(get_median([4, 1, 2, 3]), 2.5)
+
+
+class TestPrunerBenchmark:
+
+    def setup(self):
+        "Set up test fixtures"
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_listing_mixes_archives_and_other_files(self):
+        listing = pruner.generate_listing(16, date(2020, 1, 6))
+        assert_equal(len(listing), 16)
+        assert_equal(listing[0], 'automated-backup-2020-01-06.tar.zst')
+        assert_true('automated-backup-2020-01-05.incremental.tar.gz'
+                    in listing)
+        assert_equal(len([name for name in listing
+                          if name.endswith('.partial')]), 2)
+
+    def test_run_classifies_listing(self):
+        results = pruner.run(800, date(2020, 1, 6))
+        assert_equal(results['backups'], 500)
+        # Every partial upload is older than the end date, so all 100 go
+        assert_true(100 < results['to_remove'] < 600)
@@ -58,6 +58,7 @@ class TestArgParser:
         assert_equal(returned['source'], '/local/files')
         assert_equal(returned['destination'], 'user@target.com:/path')
         assert_equal(returned['debug'], False)
+        assert_equal(returned['ssh_multiplex'], False)
         assert_equal(returned['exclude'], [])
         assert_equal(returned['ssh_identity_file'], None)
         assert_equal(returned['ssh_port'], '22')
@@ -67,6 +68,22 @@ class TestArgParser:
         assert_equal(returned['years'], '10')
         assert_equal(returned['rsync_dir'], 'latest')
         assert_equal(returned['backup_prefix'], 'automated-backup-')
+        assert_equal(returned['archive_mode'], 'tar')
+        assert_equal(returned['compression'], 'bzip2')
+        assert_equal(returned['compression_level'], None)
+        assert_equal(returned['metrics_file'], None)
+        assert_equal(returned['prometheus_dir'], None)
+
+    @no_stdout_or_stderr
+    def test_unknown_compression_codec_raises_error(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/path',
+            '--compression',
+            'rar'
+        ]
+        self.set_command_line_arguments(arguments)
+        assert_raises(SystemExit, self.args_parser.get_args)
 
     @no_stdout_or_stderr
     def test_invalid_argument_raises_error(self):
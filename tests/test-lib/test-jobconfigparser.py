@@ -0,0 +1,88 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=lib.jobconfigparser \
+# --nocapture ./tests/lib
+
+import os
+import tempfile
+import textwrap
+from nose.tools import *
+from tests.utils import no_stdout_or_stderr
+from lib.jobconfigparser import JobConfigParser
+
+
+class TestJobConfigParser:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.parser = JobConfigParser()
+        handle, self.config_file = tempfile.mkstemp(suffix='.ini')
+        os.close(handle)
+
+    def teardown(self):
+        "Tear down test fixtures"
+        os.remove(self.config_file)
+
+    def write_config(self, content):
+        with open(self.config_file, 'w') as config:
+            config.write(textwrap.dedent(content))
+
+    def test_each_section_is_a_job_with_default_values(self):
+        self.write_config('''
+            [DEFAULT]
+            days = 7
+
+            [www-files]
+            source = /var/www
+            destination = user@backup1.com:/backups/www
+            ssh-port = 2222
+            ssh-multiplex = true
+            exclude = .git/*
+                      *.tmp
+
+            [db-dumps]
+            source = /var/dumps
+            destination = user@backup2.com:/backups/db
+            days = 3
+            debug = false
+            ''')
+        jobs = self.parser.get_jobs(self.config_file)
+        assert_equal([job['job_name'] for job in jobs],
+                     ['www-files', 'db-dumps'])
+
+        www = jobs[0]
+        assert_equal(www['source'], '/var/www')
+        assert_equal(www['destination_host'], 'backup1.com')
+        assert_equal(www['destination_path'], '/backups/www')
+        assert_equal(www['ssh_port'], '2222')
+        assert_equal(www['ssh_multiplex'], True)
+        assert_equal(www['exclude'], ['.git/*', '*.tmp'])
+        assert_equal(www['days'], '7')
+        assert_equal(www['weeks'], '5')
+
+        db = jobs[1]
+        assert_equal(db['destination_host'], 'backup2.com')
+        assert_equal(db['days'], '3')
+        assert_equal(db['debug'], False)
+        assert_equal(db['exclude'], [])
+
+    def test_missing_destination_raises_error(self):
+        self.write_config('''
+            [www-files]
+            source = /var/www
+            ''')
+        assert_raises(Exception, self.parser.get_jobs, self.config_file)
+
+    @no_stdout_or_stderr
+    def test_invalid_option_raises_error(self):
+        self.write_config('''
+            [www-files]
+            source = /var/www
+            destination = user@backup1.com:/backups/www
+            compression = rar
+            ''')
+        assert_raises(SystemExit, self.parser.get_jobs, self.config_file)
+
+    def test_unreadable_config_raises_error(self):
+        missing_file = '{0}.missing'.format(self.config_file)
+        assert_raises(Exception, self.parser.get_jobs, missing_file)
@@ -6,6 +6,7 @@
 import sys
 from nose.tools import *
 from lib.optionsparser import OptionsParser
+from tests.utils import no_stdout_or_stderr
 
 
 class TestOptionsParser:
@@ -85,3 +86,54 @@ class TestOptionsParser:
         assert_equal(returned['years'], '2')
         assert_equal(returned['rsync_dir'], 'live-files')
         assert_equal(returned['backup_prefix'], 'rrbackup')
+
+    def test_options_between_source_and_destinations(self):
+        arguments = [
+            '/local/files',
+            '--days',
+            '3',
+            'user@target.com:/some/path',
+            '--weeks',
+            '2',
+            'other@second.com:/other/path'
+        ]
+        self.set_command_line_arguments(arguments)
+        self.options_parser = OptionsParser()
+
+        returned = self.options_parser.get_options()
+        assert_equal(returned['source'], '/local/files')
+        assert_equal(returned['destinations'], [
+            'user@target.com:/some/path',
+            'other@second.com:/other/path'
+        ])
+        assert_equal(returned['destination_host'], 'target.com')
+        assert_equal(returned['days'], '3')
+        assert_equal(returned['weeks'], '2')
+
+    @no_stdout_or_stderr
+    def test_unrecognized_option_after_positionals_raises_error(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--unknown-option'
+        ]
+        self.set_command_line_arguments(arguments)
+        self.options_parser = OptionsParser()
+        assert_raises(SystemExit, self.options_parser.get_options)
+
+    def test_multiple_destinations(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            'other@second.com:/other/path'
+        ]
+        self.set_command_line_arguments(arguments)
+        self.options_parser = OptionsParser()
+
+        returned = self.options_parser.get_options()
+        assert_equal(returned['destination'], 'user@target.com:/some/path')
+        assert_equal(returned['destinations'], [
+            'user@target.com:/some/path',
+            'other@second.com:/other/path'
+        ])
+        assert_equal(returned['destination_host'], 'target.com')
@@ -0,0 +1,94 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=lib.prometheusexporter \
+# --nocapture ./tests/lib
+
+import os
+import shutil
+import tempfile
+from nose.tools import *
+from lib.prometheusexporter import PrometheusExporter
+
+
+class TestPrometheusExporter:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.exporter = PrometheusExporter()
+        self.textfile_dir = tempfile.mkdtemp()
+        self.labels = 'job="www",source="/var/www",destination="b@h:/backups"'
+
+    def teardown(self):
+        "Tear down test fixtures"
+        shutil.rmtree(self.textfile_dir)
+
+    def create_record(self, success=True, finished=1500000000.5):
+        record = {
+            'job_name': 'www',
+            'source': '/var/www',
+            'destinations': ['b@h:/backups'],
+            'finished': finished,
+            'success': success,
+            'phases': [
+                {
+                    'phase': 'backup',
+                    'destination': 'b@h:/backups',
+                    'duration': 12.5,
+                    'success': True,
+                    'metrics': {'bytes_sent': 2048, 'bytes_received': 64,
+                                'speedup': 40.5}
+                },
+                {
+                    'phase': 'cleanup',
+                    'destination': 'b@h:/backups',
+                    'duration': 0.25,
+                    'success': success,
+                    'metrics': {'retained_count': 7,
+                                'retained_bytes': 700000}
+                }
+            ]
+        }
+        return record
+
+    def test_samples_are_labelled_by_job_source_and_destination(self):
+        content = self.exporter.create(self.create_record())
+        lines = content.splitlines()
+        assert_true('# TYPE roundrobinbackup_last_success_timestamp_seconds '
+                    'gauge' in lines)
+        assert_true('roundrobinbackup_last_success_timestamp_seconds'
+                    '{{{0}}} 1500000000.5'.format(self.labels) in lines)
+        assert_true('roundrobinbackup_phase_duration_seconds'
+                    '{{{0},phase="backup"}} 12.5'.format(self.labels) in lines)
+        assert_true('roundrobinbackup_rsync_sent_bytes'
+                    '{{{0}}} 2048'.format(self.labels) in lines)
+        assert_true('roundrobinbackup_retained_archives'
+                    '{{{0}}} 7'.format(self.labels) in lines)
+        assert_true('roundrobinbackup_retained_bytes'
+                    '{{{0}}} 700000'.format(self.labels) in lines)
+        # Metrics without samples are left out entirely
+        assert_false('archive_size_bytes' in content)
+
+    def test_label_values_are_escaped(self):
+        record = self.create_record()
+        record['source'] = '/data/"quoted"\\dir'
+        content = self.exporter.create(record)
+        assert_true('source="/data/\\"quoted\\"\\\\dir"' in content)
+
+    def test_write_is_named_after_job(self):
+        path = self.exporter.write(self.textfile_dir, self.create_record())
+        assert_equal(os.path.basename(path), 'roundrobinbackup_www.prom')
+        assert_equal(os.listdir(self.textfile_dir),
+                     ['roundrobinbackup_www.prom'])
+
+    def test_failed_run_keeps_previous_success_timestamp(self):
+        self.exporter.write(self.textfile_dir, self.create_record())
+        failed_record = self.create_record(False, 1500086400.0)
+        path = self.exporter.write(self.textfile_dir, failed_record)
+        with open(path) as prom_file:
+            lines = prom_file.read().splitlines()
+        assert_true('roundrobinbackup_last_success_timestamp_seconds'
+                    '{{{0}}} 1500000000.5'.format(self.labels) in lines)
+        assert_true('roundrobinbackup_last_run_timestamp_seconds'
+                    '{{{0}}} 1500086400.0'.format(self.labels) in lines)
+        assert_true('roundrobinbackup_last_run_success'
+                    '{{{0}}} 0'.format(self.labels) in lines)
@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=lib.retentionsimulator \
+# --nocapture ./tests/lib
+
+from datetime import date, timedelta
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+from lib.retentionsimulator import RetentionSimulator
+from utilities.roundrobindate import RoundRobinDate
+
+
+class TestRetentionSimulator:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.simulator = RetentionSimulator({
+            'start_date': '2011-05-23',
+            'days': 400,
+            'steady_state_days': 30
+        })
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def require_numpy(self):
+        try:
+            import numpy
+        except ImportError:
+            raise SkipTest('NumPy is not installed')
+
+    def create_job(self, name='job', **extra_options):
+        job = {
+            'name': name,
+            'days': 6,
+            'weeks': 5,
+            'months': 6,
+            'years': 2,
+            'archive_size': 1000,
+            'growth': 0,
+            'churn': 0
+        }
+        job.update(extra_options)
+        return job
+
+    def test_surviving_archives_match_round_robin_dates(self):
+        expiry_days = self.simulator.get_expiry_days((6, 5, 6, 2))
+        start_date = date(2011, 5, 23)
+        survivors = set((start_date + timedelta(days=day)).isoformat()
+                        for day, expiry in enumerate(expiry_days)
+                        if expiry == 400)
+        last_date = start_date + timedelta(days=399)
+        date_library = RoundRobinDate({
+            'days_to_retain': 6,
+            'weeks_to_retain': 5,
+            'months_to_retain': 6,
+            'years_to_retain': 2,
+            'anchor_date': start_date,
+            'current_date': last_date
+        })
+        expected = set(date.isoformat() for date in
+                       date_library.iter_retained_dates()
+                       if date >= start_date)
+        assert_equal(survivors, expected)
+
+    def test_daily_archives_expire_after_days_to_retain(self):
+        expiry_days = self.simulator.get_expiry_days((6, 0, 0, 0))
+        assert_equal(expiry_days[0], 400)
+        assert_equal([expiry_days[day] - day for day in range(1, 10)],
+                     [7] * 9)
+
+    def test_footprint_matches_archives_alive_each_day(self):
+        self.require_numpy()
+        job = self.create_job(growth=0.5, churn=0.2, seed=3)
+        result = self.simulator.simulate([job])[0]
+        sizes = self.simulator._create_sizes(__import__('numpy'), [job])[0]
+        expiry_days = self.simulator.get_expiry_days((6, 5, 6, 2))
+        footprints = []
+        for day in range(400):
+            footprints.append(sum(sizes[created] for created in range(day + 1)
+                                  if expiry_days[created] > day))
+        assert_almost_equal(result['peak_bytes'], max(footprints), places=3)
+        assert_almost_equal(result['final_bytes'], footprints[-1], places=3)
+        assert_almost_equal(result['steady_state_bytes'],
+                            sum(footprints[-30:]) / 30.0, places=3)
+
+    def test_jobs_keep_their_order_across_retention_groups(self):
+        self.require_numpy()
+        jobs = [
+            self.create_job('short', days=2, weeks=0, months=0, years=0),
+            self.create_job('long'),
+            self.create_job('short-again', days=2, weeks=0, months=0,
+                            years=0)
+        ]
+        results = self.simulator.simulate(jobs)
+        assert_equal([result['name'] for result in results],
+                     ['short', 'long', 'short-again'])
+        # Today, two days and the first archive, which is always the oldest
+        assert_equal(results[0]['final_bytes'], 4000)
+        assert_equal(results[0]['peak_archives'], 4)
+        assert_true(results[1]['final_bytes'] > results[0]['final_bytes'])
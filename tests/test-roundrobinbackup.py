@@ -3,12 +3,78 @@
 # nosetests --with-coverage --cover-package=<package> \
 # --nocapture ./tests
 
+import io
+import json
+import os
+import shutil
+import subprocess
 import sys
+import tarfile
+import tempfile
+import textwrap
+import threading
+import time
+from datetime import date, timedelta
 from nose.tools import *
-from tests.mocksandstubs import CommandLineMock
+from tests.mocksandstubs import CommandLineMock, CommandLineRecorder, \
+    create_remote_listing
 from tests.utils import no_stdout_or_stderr
+from utilities import remotehelper
+from utilities.asynccommandline import AsyncCommand, AsyncCommandLine
 from utilities.roundrobindate import RoundRobinDate
-from roundrobinbackup import RoundRobinBackup
+from roundrobinbackup import RoundRobinBackup, RoundRobinBackupScheduler
+
+LIST_COMMAND = "/usr/bin/find {0} -mindepth 1 -maxdepth 1 -printf '%y/%s/%T@/%f\\0'"
+TAR_WARNING_SCRIPT = 'tar "$@"; status=$?; [ $status -eq 1 ] && exit 0; exit $status'
+REMOVE_COMMAND = "/usr/bin/xargs -0 -r -n 100 -P 4 /bin/sh -c 'for path; do /bin/rm -r -- \"$path\" || printf \"%s\\0\" \"$path\"; done' sh"
+
+
+class CommandLineConcurrencyRecorder:
+    ' Tracks how many commands run at once, overall and per host '
+    def __init__(self, failing_host=None):
+        self.lock = threading.Lock()
+        self.running = {}
+        self.max_running = {}
+        self.failing_host = failing_host
+
+    def execute(self, command, **extra_params_not_used_in_testing):
+        host = self._get_host(command)
+        with self.lock:
+            for key in [host, 'all']:
+                self.running[key] = self.running.get(key, 0) + 1
+                self.max_running[key] = max(self.max_running.get(key, 0),
+                                            self.running[key])
+        time.sleep(0.02)
+        with self.lock:
+            for key in [host, 'all']:
+                self.running[key] -= 1
+        if host == self.failing_host:
+            raise Exception('Connection refused')
+        return ''
+
+    def execute_lines(self, command, **extra_params_not_used_in_testing):
+        self.execute(command)
+        return iter([])
+
+    def submit(self, command, **extra_params_not_used_in_testing):
+        ' Runs execute on a thread, like a command on a reactor '
+        async_command = AsyncCommand(command, None)
+        def run():
+            try:
+                value = self.execute(command)
+            except Exception as error:
+                async_command.fail(error)
+                return
+            async_command.succeed(value)
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        return async_command
+
+    def _get_host(self, command):
+        for token in command:
+            if '@' in token:
+                return token.split('@')[1].split(':')[0]
 
 
 class TestRoundRobinBackup:
@@ -106,14 +172,42 @@ class TestRoundRobinBackup:
         cli_input_output = [
             ('ssh user@target.com /bin/mkdir -p /some/path/latest', ''),
             ('rsync -az --delete -e ssh /local/files user@target.com:/some/path/latest', ''),
-            ('ssh user@target.com /bin/tar -C /some/path -cjf /some/path/automated-backup-{0}.tar.bzip2 latest'.format(self.today), ''),
-            ('ssh user@target.com /bin/ls /some/path', '')
+            ('ssh user@target.com /bin/tar -C /some/path -cjf /some/path/automated-backup-{0}.tar.bzip2.partial latest && /bin/mv /some/path/automated-backup-{0}.tar.bzip2.partial /some/path/automated-backup-{0}.tar.bzip2 || {{ /bin/rm -f /some/path/automated-backup-{0}.tar.bzip2.partial; false; }}'.format(self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), '')
         ]
         cli_mock = CommandLineMock(cli_input_output)
         rrbackup = RoundRobinBackup()
         rrbackup.set_command_line_library(cli_mock)
         rrbackup.backup()
 
+    def test_date_option_replaces_current_date(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--date',
+            '2020-03-04'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        existing_backups = create_remote_listing([
+            'automated-backup-2020-03-03.tar.bzip2',
+            'automated-backup-2020-03-04.tar.bzip2',
+            'automated-backup-{0}.tar.bzip2'.format(self.today)
+        ])
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/latest', ''),
+            ('rsync -az --delete -e ssh /local/files user@target.com:/some/path/latest', ''),
+            ('ssh user@target.com /bin/tar -C /some/path -cjf /some/path/automated-backup-2020-03-04.tar.bzip2.partial latest && /bin/mv /some/path/automated-backup-2020-03-04.tar.bzip2.partial /some/path/automated-backup-2020-03-04.tar.bzip2 || { /bin/rm -f /some/path/automated-backup-2020-03-04.tar.bzip2.partial; false; }', ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + REMOVE_COMMAND, '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.stdin, ['/some/path/automated-backup-{0}.tar.bzip2\0'.format(self.today)])
+        assert_equal(cli_mock.expected_commands, [])
+
     def test_full_execution_when_remote_archives_exist(self):
         arguments = [
             '/local/files',
@@ -129,18 +223,61 @@ class TestRoundRobinBackup:
             'automated-backup-2004-02-21.tar.bzip2',
             'automated-backup-2004-02-22.tar'
         ]
-        existing_backups = '\n'.join(existing_backup_files)
+        existing_backups = create_remote_listing(existing_backup_files)
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/latest', ''),
+            ('rsync -az --delete -e ssh /local/files user@target.com:/some/path/latest', ''),
+            ('ssh user@target.com /bin/tar -C /some/path -cjf /some/path/automated-backup-{0}.tar.bzip2.partial latest && /bin/mv /some/path/automated-backup-{0}.tar.bzip2.partial /some/path/automated-backup-{0}.tar.bzip2 || {{ /bin/rm -f /some/path/automated-backup-{0}.tar.bzip2.partial; false; }}'.format(self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + REMOVE_COMMAND, '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.stdin, ['/some/path/automated-backup-2004-02-21.tar.bzip2\0/some/path/automated-backup-2004-02-22.tar\0'])
+
+    def test_remote_names_with_spaces_and_newlines_are_pruned_quoted(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        existing_backup_files = [
+            'automated-backup-1996-01-21',
+            'automated-backup-2004-02-21.tar copy.bzip2',
+            'automated-backup-2004-02-22.tar\nnotes',
+            'unrelated\nautomated-backup-2004-02-23'
+        ]
+        existing_backups = create_remote_listing(existing_backup_files)
         cli_input_output = [
             ('ssh user@target.com /bin/mkdir -p /some/path/latest', ''),
             ('rsync -az --delete -e ssh /local/files user@target.com:/some/path/latest', ''),
-            ('ssh user@target.com /bin/tar -C /some/path -cjf /some/path/automated-backup-{0}.tar.bzip2 latest'.format(self.today), ''),
-            ('ssh user@target.com /bin/ls /some/path', existing_backups),
-            ('ssh user@target.com /bin/rm -r /some/path/automated-backup-2004-02-21.tar.bzip2 /some/path/automated-backup-2004-02-22.tar', '')
+            ('ssh user@target.com /bin/tar -C /some/path -cjf /some/path/automated-backup-{0}.tar.bzip2.partial latest && /bin/mv /some/path/automated-backup-{0}.tar.bzip2.partial /some/path/automated-backup-{0}.tar.bzip2 || {{ /bin/rm -f /some/path/automated-backup-{0}.tar.bzip2.partial; false; }}'.format(self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + REMOVE_COMMAND, '')
         ]
         cli_mock = CommandLineMock(cli_input_output)
         rrbackup = RoundRobinBackup()
         rrbackup.set_command_line_library(cli_mock)
         rrbackup.backup()
+        assert_equal(cli_mock.stdin, ['/some/path/automated-backup-2004-02-21.tar copy.bzip2\0/some/path/automated-backup-2004-02-22.tar\nnotes\0'])
+        assert_equal(cli_mock.expected_commands, [])
+
+    def test_remote_destination_path_is_listed_quoted(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/back ups'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        cli = CommandLineRecorder()
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli)
+        rrbackup._execute('cleanup')
+        assert_equal(cli.commands[0], ['ssh', 'user@target.com',
+                     LIST_COMMAND.format("'/some/back ups'")])
 
     def test_full_execution_with_options_when_remote_archives_exist(self):
         arguments = [
@@ -174,15 +311,1141 @@ class TestRoundRobinBackup:
             'custom_backup_prefix_2004-02-21.tar.bzip2',
             'custom_backup_prefix_2004-02-22.tar'
         ]
-        existing_backups = '\n'.join(existing_backup_files)
+        existing_backups = create_remote_listing(existing_backup_files)
         cli_input_output = [
             ('ssh user@target.com -p 2222 -i /dev/null /bin/mkdir -p /some/path/live-files', ''),
             ('rsync -az --delete -e ssh -p 2222 -i /dev/null /local/files user@target.com:/some/path/live-files --exclude .git/* --exclude .venv/*', ''),
-            ('ssh user@target.com -p 2222 -i /dev/null /bin/tar -C /some/path -cjf /some/path/custom_backup_prefix_{0}.tar.bzip2 live-files'.format(self.today), ''),
-            ('ssh user@target.com -p 2222 -i /dev/null /bin/ls /some/path', existing_backups),
-            ('ssh user@target.com -p 2222 -i /dev/null /bin/rm -r /some/path/custom_backup_prefix_2004-02-21.tar.bzip2 /some/path/custom_backup_prefix_2004-02-22.tar', '')
+            ('ssh user@target.com -p 2222 -i /dev/null /bin/tar -C /some/path -cjf /some/path/custom_backup_prefix_{0}.tar.bzip2.partial live-files && /bin/mv /some/path/custom_backup_prefix_{0}.tar.bzip2.partial /some/path/custom_backup_prefix_{0}.tar.bzip2 || {{ /bin/rm -f /some/path/custom_backup_prefix_{0}.tar.bzip2.partial; false; }}'.format(self.today), ''),
+            ('ssh user@target.com -p 2222 -i /dev/null ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com -p 2222 -i /dev/null ' + REMOVE_COMMAND, '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.stdin, ['/some/path/custom_backup_prefix_2004-02-21.tar.bzip2\0/some/path/custom_backup_prefix_2004-02-22.tar\0'])
+
+    def test_full_execution_with_ssh_multiplex_reuses_one_connection(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--ssh-multiplex'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        cli_recorder = CommandLineRecorder()
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_recorder)
+        rrbackup.backup()
+
+        commands = cli_recorder.commands
+        control_option = commands[0][commands[0].index('-o') + 1]
+        assert_true(control_option.startswith('ControlPath='))
+        assert_true('ControlMaster=yes' in commands[0])
+        assert_equal(commands[-1][-2:], ['-O', 'exit'])
+        for command in commands[1:]:
+            command_as_string = ' '.join(command)
+            assert_true(control_option in command_as_string)
+        assert_equal(rrbackup.get_options()['ssh_control_path'], None)
+
+    def count_ssh_handshakes(self, extra_arguments):
+        '''
+        Every ssh session negotiates its own connection, except those
+        reusing a master through its ControlPath
+        '''
+        arguments = ['/local/files', 'user@target.com:/some/path']
+        self.set_command_line_arguments(arguments + extra_arguments)
+        cli_recorder = CommandLineRecorder()
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_recorder)
+        rrbackup.backup()
+        handshakes = 0
+        for command in cli_recorder.commands:
+            if command[0] != 'ssh' and 'ssh' not in ' '.join(command):
+                continue
+            if '-O' in command:
+                continue
+            if 'ControlMaster=yes' in command or \
+                    not any('ControlPath=' in token for token in command):
+                handshakes += 1
+        return handshakes
+
+    def test_ssh_multiplex_reduces_handshakes_to_one(self):
+        assert_equal(self.count_ssh_handshakes([]), 4)
+        assert_equal(self.count_ssh_handshakes(['--ssh-multiplex']), 1)
+
+    def test_full_execution_with_compression_codec(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--compression',
+            'zstd',
+            '--compression-level',
+            '3'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        # Archives created with other codecs are still recognized. Only the
+        # unanchored 2004-02-21 archive is stale.
+        existing_backup_files = [
+            'automated-backup-1996-01-21.tar.bzip2',
+            'automated-backup-2004-02-21.tar.gz',
+            'automated-backup-{0}.tar.zst'.format(self.today),
+            'automated-backup-level0.snar'
+        ]
+        existing_backups = create_remote_listing(existing_backup_files)
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/latest', ''),
+            ('rsync -az --delete -e ssh /local/files user@target.com:/some/path/latest', ''),
+            ("ssh user@target.com /bin/bash -c 'set -o pipefail && /bin/tar -C /some/path -cf - latest | zstd -c -q -T0 -3 > /some/path/automated-backup-{0}.tar.zst.partial' && /bin/mv /some/path/automated-backup-{0}.tar.zst.partial /some/path/automated-backup-{0}.tar.zst || {{ /bin/rm -f /some/path/automated-backup-{0}.tar.zst.partial; false; }}".format(self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + REMOVE_COMMAND, '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.stdin, ['/some/path/automated-backup-2004-02-21.tar.gz\0'])
+        assert_equal(cli_mock.expected_commands, [])
+
+    def test_full_execution_in_snapshot_mode(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--archive-mode',
+            'snapshot'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        # The newest snapshot before today is used as the hardlink base.
+        # Tarballs are never used as a base, but are pruned by the same rules.
+        existing_backup_files = [
+            'automated-backup-1996-01-21',
+            'automated-backup-2004-02-21',
+            'automated-backup-2004-02-22.tar.bzip2',
+            'automated-backup-{0}'.format(self.today),
+            'latest'
+        ]
+        existing_backups = create_remote_listing(existing_backup_files)
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/automated-backup-{0}'.format(self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('rsync -az --delete --link-dest=/some/path/automated-backup-2004-02-21 -e ssh /local/files user@target.com:/some/path/automated-backup-{0}'.format(self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + REMOVE_COMMAND, '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.stdin, ['/some/path/automated-backup-2004-02-21\0/some/path/automated-backup-2004-02-22.tar.bzip2\0'])
+        assert_equal(cli_mock.expected_commands, [])
+
+    def test_first_run_in_snapshot_mode_has_no_link_dest(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--archive-mode',
+            'snapshot'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/automated-backup-{0}'.format(self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), ''),
+            ('rsync -az --delete -e ssh /local/files user@target.com:/some/path/automated-backup-{0}'.format(self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.expected_commands, [])
+
+    def get_date_string(self, days_ago):
+        day = date.today() - timedelta(days=days_ago)
+        return day.isoformat()
+
+    def test_full_execution_in_incremental_mode_on_anchor_date(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--archive-mode',
+            'incremental'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        # The oldest backup is exactly one week old, making today a weekly
+        # anchor date that gets a new full archive and snapshot file.
+        existing_backup_files = [
+            'automated-backup-{0}.tar.bzip2'.format(self.get_date_string(7)),
+            'automated-backup-{0}.incremental.tar.bzip2'.format(self.get_date_string(1))
+        ]
+        existing_backups = create_remote_listing(existing_backup_files)
+        snar = '/some/path/.automated-backup-level0.snar'
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/latest', ''),
+            ('rsync -az --delete -e ssh /local/files user@target.com:/some/path/latest', ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com /usr/bin/test -f {0}'.format(snar), True),
+            ('ssh user@target.com /bin/rm -f {0}.new && /bin/tar -C /some/path --listed-incremental={0}.new -cjf /some/path/automated-backup-{1}.tar.bzip2.partial latest && /bin/mv /some/path/automated-backup-{1}.tar.bzip2.partial /some/path/automated-backup-{1}.tar.bzip2 || {{ /bin/rm -f /some/path/automated-backup-{1}.tar.bzip2.partial; false; }} && /bin/mv {0}.new {0}'.format(snar, self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups)
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.expected_commands, [])
+
+    def test_full_execution_in_incremental_mode_between_anchor_dates(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--archive-mode',
+            'incremental',
+            '--compression',
+            'zstd'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        existing_backup_files = [
+            'automated-backup-{0}.tar.bzip2'.format(self.get_date_string(8)),
+        ]
+        existing_backups = create_remote_listing(existing_backup_files)
+        snar = '/some/path/.automated-backup-level0.snar'
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/latest', ''),
+            ('rsync -az --delete -e ssh /local/files user@target.com:/some/path/latest', ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com /usr/bin/test -f {0}'.format(snar), True),
+            ("ssh user@target.com /bin/cp {0} {0}.work && /bin/bash -c 'set -o pipefail && /bin/tar -C /some/path --listed-incremental={0}.work -cf - latest | zstd -c -q -T0 > /some/path/automated-backup-{1}.incremental.tar.zst.partial' && /bin/mv /some/path/automated-backup-{1}.incremental.tar.zst.partial /some/path/automated-backup-{1}.incremental.tar.zst || {{ /bin/rm -f /some/path/automated-backup-{1}.incremental.tar.zst.partial; false; }} && /bin/rm {0}.work".format(snar, self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups)
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.expected_commands, [])
+
+    def test_incremental_mode_without_snapshot_file_creates_full_archive(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--archive-mode',
+            'incremental'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        existing_backup_files = [
+            'automated-backup-{0}.tar.bzip2'.format(self.get_date_string(8)),
+        ]
+        existing_backups = create_remote_listing(existing_backup_files)
+        snar = '/some/path/.automated-backup-level0.snar'
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/latest', ''),
+            ('rsync -az --delete -e ssh /local/files user@target.com:/some/path/latest', ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com /usr/bin/test -f {0}'.format(snar), False),
+            ('ssh user@target.com /bin/rm -f {0}.new && /bin/tar -C /some/path --listed-incremental={0}.new -cjf /some/path/automated-backup-{1}.tar.bzip2.partial latest && /bin/mv /some/path/automated-backup-{1}.tar.bzip2.partial /some/path/automated-backup-{1}.tar.bzip2 || {{ /bin/rm -f /some/path/automated-backup-{1}.tar.bzip2.partial; false; }} && /bin/mv {0}.new {0}'.format(snar, self.today), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups)
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.expected_commands, [])
+
+    def test_cleanup_keeps_full_archives_needed_by_retained_incrementals(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--archive-mode',
+            'incremental'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        # 2004-02-21 is not a round-robin date, but yesterday's incremental
+        # was created against it. 2004-02-20 has no retained dependents.
+        existing_backup_files = [
+            'automated-backup-1996-01-21.tar.bzip2',
+            'automated-backup-2004-02-20.tar.bzip2',
+            'automated-backup-2004-02-21.tar.bzip2',
+            'automated-backup-{0}.incremental.tar.bzip2'.format(self.get_date_string(1))
+        ]
+        existing_backups = create_remote_listing(existing_backup_files)
+        cli_input_output = [
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + REMOVE_COMMAND, '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup._execute('cleanup')
+        assert_equal(cli_mock.stdin, ['/some/path/automated-backup-2004-02-20.tar.bzip2\0'])
+        assert_equal(cli_mock.expected_commands, [])
+
+    def test_full_execution_in_stream_mode(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--archive-mode',
+            'stream',
+            '--compression',
+            'pigz',
+            '--exclude',
+            '.git/*'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        # Partial uploads are never treated as backups by the pruner, and
+        # those left by an earlier failed run are removed
+        existing_backup_files = [
+            'automated-backup-1996-01-21.tar.bzip2',
+            'automated-backup-2004-02-21.tar.gz.partial',
+            'automated-backup-{0}.tar.gz'.format(self.today)
+        ]
+        existing_backups = create_remote_listing(existing_backup_files)
+        archive = '/some/path/automated-backup-{0}.tar.gz'.format(self.today)
+        cli_input_output = [
+            ('/bin/sh -c ' + TAR_WARNING_SCRIPT + ' sh -C /local -cf - --exclude=.git/* files | pigz -c | ssh user@target.com /bin/mkdir -p /some/path && /bin/cat > {0}.partial'.format(archive), ''),
+            ('ssh user@target.com /bin/mv {0}.partial {0}'.format(archive), ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + REMOVE_COMMAND, '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.expected_commands, [])
+        assert_equal(cli_mock.stdin, ['/some/path/automated-backup-2004-02-21.tar.gz.partial\0'])
+
+    def test_failed_stream_removes_the_partial_archive(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--archive-mode',
+            'stream'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        class CommandLineFailingQueue(CommandLineRecorder):
+            def execute_queue(self, commands, **extra):
+                raise Exception('Broken pipe')
+
+        cli = CommandLineFailingQueue()
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli)
+        with assert_raises(Exception) as context:
+            rrbackup._execute('archive')
+        assert_true('Broken pipe' in str(context.exception))
+        archive = '/some/path/automated-backup-{0}.tar.bzip2'.format(self.today)
+        assert_equal(' '.join(cli.commands[-1]),
+                     'ssh user@target.com /bin/rm -f {0}.partial'.format(archive))
+
+    def test_failed_removals_are_reported_without_failing_cleanup(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--prune-parallelism',
+            '2',
+            '--prune-batch-size',
+            '10',
+            '--metrics-file',
+            '/tmp/unused-run.json'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        existing_backups = create_remote_listing([
+            'automated-backup-1996-01-21.tar.bzip2',
+            'automated-backup-2004-02-21.tar.bzip2',
+            'automated-backup-2004-02-22.tar.bzip2'
+        ], [1024, 2048, 4096])
+        failed_archive = '/some/path/automated-backup-2004-02-22.tar.bzip2'
+        remove_command = REMOVE_COMMAND.replace('-n 100 -P 4', '-n 10 -P 2')
+        cli_input_output = [
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + remove_command, failed_archive + '\0')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup._execute('cleanup')
+        assert_equal(cli_mock.expected_commands, [])
+
+        record = rrbackup.get_run_record()
+        cleanup = record['phases'][0]
+        assert_equal(cleanup['success'], True)
+        assert_equal(cleanup['metrics']['prune_failed'], [failed_archive])
+        assert_equal(cleanup['metrics']['prune_failed_count'], 1)
+        assert_equal(cleanup['metrics']['pruned_count'], 1)
+        assert_equal(cleanup['metrics']['pruned_bytes'], 2048)
+        assert_equal(cleanup['metrics']['retained_count'], 2)
+        assert_equal(cleanup['metrics']['retained_bytes'], 5120)
+
+    def test_trash_prune_mode_moves_stale_archives_to_trash(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--prune-mode',
+            'trash'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        existing_backups = create_remote_listing([
+            'automated-backup-1996-01-21.tar.bzip2',
+            'automated-backup-2004-02-21.tar.bzip2'
+        ])
+        trash_command = "/bin/mkdir -p /some/path/.trash && /usr/bin/xargs -0 -r -n 100 -P 4 /bin/sh -c 'trash=$1; shift; for path; do /bin/mv -- \"$path\" \"$trash\"/ || printf \"%s\\0\" \"$path\"; done' sh /some/path/.trash"
+        cli_input_output = [
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + trash_command, '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup._execute('cleanup')
+        assert_equal(cli_mock.stdin, ['/some/path/automated-backup-2004-02-21.tar.bzip2\0'])
+        assert_equal(cli_mock.expected_commands, [])
+
+    def test_reap_trash_deletes_trashed_archives_at_rate_limit(self):
+        metrics_dir = tempfile.mkdtemp()
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--reap-trash',
+            '--reap-files-per-second',
+            '2',
+            '--reap-bytes-per-second',
+            '1000',
+            '--metrics-file',
+            os.path.join(metrics_dir, 'run.json')
+        ]
+        self.set_command_line_arguments(arguments)
+
+        # Listed newest first, reaped oldest first. The snapshot directory is
+        # measured with du
+        trash_listing = '\0'.join([
+            'f/4000/1500000200.0/automated-backup-2004-02-22.tar.bzip2',
+            'd/4096/1500000100.0/automated-backup-2004-02-21',
+            'f/100/1500000000.0/automated-backup-2004-02-20.tar.bzip2'
+        ])
+        snapshot = '/some/path/.trash/automated-backup-2004-02-21'
+        reap_command = "/usr/bin/xargs -0 -r -n 2 /bin/sh -c '/bin/rm -r -- \"$2\" || printf \"%s\\0\" \"$2\"; /bin/sleep \"$1\"' sh"
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/.trash', ''),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path/.trash'), trash_listing),
+            ('ssh user@target.com /usr/bin/du -sb {0}'.format(snapshot), '1500\t{0}\n'.format(snapshot)),
+            ('ssh user@target.com ' + reap_command, snapshot + '\0')
         ]
         cli_mock = CommandLineMock(cli_input_output)
         rrbackup = RoundRobinBackup()
         rrbackup.set_command_line_library(cli_mock)
         rrbackup.backup()
+        shutil.rmtree(metrics_dir)
+        assert_equal(cli_mock.expected_commands, [])
+        assert_equal(cli_mock.stdin, ['\0'.join([
+            '0.500', '/some/path/.trash/automated-backup-2004-02-20.tar.bzip2',
+            '1.500', snapshot,
+            '4.000', '/some/path/.trash/automated-backup-2004-02-22.tar.bzip2'
+        ]) + '\0'])
+
+        record = rrbackup.get_run_record()
+        assert_equal([phase['phase'] for phase in record['phases']], ['reap'])
+        metrics = record['phases'][0]['metrics']
+        assert_equal(metrics['reaped_count'], 2)
+        assert_equal(metrics['reaped_bytes'], 4100)
+        assert_equal(metrics['reap_failed'], [snapshot])
+
+    def test_failed_metrics_export_keeps_the_outcome_of_the_run(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--reap-trash',
+            '--metrics-file',
+            '/nonexistent/directory/run.json',
+            '--prometheus-dir',
+            '/nonexistent/directory'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        class CommandLineFailingList(CommandLineRecorder):
+            def execute_lines(self, command, **extra):
+                raise Exception('Connection refused')
+
+        stderr = sys.stderr
+        sys.stderr = tempfile.TemporaryFile(mode='w+')
+        try:
+            rrbackup = RoundRobinBackup()
+            rrbackup.set_command_line_library(CommandLineRecorder())
+            rrbackup.backup()
+            assert_true(rrbackup.get_run_record()['success'])
+
+            rrbackup = RoundRobinBackup()
+            rrbackup.set_command_line_library(CommandLineFailingList())
+            with assert_raises(Exception) as context:
+                rrbackup.backup()
+            assert_true('Connection refused' in str(context.exception))
+            sys.stderr.seek(0)
+            messages = sys.stderr.read()
+        finally:
+            sys.stderr.close()
+            sys.stderr = stderr
+        assert_equal(messages.count('Could not write metrics file'), 2)
+        assert_equal(messages.count('Could not write Prometheus metrics'), 2)
+
+    def test_metrics_file_records_phases_and_metrics(self):
+        metrics_dir = tempfile.mkdtemp()
+        metrics_file = os.path.join(metrics_dir, 'run.json')
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--metrics-file',
+            metrics_file,
+            '--prometheus-dir',
+            metrics_dir
+        ]
+        self.set_command_line_arguments(arguments)
+
+        rsync_stats = textwrap.dedent('''
+            Number of files: 1,024
+            Number of regular files transferred: 12
+            Total file size: 52,428,800 bytes
+            Total transferred file size: 1,048,576 bytes
+            Total bytes sent: 1,050,000
+            Total bytes received: 2,345
+
+            sent 1,050,000 bytes  received 2,345 bytes  701,563.33 bytes/sec
+            total size is 52,428,800  speedup is 49.82
+            ''')
+        stale_archive = '/some/path/automated-backup-1996-01-22.tar.bzip2'
+        existing_backups = create_remote_listing([
+            'automated-backup-1996-01-21.tar.bzip2',
+            'automated-backup-1996-01-22.tar.bzip2',
+            'automated-backup-{0}.tar.bzip2'.format(self.today)
+        ], [1024, 2048, 4096])
+        archive = '/some/path/automated-backup-{0}.tar.bzip2'.format(self.today)
+        cli_input_output = [
+            ('ssh user@target.com /bin/mkdir -p /some/path/latest', ''),
+            ('rsync -az --delete --stats -e ssh /local/files user@target.com:/some/path/latest', rsync_stats),
+            ('ssh user@target.com /bin/tar -C /some/path -cjf {0}.partial latest && /bin/mv {0}.partial {0} || {{ /bin/rm -f {0}.partial; false; }}'.format(archive), ''),
+            ('ssh user@target.com /usr/bin/stat -c %s {0}'.format(archive), '4096\n'),
+            ('ssh user@target.com ' + LIST_COMMAND.format('/some/path'), existing_backups),
+            ('ssh user@target.com ' + REMOVE_COMMAND, '')
+        ]
+        cli_mock = CommandLineMock(cli_input_output)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_mock)
+        rrbackup.backup()
+        assert_equal(cli_mock.stdin, [stale_archive + '\0'])
+        assert_equal(cli_mock.expected_commands, [])
+
+        with open(metrics_file) as record_file:
+            record = json.load(record_file)
+        prom_files = os.listdir(metrics_dir)
+        shutil.rmtree(metrics_dir)
+        assert_equal(sorted(prom_files),
+                     ['roundrobinbackup_local_files.prom', 'run.json'])
+        assert_equal(record['success'], True)
+        assert_equal([phase['phase'] for phase in record['phases']],
+                     ['backup', 'archive', 'cleanup'])
+        backup, archive, cleanup = record['phases']
+        assert_equal(backup['metrics']['bytes_sent'], 1050000)
+        assert_equal(backup['metrics']['bytes_received'], 2345)
+        assert_equal(backup['metrics']['speedup'], 49.82)
+        assert_equal(len(backup['commands']), 2)
+        assert_equal(backup['commands'][1]['returncode'], 0)
+        assert_equal(archive['metrics']['archive_bytes'], 4096)
+        assert_equal(cleanup['metrics']['pruned_count'], 1)
+        assert_equal(cleanup['metrics']['pruned_bytes'], 2048)
+        assert_equal(cleanup['metrics']['retained_count'], 2)
+        assert_equal(cleanup['metrics']['retained_bytes'], 5120)
+
+    def test_remote_helper_runs_each_phase_in_one_session(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--remote-helper',
+            '--remote-python',
+            'python3',
+            '--metrics-file',
+            '/tmp/unused-run.json'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        class CommandLineRemoteHelper(CommandLineRecorder):
+            def execute(self, command, stdin=None, **extra):
+                CommandLineRecorder.execute(self, command)
+                python, _, batch = command[-1].split(' ')
+                self.program = stdin.read().decode('utf-8')
+                batch = remotehelper.decode_batch(batch)
+                self.batches.append(batch['operations'])
+                results = [dict(operation, success=True, error=None,
+                                skipped=False, duration=0.5)
+                           for operation in batch['operations']]
+                for result in results:
+                    result.update({
+                        'size': 4096, 'removed': ['/some/path/stale'],
+                        'failed': [], 'pruned_count': 1, 'pruned_bytes': 10,
+                        'retained_count': 2, 'retained_bytes': 20
+                    })
+                return json.dumps({'results': results})
+
+        cli = CommandLineRemoteHelper()
+        cli.batches = []
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli)
+        rrbackup._execute('archive')
+        rrbackup._execute('cleanup')
+
+        commands = [' '.join(command).rsplit(' ', 1)[0]
+                    for command in cli.commands]
+        assert_equal(commands, ['ssh user@target.com python3 -'] * 2)
+        assert_true('class RoundRobinDate' in cli.program)
+        assert_true('class RemoteHelper' in cli.program)
+        archive, prune = cli.batches
+        archive_path = '/some/path/automated-backup-{0}.tar.bzip2'.format(
+            self.today)
+        assert_equal([operation['op'] for operation in archive],
+                     ['archive', 'fsync'])
+        assert_equal(archive[0]['command'], '/bin/tar -C /some/path -cjf '
+                     '{0}.partial latest && /bin/mv {0}.partial {0} || '
+                     '{{ /bin/rm -f {0}.partial; false; }}'.format(
+                     archive_path))
+        assert_equal(archive[1]['paths'], [archive_path])
+        assert_equal(prune[0]['op'], 'prune')
+        assert_equal(prune[0]['prefix'], 'automated-backup-')
+        assert_equal(prune[0]['retention']['weeks'], '5')
+        assert_equal(prune[0]['mode'], 'delete')
+        assert_true(prune[0]['sizes'])
+
+        archive_phase, cleanup_phase = rrbackup.get_run_record()['phases']
+        assert_equal(archive_phase['metrics']['archive_bytes'], 4096)
+        assert_equal(archive_phase['metrics']['remote_operations'], [
+            {'op': 'archive', 'duration': 0.5, 'success': True},
+            {'op': 'fsync', 'duration': 0.5, 'success': True}
+        ])
+        assert_equal(cleanup_phase['metrics']['pruned_count'], 1)
+        assert_equal(cleanup_phase['metrics']['retained_bytes'], 20)
+
+    def test_remote_helper_failure_fails_the_phase(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--remote-helper'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        class CommandLineFailingHelper(CommandLineRecorder):
+            def execute(self, command, **extra):
+                return json.dumps({'results': [
+                    {'op': 'archive', 'success': False, 'skipped': False,
+                     'error': 'Command exited 2', 'duration': 0.1},
+                    {'op': 'fsync', 'success': False, 'skipped': True,
+                     'error': None, 'duration': 0}
+                ]})
+
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(CommandLineFailingHelper())
+        with assert_raises(Exception) as context:
+            rrbackup._execute('archive')
+        assert_true('archive failed: Command exited 2' in
+                    str(context.exception))
+
+    def test_local_destination_runs_in_process_without_ssh(self):
+        destination = tempfile.mkdtemp()
+        os.mkdir(os.path.join(destination, 'latest'))
+        with open(os.path.join(destination, 'latest', 'file'), 'w') as synced:
+            synced.write('data')
+        for backup_date in ['2004-01-01', '2004-12-03', '2004-12-31']:
+            name = 'automated-backup-{0}.tar.bzip2'.format(backup_date)
+            open(os.path.join(destination, name), 'w').close()
+        arguments = [
+            '/local/files',
+            destination,
+            '--date',
+            '2005-01-01'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        cli = CommandLineRecorder()
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli)
+        rrbackup.backup()
+        names = sorted(os.listdir(destination))
+        shutil.rmtree(destination)
+        assert_equal(cli.commands, [[
+            'rsync', '-az', '--delete', '/local/files',
+            os.path.join(destination, 'latest')
+        ]])
+        assert_equal(names, [
+            'automated-backup-2004-01-01.tar.bzip2',
+            'automated-backup-2004-12-31.tar.bzip2',
+            'automated-backup-2005-01-01.tar.bzip2',
+            'latest'
+        ])
+
+    def test_local_destination_with_python_archive_writer(self):
+        destination = tempfile.mkdtemp()
+        os.mkdir(os.path.join(destination, 'latest'))
+        with open(os.path.join(destination, 'latest', 'file'), 'w') as synced:
+            synced.write('data')
+        arguments = [
+            '/local/files',
+            destination,
+            '--date',
+            '2005-01-01',
+            '--archive-writer',
+            'python',
+            '--archive-processes',
+            '2'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        cli = CommandLineRecorder()
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli)
+        rrbackup._execute('archive')
+        archive = os.path.join(destination,
+                               'automated-backup-2005-01-01.tar.bzip2')
+        tar_data = subprocess.Popen(['bunzip2', '-c', archive],
+                                    stdout=subprocess.PIPE).communicate()[0]
+        shutil.rmtree(destination)
+        assert_equal(cli.commands, [])
+        tar = tarfile.open(fileobj=io.BytesIO(tar_data), mode='r:')
+        assert_equal(tar.getnames(), ['latest', 'latest/file'])
+
+    def test_failed_full_archive_keeps_the_snapshot_file(self):
+        destination = tempfile.mkdtemp()
+        snar = os.path.join(destination, '.automated-backup-level0.snar')
+        with open(snar, 'w') as snapshot_file:
+            snapshot_file.write('level0')
+        arguments = [
+            '/local/files',
+            destination,
+            '--date',
+            '2005-01-01',
+            '--archive-mode',
+            'incremental'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(CommandLineRecorder())
+        assert_raises(Exception, rrbackup._execute, 'archive')
+        with open(snar) as snapshot_file:
+            snapshot = snapshot_file.read()
+        names = os.listdir(destination)
+        shutil.rmtree(destination)
+        assert_equal(snapshot, 'level0')
+        assert_equal([name for name in names
+                      if name.startswith('automated-backup-')], [])
+
+    def test_python_archive_writer_rejects_incremental_mode(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path',
+            '--archive-writer',
+            'python',
+            '--archive-mode',
+            'incremental'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(CommandLineRecorder())
+        assert_raises(Exception, rrbackup._execute, 'archive')
+
+    def test_local_destination_reaps_trash_in_process(self):
+        destination = tempfile.mkdtemp()
+        trash = os.path.join(destination, '.trash')
+        os.makedirs(os.path.join(trash, 'automated-backup-2004-02-21'))
+        with open(os.path.join(trash, 'automated-backup-2004-02-20.tar.gz'),
+                  'w') as trashed:
+            trashed.write('12345')
+        arguments = [
+            '/local/files',
+            destination,
+            '--reap-trash',
+            '--reap-files-per-second',
+            '1000',
+            '--metrics-file',
+            os.path.join(destination, 'run.json')
+        ]
+        self.set_command_line_arguments(arguments)
+
+        cli = CommandLineRecorder()
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli)
+        rrbackup.backup()
+        trashed_names = os.listdir(trash)
+        shutil.rmtree(destination)
+        assert_equal(cli.commands, [])
+        assert_equal(trashed_names, [])
+        metrics = rrbackup.get_run_record()['phases'][0]['metrics']
+        assert_equal(metrics['reaped_count'], 2)
+        assert_equal(metrics['reap_failed'], [])
+
+    def test_sharded_rsync_balances_top_level_directories(self):
+        source = tempfile.mkdtemp()
+        for path, files in [('a', 3), ('b', 1), ('c', 1)]:
+            os.makedirs(os.path.join(source, 'files', path))
+            for index in range(files):
+                open(os.path.join(source, 'files', path, str(index)),
+                     'w').close()
+        open(os.path.join(source, 'files', 'top-level-file'), 'w').close()
+        arguments = [
+            os.path.join(source, 'files'),
+            'user@target.com:/some/path',
+            '--rsync-shards',
+            '2',
+            '--metrics-file',
+            os.path.join(source, 'run.json')
+        ]
+        self.set_command_line_arguments(arguments)
+
+        class CommandLineShardRecorder(CommandLineRecorder):
+            def execute(self, command, **extra):
+                CommandLineRecorder.execute(self, command)
+                for token in command:
+                    if token.startswith('--files-from='):
+                        with open(token.split('=', 1)[1]) as files_from:
+                            self.shards.append(files_from.read())
+                return 'Total bytes sent: 100\nTotal file size: 1,000\n' \
+                       'Total bytes received: 10\n'
+
+        cli = CommandLineShardRecorder()
+        cli.shards = []
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli)
+        rrbackup._execute('backup')
+        shutil.rmtree(source)
+
+        commands = [' '.join(command) for command in cli.commands]
+        assert_equal(commands[:2], [
+            'ssh user@target.com /bin/mkdir -p /some/path/latest',
+            'rsync -dlptgoDz --delete --stats -e ssh {0}/files/ user@target.com:/some/path/latest/files/'.format(source)
+        ])
+        shard_command = 'rsync -az --delete --stats -r --from0 --files-from={0} -e ssh {1}/ user@target.com:/some/path/latest'
+        assert_equal(len(commands), 4)
+        for command in commands[2:]:
+            files_from = command.split('--files-from=')[1].split(' ')[0]
+            assert_equal(command, shard_command.format(files_from, source))
+        assert_equal(sorted(cli.shards),
+                     ['files/a\0', 'files/c\0files/b\0'])
+
+        metrics = rrbackup.get_run_record()['phases'][0]['metrics']
+        assert_equal(metrics['rsync_shards'], 2)
+        assert_equal(metrics['bytes_sent'], 300)
+        assert_equal(metrics['bytes_received'], 30)
+        assert_equal(metrics['speedup'], 9.09)
+
+    def test_sharded_rsync_weighs_without_excluded_entries(self):
+        source = tempfile.mkdtemp()
+        for path, names in [('a', ['0.tmp', '1.tmp', '2.tmp', '3.tmp']),
+                            ('b', ['0', '1']), ('c', ['0'])]:
+            os.makedirs(os.path.join(source, 'files', path))
+            for name in names:
+                open(os.path.join(source, 'files', path, name), 'w').close()
+        arguments = [
+            os.path.join(source, 'files'),
+            'user@target.com:/some/path',
+            '--rsync-shards',
+            '2',
+            '--exclude',
+            '*.tmp'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        rrbackup = RoundRobinBackup()
+        agent = rrbackup._backup_agent_simple_factory('backup')
+        agent.set_options(rrbackup.options)
+        shards = agent._get_rsync_shards(source, 'files/')
+        shutil.rmtree(source)
+        assert_equal(shards, [['files/b'], ['files/c', 'files/a']])
+
+    def test_concurrent_shard_commands_share_the_reactor(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        rrbackup = RoundRobinBackup()
+        agent = rrbackup._backup_agent_simple_factory('backup')
+        agent.set_options(rrbackup.options)
+        agent.set_command_line_library(AsyncCommandLine())
+        threads = threading.active_count()
+        started = time.time()
+        command = ['sh', '-c', 'sleep 0.3; echo done']
+        outputs = agent._execute_commands_concurrently([command] * 6)
+        assert_equal(outputs, ['done\n'] * 6)
+        assert_true(time.time() - started < 1.5)
+        assert_true(threading.active_count() <= threads + 1)
+
+    def test_adaptive_rsync_workers_grow_with_throughput(self):
+        source = tempfile.mkdtemp()
+        for index in range(8):
+            os.makedirs(os.path.join(source, 'files', str(index)))
+        arguments = [
+            os.path.join(source, 'files'),
+            'user@target.com:/some/path',
+            '--rsync-max-workers',
+            '3',
+            '--metrics-file',
+            os.path.join(source, 'run.json')
+        ]
+        self.set_command_line_arguments(arguments)
+
+        class CommandLineRsyncRecorder(CommandLineConcurrencyRecorder):
+            def execute(self, command, **extra):
+                CommandLineConcurrencyRecorder.execute(self, command)
+                return 'Total bytes sent: 1,000\nTotal bytes received: 10\n'
+
+        cli = CommandLineRsyncRecorder()
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli)
+        rrbackup._execute('backup')
+        shutil.rmtree(source)
+
+        assert_equal(cli.max_running['all'], 3)
+        metrics = rrbackup.get_run_record()['phases'][0]['metrics']
+        assert_equal(metrics['rsync_shards'], 8)
+        assert_equal(metrics['bytes_sent'], 9000)
+        assert_equal(metrics['rsync_workers'], 3)
+        assert_equal([level['level'] for level in
+                      metrics['rsync_worker_levels']], [1, 2, 3])
+
+    def test_run_record_includes_failed_phase(self):
+        arguments = [
+            '/local/files',
+            'user@target.com:/some/path'
+        ]
+        self.set_command_line_arguments(arguments)
+
+        class CommandLineFailingRsync(CommandLineRecorder):
+            def execute(self, command, return_boolean=False, **extra):
+                if command[0] == 'rsync':
+                    error = Exception('Connection closed')
+                    error.returncode = 255
+                    raise error
+                return CommandLineRecorder.execute(self, command)
+
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(CommandLineFailingRsync())
+        assert_raises(Exception, rrbackup.backup)
+
+        record = rrbackup.get_run_record()
+        assert_equal(record['success'], False)
+        assert_equal(record['error'], 'Connection closed')
+        assert_equal(len(record['phases']), 1)
+        phase = record['phases'][0]
+        assert_equal(phase['success'], False)
+        assert_equal(phase['commands'][-1]['returncode'], 255)
+
+
+    def run_multiple_destination_backup(self, cli_recorder, extra_arguments=[]):
+        arguments = [
+            '/local/files',
+            'user@one.com:/backups',
+            'user@two.com:/backups',
+            'user@three.com:/srv/backups'
+        ] + extra_arguments
+        self.set_command_line_arguments(arguments)
+        rrbackup = RoundRobinBackup()
+        rrbackup.set_command_line_library(cli_recorder)
+        rrbackup.backup()
+        return [' '.join(command) for command in cli_recorder.commands]
+
+    def test_multiple_destinations_replay_one_rsync_batch(self):
+        commands = self.run_multiple_destination_backup(CommandLineRecorder())
+
+        rsync_commands = [command for command in commands
+                          if command.startswith('rsync')]
+        write_batch = rsync_commands[0]
+        assert_true(write_batch.startswith('rsync -az --delete --write-batch='))
+        assert_true(write_batch.endswith('/local/files user@one.com:/backups/latest'))
+        batch_file = write_batch.split('--write-batch=')[1].split(' ')[0]
+        assert_equal(sorted(rsync_commands[1:]), [
+            'rsync -az --delete --read-batch={0} -e ssh user@three.com:/srv/backups/latest'.format(batch_file),
+            'rsync -az --delete --read-batch={0} -e ssh user@two.com:/backups/latest'.format(batch_file)
+        ])
+
+        for destination in ['user@one.com /backups', 'user@two.com /backups',
+                            'user@three.com /srv/backups']:
+            host, path = destination.split(' ')
+            archive = 'ssh {0} /bin/tar -C {1} -cjf {1}/automated-backup-{2}.tar.bzip2.partial latest && /bin/mv {1}/automated-backup-{2}.tar.bzip2.partial {1}/automated-backup-{2}.tar.bzip2 || {{ /bin/rm -f {1}/automated-backup-{2}.tar.bzip2.partial; false; }}'.format(host, path, self.today)
+            assert_true(archive in commands)
+            assert_true('ssh {0} {1}'.format(host, LIST_COMMAND.format(path)) in commands)
+
+    def test_multiple_destinations_fall_back_to_rsync_when_batch_fails(self):
+        class CommandLineBatchFailure(CommandLineRecorder):
+            def execute(self, command, return_boolean=False, **extra):
+                self.commands.append(command)
+                return False if return_boolean else ''
+
+        commands = self.run_multiple_destination_backup(CommandLineBatchFailure())
+        assert_true('rsync -az --delete -e ssh /local/files user@two.com:/backups/latest' in commands)
+        assert_true('rsync -az --delete -e ssh /local/files user@three.com:/srv/backups/latest' in commands)
+
+    def run_multiple_destination_backup_failing(self, failing_destination):
+        class CommandLineRsyncFailure(CommandLineRecorder):
+            def execute(self, command, return_boolean=False, **extra):
+                self.commands.append(command)
+                if command[0] == 'rsync' and failing_destination in command[-1]:
+                    raise Exception('Connection refused')
+                return True if return_boolean else ''
+
+        cli = CommandLineRsyncFailure()
+        with assert_raises(Exception) as context:
+            self.run_multiple_destination_backup(cli)
+        commands = [' '.join(command) for command in cli.commands]
+        return str(context.exception), commands
+
+    def test_multiple_destinations_archive_every_synced_destination(self):
+        error, commands = self.run_multiple_destination_backup_failing(
+            'user@two.com')
+        assert_equal(error, 'user@two.com:/backups: Connection refused')
+        archives = [command for command in commands if '/bin/tar' in command]
+        assert_equal(sorted(command.split(' ')[1] for command in archives),
+                     ['user@one.com', 'user@three.com'])
+        assert_true('ssh user@three.com ' +
+                    LIST_COMMAND.format('/srv/backups') in commands)
+
+    def test_multiple_destinations_sync_directly_when_first_fails(self):
+        error, commands = self.run_multiple_destination_backup_failing(
+            'user@one.com')
+        assert_equal(error, 'user@one.com:/backups: Connection refused')
+        assert_true('rsync -az --delete -e ssh /local/files user@two.com:/backups/latest' in commands)
+        assert_true('rsync -az --delete -e ssh /local/files user@three.com:/srv/backups/latest' in commands)
+        archives = [command for command in commands if '/bin/tar' in command]
+        assert_equal(sorted(command.split(' ')[1] for command in archives),
+                     ['user@three.com', 'user@two.com'])
+
+    def test_multiple_destinations_in_snapshot_mode_sync_directly(self):
+        arguments = ['--archive-mode', 'snapshot']
+        commands = self.run_multiple_destination_backup(CommandLineRecorder(),
+                                                        arguments)
+        rsync_commands = [command for command in commands
+                          if command.startswith('rsync')]
+        assert_equal(len(rsync_commands), 3)
+        assert_false(any('batch' in command for command in rsync_commands))
+
+class TestRoundRobinBackupScheduler:
+
+    def setup(self):
+        "Set up test fixtures"
+        handle, self.config_file = tempfile.mkstemp(suffix='.ini')
+        os.close(handle)
+        jobs = []
+        for index in range(6):
+            host = 'backup{0}.com'.format(index % 2)
+            jobs.append(textwrap.dedent('''
+                [job-{0}]
+                source = /local/files-{0}
+                destination = user@{1}:/backups/{0}
+                '''.format(index, host)))
+        with open(self.config_file, 'w') as config:
+            config.write(''.join(jobs))
+
+    def teardown(self):
+        "Tear down test fixtures"
+        os.remove(self.config_file)
+
+    def create_scheduler(self, arguments, command_line_library):
+        sys.argv = ['./roundrobinbackup.py', '--config',
+                    self.config_file] + arguments
+        options = RoundRobinBackup().get_options()
+        scheduler = RoundRobinBackupScheduler(options)
+        scheduler.set_command_line_library(command_line_library)
+        return scheduler
+
+    def test_jobs_respect_global_and_per_host_limits(self):
+        cli = CommandLineConcurrencyRecorder()
+        arguments = ['--max-jobs', '3', '--max-jobs-per-host', '1']
+        scheduler = self.create_scheduler(arguments, cli)
+        results = scheduler.run()
+
+        assert_equal([result['job_name'] for result in results],
+                     ['job-{0}'.format(index) for index in range(6)])
+        assert_true(all(result['success'] for result in results))
+        assert_equal(cli.max_running['backup0.com'], 1)
+        assert_equal(cli.max_running['backup1.com'], 1)
+        assert_equal(cli.max_running['all'], 2)
+
+    def test_jobs_take_a_slot_on_every_destination_host(self):
+        with open(self.config_file, 'w') as config:
+            config.write(textwrap.dedent('''
+                [both]
+                source = /local/both
+                destination = user@backup0.com:/backups/both user@backup1.com:/backups/both
+                [first]
+                source = /local/first
+                destination = user@backup0.com:/backups/first
+                [second]
+                source = /local/second
+                destination = user@backup1.com:/backups/second
+                '''))
+        cli = CommandLineConcurrencyRecorder()
+        arguments = ['--max-jobs', '3', '--max-jobs-per-host', '1']
+        scheduler = self.create_scheduler(arguments, cli)
+        results = scheduler.run()
+
+        assert_true(all(result['success'] for result in results))
+        assert_equal(cli.max_running['backup0.com'], 1)
+        assert_equal(cli.max_running['backup1.com'], 1)
+        assert_equal(scheduler.running_per_host,
+                     {'backup0.com': 0, 'backup1.com': 0})
+
+    def test_failed_jobs_are_reported_in_summary(self):
+        cli = CommandLineConcurrencyRecorder(failing_host='backup1.com')
+        arguments = ['--max-jobs-per-host', '2']
+        scheduler = self.create_scheduler(arguments, cli)
+        results = scheduler.run()
+
+        failed = [result['job_name'] for result in results
+                  if not result['success']]
+        assert_equal(failed, ['job-1', 'job-3', 'job-5'])
+        summary = scheduler.get_summary(results)
+        assert_true('3 succeeded, 3 failed' in summary)
+        assert_true('[FAILED] job-1 -> user@backup1.com:/backups/1' in summary)
+        assert_true('Connection refused' in summary)
+
+    def test_jobs_run_with_the_default_command_line_library(self):
+        path = tempfile.mkdtemp()
+        bin_path = os.path.join(path, 'bin')
+        os.mkdir(bin_path)
+        rsync = os.path.join(bin_path, 'rsync')
+        with open(rsync, 'w') as rsync_file:
+            rsync_file.write('#!/bin/sh\nexit 0\n')
+        os.chmod(rsync, 0o755)
+        destinations = []
+        jobs = []
+        for index in range(2):
+            destination = os.path.join(path, 'backups-{0}'.format(index))
+            os.makedirs(os.path.join(destination, 'latest'))
+            destinations.append(destination)
+            jobs.append(textwrap.dedent('''
+                [job-{0}]
+                source = /local/files-{0}
+                destination = user@backup.test:{1}
+                '''.format(index, destination)))
+        with open(self.config_file, 'w') as config:
+            config.write(''.join(jobs))
+        sys.argv = ['./roundrobinbackup.py', '--config', self.config_file]
+        ssh_path = os.path.join(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))), 'benchmarks', 'bin')
+        environment_path = os.environ['PATH']
+        os.environ['PATH'] = os.pathsep.join([bin_path, ssh_path,
+                                              environment_path])
+        try:
+            scheduler = RoundRobinBackupScheduler(
+                RoundRobinBackup().get_options())
+            results = scheduler.run()
+            names = [sorted(os.listdir(destination))
+                     for destination in destinations]
+        finally:
+            os.environ['PATH'] = environment_path
+            shutil.rmtree(path)
+        assert_equal([result['error'] for result in results], [None, None])
+        archive = 'automated-backup-{0}.tar.bzip2'.format(date.today())
+        assert_equal(names, [[archive, 'latest']] * 2)
@@ -0,0 +1,50 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.aimdcontroller \
+# --nocapture ./tests
+
+from nose.tools import *
+from utilities.aimdcontroller import AIMDController
+
+
+class TestAIMDController:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.controller = AIMDController({'minimum': 2, 'maximum': 8})
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def record_round(self, rate):
+        for index in range(self.controller.get_level()):
+            level = self.controller.record(rate)
+        return level
+
+    def test_level_increases_by_one_per_round_up_to_maximum(self):
+        levels = [self.record_round(100) for index in range(8)]
+        assert_equal(levels, [3, 4, 5, 6, 7, 8, 8, 8])
+
+    def test_level_is_halved_when_throughput_drops(self):
+        for index in range(4):
+            self.record_round(100)
+        assert_equal(self.controller.get_level(), 6)
+        # Six workers at 50 each are 300, below five at 100 each
+        assert_equal(self.record_round(50), 3)
+        assert_equal(self.record_round(10), 2)
+        history = self.controller.get_history()
+        assert_equal([entry['level'] for entry in history],
+                     [2, 3, 4, 5, 6, 3, 2])
+        assert_equal(history[0]['throughput'], None)
+        assert_equal(history[-2]['throughput'], 300)
+
+    def test_drops_within_tolerance_keep_increasing(self):
+        self.record_round(100)
+        # Three workers at 62 are 186, within 10% of two at 100
+        assert_equal(self.record_round(62), 4)
+
+    def test_bounds_are_ordered(self):
+        controller = AIMDController({'minimum': 4, 'maximum': 2})
+        assert_equal(controller.get_level(), 4)
+        controller.record(1)
+        assert_equal(controller.get_level(), 4)
@@ -0,0 +1,76 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.archivewriter \
+# --nocapture ./tests
+
+import gzip
+import io
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+from nose.tools import *
+from utilities.archivewriter import ParallelArchiveWriter
+
+
+class TestParallelArchiveWriter:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.path = tempfile.mkdtemp()
+        self.source = os.path.join(self.path, 'latest')
+        os.makedirs(os.path.join(self.source, 'directory'))
+        self.content = os.urandom(50000) + b'x' * 200000
+        with open(os.path.join(self.source, 'directory', 'file'), 'wb') as f:
+            f.write(self.content)
+        os.link(os.path.join(self.source, 'directory', 'file'),
+                os.path.join(self.source, 'hardlink'))
+        os.symlink('directory/file', os.path.join(self.source, 'symlink'))
+        self.archive = os.path.join(self.path, 'archive.tar.bzip2')
+
+    def teardown(self):
+        "Tear down test fixtures"
+        shutil.rmtree(self.path)
+
+    def write(self, **options):
+        options.setdefault('block_size', 65536)
+        writer = ParallelArchiveWriter(options)
+        return writer.write(self.source, self.archive)
+
+    def assert_archive(self, tar_data):
+        tar = tarfile.open(fileobj=io.BytesIO(tar_data), mode='r:')
+        members = dict((member.name, member) for member in tar.getmembers())
+        assert_equal(sorted(members), [
+            'latest', 'latest/directory', 'latest/directory/file',
+            'latest/hardlink', 'latest/symlink'
+        ])
+        assert_equal(tar.extractfile('latest/directory/file').read(),
+                     self.content)
+        assert_true(members['latest/hardlink'].islnk())
+        assert_equal(members['latest/symlink'].linkname, 'directory/file')
+
+    def test_bzip2_archive_of_many_streams_is_read_by_bunzip2(self):
+        sizes = self.write(processes=3)
+        tar_data = subprocess.Popen(['bunzip2', '-c', self.archive],
+                                    stdout=subprocess.PIPE).communicate()[0]
+        self.assert_archive(tar_data)
+        with open(self.archive, 'rb') as archive_file:
+            assert_true(archive_file.read().count(b'BZh9') > 2)
+        assert_equal(sizes['size'], os.path.getsize(self.archive))
+        assert_equal(sizes['tar_bytes'], len(tar_data))
+        assert_equal(sorted(os.listdir(self.path)),
+                     ['archive.tar.bzip2', 'latest'])
+
+    def test_gzip_archive_in_a_single_process(self):
+        self.write(codec='pigz', level=1, processes=1)
+        self.assert_archive(gzip.open(self.archive).read())
+
+    def test_failed_archive_leaves_no_partial_file(self):
+        writer = ParallelArchiveWriter({'processes': 2})
+        missing = os.path.join(self.path, 'missing')
+        assert_raises(OSError, writer.write, missing, self.archive)
+        assert_equal(os.listdir(self.path), ['latest'])
+
+    def test_unsupported_codec_raises_exception(self):
+        assert_raises(Exception, ParallelArchiveWriter, {'codec': 'zstd'})
@@ -0,0 +1,101 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.asynccommandline \
+# --nocapture ./tests
+
+import os
+import time
+from nose.tools import *
+from utilities.asynccommandline import AsyncCommand, AsyncCommandLine
+
+
+class TestAsyncCommandLine:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.cli = AsyncCommandLine()
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_execute_returns_stdout(self):
+        result = self.cli.execute(['echo', 'hello'])
+        assert_equal(result, 'hello\n')
+
+    def test_execute_raises_error_on_failure(self):
+        assert_raises(Exception, self.cli.execute, ['false'])
+
+    def test_execute_with_return_boolean(self):
+        assert_true(self.cli.execute(['true'], return_boolean=True))
+        assert_false(self.cli.execute(['false'], return_boolean=True))
+
+    def test_invalid_command_raises_error(self):
+        assert_raises(Exception, self.cli.execute, 'echo hello')
+
+    def test_submitted_commands_run_concurrently(self):
+        started = time.time()
+        commands = [self.cli.submit(['sleep', '0.3']) for i in range(10)]
+        self.cli.wait(commands)
+        assert_true(time.time() - started < 2)
+        assert_true(all(command.done() for command in commands))
+
+    def test_large_output_from_many_commands(self):
+        command = ['head', '-c', '300000', '/dev/zero']
+        commands = [self.cli.submit(command) for i in range(5)]
+        for async_command in commands:
+            assert_equal(len(async_command.result()), 300000)
+
+    def test_done_callback_receives_command(self):
+        finished = []
+        async_command = self.cli.submit(['echo', 'hello'])
+        async_command.add_done_callback(finished.append)
+        async_command.wait()
+        time.sleep(0.05)
+        assert_equal(finished, [async_command])
+
+    def test_finished_command_has_resource_usage(self):
+        async_command = self.cli.submit(['true'])
+        async_command.result()
+        assert_true('max_rss_kb' in async_command.rusage)
+
+    def test_from_callable_wraps_exceptions(self):
+        def failing():
+            raise Exception('failed')
+        async_command = AsyncCommand.from_callable(['noop'], failing)
+        assert_true(async_command.done())
+        assert_raises(Exception, async_command.result)
+
+    def test_failing_callback_is_forwarded_to_result(self):
+        def failing(finished_command):
+            raise Exception('callback failed')
+        async_command = self.cli.submit(['sleep', '0.1'])
+        async_command.add_done_callback(failing)
+        assert_raises(Exception, async_command.result, 5)
+        assert_equal(str(async_command.error), 'callback failed')
+        assert_equal(self.cli.execute(['echo', 'next']), 'next\n')
+
+    def test_run_returns_command_result(self):
+        result = self.cli.run(['sh', '-c', 'echo out; echo err >&2; exit 3'])
+        assert_equal(result.stdout, 'out\n')
+        assert_equal(result.stderr, 'err\n')
+        assert_equal(result.returncode, 3)
+        assert_true(result.duration >= 0)
+        assert_true('max_rss_kb' in result.rusage)
+
+    def test_command_line_contract(self):
+        assert_equal(list(self.cli.execute_lines(['printf', 'a\\nb\\n'])),
+                     ['a', 'b'])
+        assert_equal(self.cli.execute_queue([['printf', 'b\\na\\n'],
+                                             ['sort']]), 'a\nb\n')
+        pipeline = self.cli.execute_pipeline([['true'], ['cat']])
+        assert_true(pipeline.is_success())
+
+    def test_children_do_not_inherit_unrelated_descriptors(self):
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, 100)
+        try:
+            output = self.cli.execute(['ls', '/proc/self/fd'])
+        finally:
+            for fd in [read_fd, write_fd, 100]:
+                os.close(fd)
+        assert_false('100' in output.split())
@@ -0,0 +1,49 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.atomicfile \
+# --nocapture ./tests
+
+import os
+import shutil
+import stat
+import tempfile
+import threading
+from nose.tools import *
+from utilities.atomicfile import AtomicFile
+
+
+class TestAtomicFile:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.path = tempfile.mkdtemp()
+        self.fullpath = os.path.join(self.path, 'metrics.prom')
+
+    def teardown(self):
+        "Tear down test fixtures"
+        shutil.rmtree(self.path)
+
+    def read(self):
+        with open(self.fullpath) as written_file:
+            return written_file.read()
+
+    def test_write_replaces_content_and_keeps_mode(self):
+        AtomicFile().write(self.fullpath, 'first\n')
+        assert_equal(stat.S_IMODE(os.stat(self.fullpath).st_mode), 0o644)
+        os.chmod(self.fullpath, 0o640)
+        AtomicFile().write(self.fullpath, 'second\n')
+        assert_equal(self.read(), 'second\n')
+        assert_equal(stat.S_IMODE(os.stat(self.fullpath).st_mode), 0o640)
+        assert_equal(os.listdir(self.path), ['metrics.prom'])
+
+    def test_threads_writing_the_same_path_do_not_collide(self):
+        contents = ['{0}\n'.format(index) * 10000 for index in range(8)]
+        threads = [threading.Thread(target=AtomicFile().write,
+                                    args=(self.fullpath, content))
+                   for content in contents]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert_true(self.read() in contents)
+        assert_equal(os.listdir(self.path), ['metrics.prom'])
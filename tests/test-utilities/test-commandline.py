@@ -0,0 +1,112 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.commandline \
+# --nocapture ./tests
+
+import os
+import subprocess
+import textwrap
+from nose.plugins.skip import SkipTest
+from nose.tools import *
+from utilities.commandline import CommandLine
+
+
+class TestCommandLine:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.cli = CommandLine()
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_execute_returns_stdout(self):
+        result = self.cli.execute(['echo', 'hello'])
+        assert_equal(result, 'hello\n')
+
+    def test_execute_raises_error_on_failure(self):
+        assert_raises(Exception, self.cli.execute, ['false'])
+
+    def test_run_returns_result_with_resource_usage(self):
+        result = self.cli.run(['sh', '-c', 'echo out; echo err >&2; exit 4'])
+        assert_false(result.is_success())
+        assert_equal(result.stdout, 'out\n')
+        assert_equal(result.stderr, 'err\n')
+        assert_equal(result.returncode, 4)
+        assert_true(result.duration >= 0)
+        assert_true(result.rusage['max_rss_kb'] > 0)
+
+    def test_execute_error_carries_result(self):
+        try:
+            self.cli.execute(['sh', '-c', 'exit 5'])
+        except Exception as error:
+            assert_equal(error.returncode, 5)
+            assert_equal(error.result.returncode, 5)
+            assert_true('user_time' in error.result.rusage)
+        else:
+            raise AssertionError('Expected the command to fail')
+
+    def test_children_do_not_inherit_unrelated_descriptors(self):
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, 100)
+        try:
+            output = self.cli.execute(['ls', '/proc/self/fd'])
+        finally:
+            for fd in [read_fd, write_fd, 100]:
+                os.close(fd)
+        assert_false('100' in output.split())
+
+    def test_execute_lines_yields_each_line(self):
+        result = self.cli.execute_lines(['printf', 'a\\nb b\\n\\nc'])
+        assert_equal(list(result), ['a', 'b b', '', 'c'])
+
+    def test_execute_lines_is_lazy(self):
+        result = self.cli.execute_lines(['false'])
+        # Nothing runs until the first record is requested
+        assert_raises(Exception, list, result)
+
+    def test_execute_lines_with_custom_delimiter(self):
+        result = self.cli.execute_lines(['printf', 'a\\0b\\nc\\0'],
+                                        delimiter='\0')
+        assert_equal(list(result), ['a', 'b\nc'])
+
+    def test_execute_lines_error_context_is_bounded(self):
+        command = ['sh', '-c', 'seq 1 1000 >&2; exit 3']
+        result = self.cli.execute_lines(command, error_context_lines=2)
+        try:
+            list(result)
+        except Exception as error:
+            message = str(error)
+        assert_true('999\n1000\n' in message)
+        assert_false('998' in message)
+
+    def test_execute_lines_terminates_process_when_closed_early(self):
+        result = self.cli.execute_lines(['yes'])
+        assert_equal(next(result), 'y')
+        result.close()
+
+    def test_execute_stream_passes_chunks_to_callback(self):
+        chunks = []
+        result = self.cli.execute_stream(['printf', 'abc'], chunks.append)
+        assert_true(result)
+        assert_equal(''.join(chunks), 'abc')
+
+    def test_execute_lines_yields_strings_on_python_3(self):
+        'Records split across reads must not mix bytes and strings'
+        program = textwrap.dedent('''
+            from utilities.commandline import CommandLine
+            command = ['sh', '-c', 'printf "a\\\\0b"; sleep 0.1; '
+                       'printf "c\\\\0d\\\\303\\\\251"']
+            records = CommandLine().execute_lines(command, delimiter='\\0')
+            print(ascii(list(records)))
+            ''')
+        try:
+            process = subprocess.Popen(['python3', '-c', program],
+                                       stdout=subprocess.PIPE,
+                                       stderr=subprocess.PIPE,
+                                       cwd=os.getcwd())
+        except OSError:
+            raise SkipTest('Python 3 is not installed')
+        stdout, stderr = process.communicate()
+        assert_equal(process.returncode, 0, stderr)
+        assert_equal(stdout.decode('utf-8'), "['a', 'bc', 'd\\xe9']\n")
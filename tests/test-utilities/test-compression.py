@@ -0,0 +1,73 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.compression \
+# --nocapture ./tests
+
+from nose.tools import *
+from utilities.compression import CompressionCommand
+
+
+class TestCompressionCommand:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.command = CompressionCommand()
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_default_codec_is_bzip2(self):
+        result = self.command.create({})
+        expected = ['bzip2', '-c']
+        assert_equal(result, expected)
+
+    def test_multithreaded_codec_uses_all_cores(self):
+        options = {
+            'codec': 'zstd',
+        }
+        result = self.command.create(options)
+        expected = ['zstd', '-c', '-q', '-T0']
+        assert_equal(result, expected)
+
+    def test_with_level_option(self):
+        options = {
+            'codec': 'xz',
+            'level': 6
+        }
+        result = self.command.create_command_string(options)
+        expected = 'xz -c -T0 -6'
+        assert_equal(result, expected)
+
+    def test_none_codec_returns_empty_command(self):
+        options = {
+            'codec': 'none',
+            'level': 9
+        }
+        result = self.command.create(options)
+        assert_equal(result, [])
+
+    def test_invalid_level_raises_error(self):
+        options = {
+            'codec': 'gzip',
+            'level': 15
+        }
+        assert_raises(Exception, self.command.create, options)
+
+    def test_unknown_codec_raises_error(self):
+        options = {
+            'codec': 'rar',
+        }
+        assert_raises(Exception, self.command.create, options)
+
+    def test_parallel_bzip2_codecs_share_extension(self):
+        assert_equal(self.command.get_extension('bzip2'), '.tar.bzip2')
+        assert_equal(self.command.get_extension('pbzip2'), '.tar.bzip2')
+        assert_equal(self.command.get_extension('lbzip2'), '.tar.bzip2')
+        assert_equal(self.command.get_extension('pigz'), '.tar.gz')
+        assert_equal(self.command.get_extension('zstd'), '.tar.zst')
+        assert_equal(self.command.get_extension('none'), '.tar')
+
+    def test_extensions_are_ordered_longest_first(self):
+        result = self.command.get_extensions()
+        assert_equal(result[0], '.tar.bzip2')
+        assert_equal(result[-1], '.tar')
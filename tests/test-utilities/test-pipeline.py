@@ -0,0 +1,94 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.pipeline \
+# --nocapture ./tests
+
+import os
+from nose.tools import *
+from utilities.commandline import CommandLine
+from utilities.pipeline import Pipeline
+
+
+class TestPipeline:
+
+    def setup(self):
+        "Set up test fixtures"
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_output_of_last_stage_is_returned(self):
+        pipeline = Pipeline([['printf', 'b\\na\\n'], ['sort']])
+        pipeline.run()
+        assert_true(pipeline.is_success())
+        assert_equal(pipeline.get_output(), 'a\nb\n')
+
+    def test_every_stage_reports_exit_status(self):
+        pipeline = Pipeline([['sh', '-c', 'echo partial; exit 2'], ['cat']])
+        stages = pipeline.run()
+        assert_equal([stage['returncode'] for stage in stages], [2, 0])
+        assert_false(pipeline.is_success())
+        assert_true('Stage 0 "sh -c echo partial; exit 2" exited 2'
+                    in pipeline.get_error_message())
+
+    def test_chatty_stderr_does_not_deadlock(self):
+        chatty = ['sh', '-c', 'seq 1 200000 >&2; echo done']
+        pipeline = Pipeline([chatty, ['cat']], error_context_lines=1)
+        stages = pipeline.run()
+        assert_equal(pipeline.get_output(), 'done\n')
+        assert_equal(stages[0]['stderr'], '200000\n')
+
+    def test_stages_report_duration_and_throughput(self):
+        pipeline = Pipeline([['head', '-c', '1000000', '/dev/zero'], ['wc', '-c']])
+        stages = pipeline.run()
+        for stage in stages:
+            assert_true(stage['duration'] >= 0)
+        if os.path.exists('/proc/self/io'):
+            assert_true(stages[0]['bytes_written'] > 0)
+
+    def test_stages_report_resource_usage(self):
+        pipeline = Pipeline([['printf', 'a'], ['cat']])
+        stages = pipeline.run()
+        for stage in stages:
+            assert_true(stage['rusage']['max_rss_kb'] > 0)
+
+    def test_invalid_commands_raise_error(self):
+        assert_raises(Exception, Pipeline, [])
+
+    def test_stages_do_not_inherit_unrelated_descriptors(self):
+        read_fd, write_fd = os.pipe()
+        os.dup2(write_fd, 100)
+        try:
+            pipeline = Pipeline([['ls', '/proc/self/fd'], ['cat']])
+            pipeline.run()
+        finally:
+            for fd in [read_fd, write_fd, 100]:
+                os.close(fd)
+        assert_false('100' in pipeline.get_output().split())
+
+    def test_failed_start_stops_the_started_stages(self):
+        pipeline = Pipeline([['sleep', '30'], ['/nonexistent/command']])
+        assert_raises(OSError, pipeline.run)
+        process = pipeline.stages[0]['process']
+        assert_not_equal(process.returncode, None)
+        assert_true(process.stdout.closed)
+        assert_true(process.stderr.closed)
+
+
+class TestCommandLineQueue:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.cli = CommandLine()
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_failed_first_stage_is_not_reported_as_success(self):
+        commands = [['false'], ['cat']]
+        assert_false(self.cli.execute_queue(commands, return_boolean=True))
+        assert_raises(Exception, self.cli.execute_queue, commands)
+
+    def test_successful_queue_returns_stdout(self):
+        commands = [['echo', 'hello'], ['tr', 'a-z', 'A-Z']]
+        assert_equal(self.cli.execute_queue(commands), 'HELLO\n')
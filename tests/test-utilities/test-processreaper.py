@@ -0,0 +1,54 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.processreaper \
+# --nocapture ./tests
+
+import subprocess
+import sys
+from nose.tools import *
+from utilities.processreaper import ProcessReaper
+
+
+class TestProcessReaper:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.reaper = ProcessReaper()
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_wait_returns_resource_usage_of_child(self):
+        busy_loop = 'import time\nend = time.time() + 0.2\n' \
+                    'while time.time() < end: pass'
+        process = subprocess.Popen([sys.executable, '-c', busy_loop])
+        rusage = self.reaper.wait(process)
+        assert_equal(process.returncode, 0)
+        assert_true(rusage['user_time'] + rusage['system_time'] > 0.1)
+        assert_true(rusage['max_rss_kb'] > 0)
+        for key in ['block_input', 'block_output',
+                    'voluntary_context_switches',
+                    'involuntary_context_switches']:
+            assert_true(key in rusage)
+
+    def test_exit_status_matches_popen(self):
+        process = subprocess.Popen(['sh', '-c', 'exit 3'])
+        self.reaper.wait(process)
+        assert_equal(process.returncode, 3)
+        process = subprocess.Popen(['sh', '-c', 'kill -TERM $$'])
+        self.reaper.wait(process)
+        assert_equal(process.returncode, -15)
+
+    def test_non_blocking_wait_on_running_child_returns_none(self):
+        process = subprocess.Popen(['sleep', '5'])
+        assert_equal(self.reaper.wait(process, block=False), None)
+        assert_equal(process.returncode, None)
+        process.kill()
+        self.reaper.wait(process)
+        assert_equal(process.returncode, -9)
+
+    def test_child_reaped_elsewhere_has_no_resource_usage(self):
+        process = subprocess.Popen(['true'])
+        process.wait()
+        assert_equal(self.reaper.wait(process), {})
+        assert_equal(process.returncode, 0)
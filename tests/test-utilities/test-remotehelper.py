@@ -0,0 +1,245 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.remotehelper \
+# --nocapture ./tests
+
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tarfile
+import tempfile
+from datetime import date, timedelta
+from nose.tools import *
+from lib.backuparchivepruner import BackupArchivePruner
+from lib.optionsparser import OptionsParser
+from tests.mocksandstubs import CommandLineRecorder, create_remote_listing
+from utilities import remotehelper
+from utilities.compression import CompressionCommand
+from utilities.remotehelper import RemoteHelper
+
+
+class TestRemoteHelper:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.helper = RemoteHelper()
+        self.path = tempfile.mkdtemp()
+
+    def teardown(self):
+        "Tear down test fixtures"
+        shutil.rmtree(self.path)
+
+    def create_file(self, name, content='x'):
+        fullpath = os.path.join(self.path, name)
+        with open(fullpath, 'w') as created_file:
+            created_file.write(content)
+        return fullpath
+
+    def get_prune_operation(self, **extra):
+        operation = {
+            'op': 'prune',
+            'path': self.path,
+            'prefix': 'automated-backup-',
+            'extensions': CompressionCommand().get_extensions(),
+            'retention': {'days': '6', 'weeks': '5', 'months': '6',
+                          'years': '10', 'current_date': '2005-01-01'},
+            'mode': 'delete',
+            'trash_path': os.path.join(self.path, '.trash'),
+            'sizes': True
+        }
+        operation.update(extra)
+        return operation
+
+    def test_operations_run_in_order_with_timings(self):
+        archive = os.path.join(self.path, 'new', 'archive.tar')
+        self.create_file('source', 'data')
+        output = self.helper.run({'operations': [
+            {'op': 'mkdir', 'path': os.path.dirname(archive)},
+            {'op': 'archive', 'path': archive,
+             'command': '/bin/tar -C {0} -cf {1} source'.format(self.path,
+                                                                archive)},
+            {'op': 'fsync', 'paths': [archive]},
+            {'op': 'checksum', 'path': archive}
+        ]})
+        results = output['results']
+        assert_equal([result['op'] for result in results],
+                     ['mkdir', 'archive', 'fsync', 'checksum'])
+        assert_true(all(result['success'] for result in results))
+        assert_true(all(result['duration'] >= 0 for result in results))
+        with open(archive, 'rb') as archive_file:
+            content = archive_file.read()
+        assert_equal(results[1]['size'], len(content))
+        assert_equal(results[3]['checksum'],
+                     hashlib.sha256(content).hexdigest())
+
+    def test_write_archive_without_external_tools(self):
+        os.mkdir(os.path.join(self.path, 'latest'))
+        self.create_file(os.path.join('latest', 'file'), 'data')
+        archive = os.path.join(self.path, 'archive.tar.gz')
+        output = self.helper.run({'operations': [
+            {'op': 'write_archive', 'source': os.path.join(self.path, 'latest'),
+             'arcname': 'latest', 'path': archive, 'codec': 'gzip',
+             'level': None, 'processes': 2}
+        ]})
+        result = output['results'][0]
+        assert_true(result['success'])
+        assert_equal(result['size'], os.path.getsize(archive))
+        tar = tarfile.open(archive)
+        assert_equal(tar.getnames(), ['latest', 'latest/file'])
+        tar.close()
+
+    def test_list_returns_entry_metadata(self):
+        self.create_file('name with\nnewline', '12345')
+        os.mkdir(os.path.join(self.path, 'directory'))
+        output = self.helper.run({'operations': [
+            {'op': 'list', 'path': self.path}
+        ]})
+        entries = sorted(output['results'][0]['entries'],
+                         key=lambda entry: entry['name'])
+        assert_equal([(entry['name'], entry['type']) for entry in entries],
+                     [('directory', 'd'), ('name with\nnewline', 'f')])
+        assert_equal(entries[1]['size'], 5)
+        assert_true(entries[1]['mtime'] > 0)
+
+    def test_failed_operation_skips_the_rest(self):
+        output = self.helper.run({'operations': [
+            {'op': 'archive', 'command': 'echo broken >&2; exit 3',
+             'path': os.path.join(self.path, 'missing')},
+            {'op': 'mkdir', 'path': os.path.join(self.path, 'skipped')},
+            {'op': 'unknown'}
+        ]})
+        archive, mkdir, unknown = output['results']
+        assert_false(archive['success'])
+        assert_true('exited 3' in archive['error'])
+        assert_true('broken' in archive['error'])
+        assert_true(mkdir['skipped'])
+        assert_true(unknown['skipped'])
+        assert_false(os.path.exists(os.path.join(self.path, 'skipped')))
+
+    def test_failed_tar_publishes_no_archive(self):
+        archive = os.path.join(self.path, 'archive.tar.gz')
+        command = "/bin/bash -c 'set -o pipefail && /bin/tar -C {0} -cf - " \
+                  "missing | gzip -c > {1}.partial' && /bin/mv {1}.partial " \
+                  "{1}".format(self.path, archive)
+        output = self.helper.run({'operations': [
+            {'op': 'archive', 'command': command, 'path': archive}
+        ]})
+        assert_false(output['results'][0]['success'])
+        assert_equal(os.listdir(self.path), [])
+
+    def test_sizes_rename_and_remove(self):
+        archive = self.create_file('archive.tar', '1234')
+        os.mkdir(os.path.join(self.path, 'snapshot'))
+        self.create_file(os.path.join('snapshot', 'file'), '123456')
+        renamed = os.path.join(self.path, 'renamed.tar')
+        missing = os.path.join(self.path, 'missing')
+        output = self.helper.run({'operations': [
+            {'op': 'sizes', 'paths': [archive]},
+            {'op': 'rename', 'source': archive, 'path': renamed},
+            {'op': 'remove', 'paths': [renamed, missing,
+                                       os.path.join(self.path, 'snapshot')],
+             'delays': [0, 0.01]}
+        ]})
+        sizes, rename, remove = output['results']
+        assert_equal(sizes['sizes'], {archive: 4})
+        assert_true(rename['success'])
+        assert_equal(len(remove['removed']), 2)
+        assert_equal([failure['path'] for failure in remove['failed']],
+                     [missing])
+        assert_equal(os.listdir(self.path), [])
+
+    def test_unknown_operation_fails(self):
+        output = self.helper.run({'operations': [{'op': 'unknown'}]})
+        assert_true('Unknown remote helper operation' in
+                    output['results'][0]['error'])
+
+    def test_prune_moves_stale_archives_to_trash(self):
+        for backup_date in ['1996-01-21', '2004-02-21']:
+            self.create_file('automated-backup-{0}.tar.gz'.format(backup_date),
+                             '1234')
+        self.create_file('automated-backup-2004-02-22.tar.gz.partial')
+        self.create_file('automated-backup-2005-01-01.tar.gz.partial')
+        operation = self.get_prune_operation(mode='trash')
+        result = self.helper.run({'operations': [operation]})['results'][0]
+        stale_archives = [os.path.join(self.path, name) for name in [
+            'automated-backup-2004-02-21.tar.gz',
+            'automated-backup-2004-02-22.tar.gz.partial'
+        ]]
+        assert_equal(sorted(result['removed']), stale_archives)
+        assert_equal(result['failed'], [])
+        assert_equal(result['pruned_bytes'], 5)
+        assert_equal(result['retained_count'], 1)
+        assert_equal(sorted(os.listdir(os.path.join(self.path, '.trash'))),
+                     ['automated-backup-2004-02-21.tar.gz',
+                      'automated-backup-2004-02-22.tar.gz.partial'])
+        assert_true(os.path.exists(os.path.join(
+            self.path, 'automated-backup-2005-01-01.tar.gz.partial'
+        )))
+
+    def test_prune_matches_backup_archive_pruner(self):
+        'Both must remove exactly the same archives'
+        names = []
+        day = date(2005, 1, 1)
+        for i in range(400):
+            marker = '' if day.isoweekday() == 1 else '.incremental'
+            names.append('automated-backup-{0}{1}.tar.bzip2'.format(
+                day.isoformat(), marker
+            ))
+            day = day - timedelta(days=3)
+        names.append('automated-backup-2001-01-01')
+        names.append('automated-backup-2004-12-31.tar.gz.partial')
+        names.append('automated-backup-2005-01-01.tar.gz.partial')
+        names.append('unrelated-file')
+        for name in names:
+            self.create_file(name)
+
+        options = OptionsParser().get_options([
+            '/local/files', 'user@target.com:{0}'.format(self.path),
+            '--date', '2005-01-01'
+        ])
+        pruner = BackupArchivePruner()
+        pruner.set_options(options)
+        pruner.set_command_line_library(CommandLineListing(names))
+        pruner._get_existing_backups()
+        pruner._classify_existing_backups()
+
+        operation = self.get_prune_operation()
+        result = self.helper.run({'operations': [operation]})['results'][0]
+        assert_true(len(pruner.files_to_remove) > 100)
+        assert_equal(sorted(result['removed']), sorted(pruner.files_to_remove))
+        assert_true(os.path.join(self.path, 'automated-backup-2004-12-31'
+                                 '.tar.gz.partial') in result['removed'])
+        assert_false(os.path.join(self.path, 'automated-backup-2005-01-01'
+                                  '.tar.gz.partial') in result['removed'])
+
+    def test_shipped_program_runs_from_stdin(self):
+        'As piped to python - on the destination, outside this package'
+        program = BackupArchivePruner()._get_remote_helper_program()
+        self.create_file('automated-backup-2004-02-21.tar.gz')
+        self.create_file('automated-backup-2004-02-22.tar.gz')
+        batch = remotehelper.encode_batch({'operations': [
+            self.get_prune_operation()
+        ]})
+        process = subprocess.Popen([sys.executable, '-', batch],
+                                   cwd=self.path, stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        stdout, _ = process.communicate(program.encode('utf-8'))
+        assert_equal(process.returncode, 0)
+        result = json.loads(stdout.decode('utf-8'))['results'][0]
+        assert_true(result['success'])
+        assert_equal(result['removed'], [os.path.join(
+            self.path, 'automated-backup-2004-02-22.tar.gz'
+        )])
+
+
+class CommandLineListing(CommandLineRecorder):
+    ' Lists the given names and records every other command '
+    def __init__(self, names):
+        CommandLineRecorder.__init__(self)
+        self.names = names
+
+    def execute_lines(self, command, **extra_params_not_used_in_testing):
+        return iter(create_remote_listing(self.names).split('\0'))
@@ -0,0 +1,52 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=roundrobindate ./tests
+
+from nose.tools import *
+from utilities.roundrobindate import RoundRobinBackupClassifier
+
+
+class TestRoundRobinBackupClassifier():
+
+    def setup(self):
+        "Set up test fixtures"
+        self.classifier = RoundRobinBackupClassifier({
+            "current_date": "2012-05-30",
+            "days_to_retain": 2,
+            "weeks_to_retain": 0,
+            "months_to_retain": 0,
+            "years_to_retain": 0
+        })
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def create_backups(self, dates, incremental_dates=()):
+        return [{"date": backup_date,
+                 "incremental": backup_date in incremental_dates}
+                for backup_date in dates]
+
+    def test_is_backup_date(self):
+        assert_true(self.classifier.is_backup_date("2012-05-30"))
+        assert_false(self.classifier.is_backup_date("2012-05-30-notes"))
+        assert_false(self.classifier.is_backup_date("latest"))
+
+    def test_oldest_backup_and_retained_dates_are_kept(self):
+        backups = self.create_backups(["2012-05-30", "2012-05-27",
+                                       "2012-05-20", "2012-05-01"])
+        stale_backups = self.classifier.get_stale_backups(backups)
+        assert_equal([backup["date"] for backup in stale_backups],
+                     ["2012-05-27", "2012-05-20"])
+
+    def test_full_backups_of_kept_incremental_backups_are_kept(self):
+        backups = self.create_backups(
+            ["2012-05-30", "2012-05-29", "2012-05-25", "2012-05-20",
+             "2012-05-01"],
+            incremental_dates=["2012-05-30", "2012-05-29"]
+        )
+        stale_backups = self.classifier.get_stale_backups(backups)
+        assert_equal([backup["date"] for backup in stale_backups],
+                     ["2012-05-20"])
+
+    def test_no_backups_keep_no_dates(self):
+        assert_equal(self.classifier.get_dates_to_keep([]), set())
@@ -462,3 +462,70 @@ class TestRoundRobinDate():
             '2012-05-31', # Final Day
         ])
         assert_equal(results_set, expected)
+
+    def test_classify_reports_first_retaining_tier(self):
+        new_options = {
+            "current_date": "2012-05-30",
+            "anchor_date": "2011-05-23",
+            "days_to_retain": 6,
+            "weeks_to_retain": 5,
+            "months_to_retain": 6,
+            "years_to_retain": 2
+        }
+        self.rrd.set_options(new_options)
+
+        assert_equal(self.rrd.classify("2012-05-30"), "today")
+        assert_equal(self.rrd.classify("2012-05-24"), "day")
+        assert_equal(self.rrd.classify(date(2012, 5, 14)), "week")
+        assert_equal(self.rrd.classify("2012-01-23"), "month")
+        assert_equal(self.rrd.classify("2011-05-23"), "year")
+        assert_equal(self.rrd.classify("2012-05-23"), "month")
+        assert_equal(self.rrd.classify("2012-05-22"), None)
+        assert_equal(self.rrd.classify("2012-05-31"), None)
+        assert_false(self.rrd.is_retained("2010-05-23"))
+        assert_true(self.rrd.is_retained("2011-05-23"))
+
+    def test_is_retained_agrees_with_get_dates(self):
+        option_sets = [
+            {"days_to_retain": 6, "weeks_to_retain": 5,
+             "months_to_retain": 6, "years_to_retain": 2,
+             "anchor_date": "2011-05-23"},
+            {"days_to_retain": 0, "weeks_to_retain": 3,
+             "months_to_retain": 0, "years_to_retain": 3,
+             "anchor_date": "2010-02-28"},
+            {"days_to_retain": 10, "weeks_to_retain": 0,
+             "months_to_retain": 13, "years_to_retain": 0,
+             "backup_day_of_week": 7, "backup_day_of_month": 15}
+        ]
+        for options in option_sets:
+            self.rrd = RoundRobinDate(options)
+            for i in xrange(0, 800, 23):
+                current_date = date(2011, 5, 23) + timedelta(days=i)
+                self.rrd.set_options({"current_date": current_date})
+                expected = set(self.rrd.get_dates_as_strings())
+                start_date = current_date - timedelta(days=4 * 366)
+                retained = set()
+                for j in xrange((current_date - start_date).days + 30):
+                    candidate = start_date + timedelta(days=j)
+                    if self.rrd.is_retained(candidate):
+                        retained.add(candidate.isoformat())
+                assert_equal(retained, expected)
+
+    def test_iter_retained_dates_is_lazy_and_ordered(self):
+        new_options = {
+            "current_date": "2012-05-30",
+            "days_to_retain": 6,
+            "weeks_to_retain": 5,
+            "months_to_retain": 6,
+            "years_to_retain": 1000000
+        }
+        self.rrd.set_options(new_options)
+
+        retained_dates = self.rrd.iter_retained_dates()
+        newest = [next(retained_dates) for i in xrange(3)]
+        assert_equal(newest, [date(2012, 5, 30), date(2012, 5, 29),
+                              date(2012, 5, 28)])
+        # Yearly dates stop at the first year the date type supports
+        all_dates = list(retained_dates)
+        assert_equal(all_dates, sorted(set(all_dates), reverse=True))
+        assert_equal(all_dates[-1], date(1, 1, 1))
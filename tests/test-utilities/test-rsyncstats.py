@@ -0,0 +1,63 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.rsyncstats \
+# --nocapture ./tests
+
+import textwrap
+from nose.tools import *
+from utilities.rsyncstats import RsyncStatsParser
+
+
+class TestRsyncStatsParser:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.parser = RsyncStatsParser()
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_parses_rsync_3_stats(self):
+        output = textwrap.dedent('''
+            Number of files: 3,302 (reg: 3,000, dir: 302)
+            Number of created files: 0
+            Number of deleted files: 0
+            Number of regular files transferred: 7
+            Total file size: 1,234,567 bytes
+            Total transferred file size: 8,910 bytes
+            Literal data: 8,910 bytes
+            Matched data: 0 bytes
+            File list size: 65,536
+            Total bytes sent: 120,003
+            Total bytes received: 1,480
+
+            sent 120,003 bytes  received 1,480 bytes  243,966.00 bytes/sec
+            total size is 1,234,567  speedup is 10.16
+            ''')
+        expected = {
+            'files': 3302,
+            'files_transferred': 7,
+            'total_file_size': 1234567,
+            'transferred_file_size': 8910,
+            'bytes_sent': 120003,
+            'bytes_received': 1480,
+            'speedup': 10.16
+        }
+        assert_equal(self.parser.parse(output), expected)
+
+    def test_parses_stats_without_thousands_separators(self):
+        output = textwrap.dedent('''
+            Number of files: 12
+            Number of files transferred: 2
+            Total bytes sent: 300
+            Total bytes received: 40
+            total size is 1000  speedup is 2.94
+            ''')
+        returned = self.parser.parse(output)
+        assert_equal(returned['files_transferred'], 2)
+        assert_equal(returned['bytes_sent'], 300)
+        assert_equal(returned['speedup'], 2.94)
+
+    def test_missing_output_returns_no_stats(self):
+        assert_equal(self.parser.parse(''), {})
+        assert_equal(self.parser.parse(None), {})
@@ -3,8 +3,10 @@
 # nosetests --with-coverage --cover-package=lib.sshparser \
 # --nocapture ./tests
 
+import os
 from nose.tools import *
-from utilities.sshutilities import SSHCommand, SSHParser
+from tests.mocksandstubs import CommandLineRecorder
+from utilities.sshutilities import SSHCommand, SSHControlMaster, SSHParser
 
 
 class TestSSHCommand:
@@ -74,6 +76,24 @@ class TestSSHCommand:
         expected = ['ssh', 'myuser@example.com', 'ls -la']
         assert_equal(result, expected)
 
+    def test_subcommand_wrapping_quotes_are_removed(self):
+        options = {
+            'host': 'example.com',
+            'subcommand': '"ls -la"'
+        }
+        result = self.command.create(options)
+        assert_equal(result, ['ssh', 'example.com', 'ls -la'])
+
+    def test_subcommand_inner_quotes_are_kept(self):
+        options = {
+            'host': 'example.com',
+            'subcommand': "rm -r '/backups/with space' /backups/plain"
+        }
+        result = self.command.create(options)
+        expected = ['ssh', 'example.com',
+                    "rm -r '/backups/with space' /backups/plain"]
+        assert_equal(result, expected)
+
     def test_with_all_options(self):
         options = {
             'user': 'myuser',
@@ -99,6 +119,68 @@ class TestSSHCommand:
         expected = 'ssh myuser@example.com -p 2222 -i /path/to/file ls -la'
         assert_equal(result, expected)
 
+    def test_with_control_path_option(self):
+        options = {
+            'user': 'myuser',
+            'host': 'example.com',
+            'port': '2222',
+            'control_path': '/tmp/master',
+            'subcommand': 'ls -la'
+        }
+        result = self.command.create(options)
+        expected = ['ssh', 'myuser@example.com', '-p', '2222', '-o',
+                    'ControlPath=/tmp/master', 'ls -la']
+        assert_equal(result, expected)
+
+
+class TestSSHControlMaster:
+
+    def setup(self):
+        "Set up test fixtures"
+        options = {
+            'user': 'myuser',
+            'host': 'example.com',
+            'port': '2222',
+        }
+        self.master = SSHControlMaster(options)
+        self.cli = CommandLineRecorder()
+
+    def teardown(self):
+        "Tear down test fixtures"
+        self.master.close(self.cli)
+
+    def test_open_starts_persistent_master(self):
+        control_path = self.master.open(self.cli)
+        assert_true(os.path.isdir(os.path.dirname(control_path)))
+        expected = ['ssh', 'myuser@example.com', '-p', '2222', '-o',
+                    'ControlPath={0}'.format(control_path), '-o',
+                    'ControlMaster=yes', '-o', 'ControlPersist=yes',
+                    '-f', '-N']
+        assert_equal(self.cli.commands, [expected])
+
+    def test_open_failure_raises_and_removes_control_dir(self):
+        class CommandLineFailure(CommandLineRecorder):
+            def execute(self, command, stdout=None, **extra):
+                stdout.write(b'Permission denied (publickey).')
+                raise Exception('Stdout: None | Stderr: None')
+
+        assert_raises(Exception, self.master.open, CommandLineFailure())
+        assert_equal(self.master.get_control_path(), '')
+        assert_equal(self.master.control_dir, '')
+
+    def test_close_exits_master_and_removes_control_dir(self):
+        control_path = self.master.open(self.cli)
+        self.master.close(self.cli)
+        expected = ['ssh', 'myuser@example.com', '-p', '2222', '-o',
+                    'ControlPath={0}'.format(control_path), '-O', 'exit']
+        assert_equal(self.cli.commands[-1], expected)
+        assert_false(os.path.exists(os.path.dirname(control_path)))
+        assert_equal(self.master.get_control_path(), '')
+
+    def test_close_without_open_is_a_noop(self):
+        self.master.close(self.cli)
+        assert_equal(self.cli.commands, [])
+
 
 class TestSSHParser:
 
@@ -0,0 +1,72 @@
+# -*- coding: utf8 -*-
+
+# nosetests --with-coverage --cover-package=utilities.timedcommandline \
+# --nocapture ./tests
+
+from nose.tools import *
+from tests.mocksandstubs import CommandLineRecorder
+from utilities.asynccommandline import AsyncCommandLine
+from utilities.commandline import CommandLine
+from utilities.timedcommandline import TimedCommandLine
+
+
+class TestTimedCommandLine:
+
+    def setup(self):
+        "Set up test fixtures"
+        self.cli = TimedCommandLine(CommandLine())
+
+    def teardown(self):
+        "Tear down test fixtures"
+
+    def test_records_successful_command(self):
+        result = self.cli.execute(['echo', 'hello'])
+        assert_equal(result, 'hello\n')
+        commands = self.cli.get_commands()
+        assert_equal(len(commands), 1)
+        assert_equal(commands[0]['command'], 'echo hello')
+        assert_equal(commands[0]['success'], True)
+        assert_equal(commands[0]['returncode'], 0)
+        assert_true(commands[0]['duration'] >= 0)
+        assert_true(commands[0]['rusage']['max_rss_kb'] > 0)
+
+    def test_records_exit_status_of_failed_command(self):
+        assert_raises(Exception, self.cli.execute, ['sh', '-c', 'exit 3'])
+        commands = self.cli.get_commands()
+        assert_equal(commands[0]['success'], False)
+        assert_equal(commands[0]['returncode'], 3)
+
+    def test_records_boolean_failure(self):
+        result = self.cli.execute(['false'], return_boolean=True)
+        assert_equal(result, False)
+        assert_equal(self.cli.get_commands()[0]['success'], False)
+
+    def test_records_lines_once_consumed(self):
+        lines = self.cli.execute_lines(['printf', 'a\\nb'])
+        assert_equal(self.cli.get_commands(), [])
+        assert_equal(list(lines), ['a', 'b'])
+        assert_equal(self.cli.get_commands()[0]['command'], 'printf a\\nb')
+
+    def test_records_queue_as_one_pipeline(self):
+        self.cli.execute_queue([['echo', 'a'], ['cat']])
+        command = self.cli.get_commands()[0]
+        assert_equal(command['command'], 'echo a | cat')
+        assert_equal([stage['command'] for stage in command['stages']],
+                     ['echo a', 'cat'])
+        assert_true('user_time' in command['stages'][1]['rusage'])
+
+    def test_records_first_failed_stage_of_queue(self):
+        assert_raises(Exception, self.cli.execute_queue,
+                      [['sh', '-c', 'exit 6'], ['cat']])
+        assert_equal(self.cli.get_commands()[0]['returncode'], 6)
+
+    def test_records_submitted_command_when_done(self):
+        cli = TimedCommandLine(AsyncCommandLine())
+        async_command = cli.submit(['sh', '-c', 'exit 2'])
+        assert_raises(Exception, async_command.result)
+        commands = cli.get_commands()
+        assert_equal(commands[0]['returncode'], 2)
+
+    def test_submit_is_only_offered_when_supported(self):
+        cli = TimedCommandLine(CommandLineRecorder())
+        assert_false(hasattr(cli, 'submit'))
@@ -0,0 +1,67 @@
+import time
+
+
+class AIMDController:
+
+    '''
+    Chooses a concurrency level between a minimum and a maximum by additive
+    increase, multiplicative decrease feedback, like TCP's congestion
+    window. Every finished unit of work records the rate it ran at. Once as
+    many have finished as the current level, a round, their mean rate times
+    the level estimates the aggregate throughput. If it fell more than the
+    tolerance below the previous round's, the level is multiplied by the
+    decrease factor, otherwise it grows by the increase.
+
+    Every change of level is kept in the history, with the time elapsed
+    and the throughput that caused it.
+    '''
+
+    def __init__(self, options=None):
+        options = options or {}
+        self.minimum = max(int(options.get('minimum') or 1), 1)
+        self.maximum = max(int(options.get('maximum') or self.minimum),
+                           self.minimum)
+        initial = int(options.get('initial') or self.minimum)
+        self.level = min(max(initial, self.minimum), self.maximum)
+        self.increase = int(options.get('increase') or 1)
+        self.decrease = float(options.get('decrease') or 0.5)
+        self.tolerance = float(options.get('tolerance', 0.1))
+        self.rates = []
+        self.previous_throughput = None
+        self.started = time.time()
+        self.history = [self._create_history_entry(None)]
+
+    def get_level(self):
+        return self.level
+
+    def get_history(self):
+        return [entry.copy() for entry in self.history]
+
+    def record(self, rate):
+        'Records the rate of a finished unit of work, returns the new level'
+        self.rates.append(float(rate))
+        if len(self.rates) < self.level:
+            return self.level
+        throughput = sum(self.rates) / len(self.rates) * self.level
+        self.rates = []
+        level = self._get_next_level(throughput)
+        self.previous_throughput = throughput
+        if level != self.level:
+            self.level = level
+            self.history.append(self._create_history_entry(throughput))
+        return self.level
+
+    def _get_next_level(self, throughput):
+        previous = self.previous_throughput
+        if previous is not None and \
+                throughput < previous * (1 - self.tolerance):
+            return max(int(self.level * self.decrease), self.minimum)
+        return min(self.level + self.increase, self.maximum)
+
+    def _create_history_entry(self, throughput):
+        entry = {
+            'elapsed': time.time() - self.started,
+            'level': self.level,
+            'throughput': throughput
+        }
+        return entry
@@ -0,0 +1,208 @@
+import bz2
+import collections
+import multiprocessing
+import os
+import tarfile
+import zlib
+
+# Eight bzip2 blocks at level 9 per compressed block
+BLOCK_SIZE = 8 * 900 * 1000
+READ_BUFFER_SIZE = 1024 * 1024
+BZIP2_CODECS = ['bzip2', 'pbzip2', 'lbzip2']
+GZIP_CODECS = ['gzip', 'pigz']
+
+
+class ParallelArchiveWriter:
+
+    '''
+    Writes a tar archive of a directory tree with the standard library only,
+    for destinations without GNU tar or parallel compressors. The tree is
+    walked with os.scandir and its members streamed through tarfile, and the
+    tar stream is cut into fixed size blocks compressed by a pool of
+    processes. Every block is a complete bzip2 stream or gzip member, so the
+    concatenated archive is read by bunzip2 and gunzip like one written by
+    pbzip2 or pigz. Memory use is bounded by the blocks in flight, two per
+    process, whatever the size of the tree.
+
+    Runs on Python 2.6+ and 3, and is shipped to the destination with
+    utilities.remotehelper.
+    '''
+
+    codecs = BZIP2_CODECS + GZIP_CODECS + ['none']
+
+    def __init__(self, options=None):
+        options = options or {}
+        self.codec = options.get('codec') or 'bzip2'
+        self.level = options.get('level')
+        self.processes = options.get('processes') or \
+                         multiprocessing.cpu_count()
+        self.block_size = options.get('block_size') or BLOCK_SIZE
+        if self.codec not in self.codecs:
+            raise Exception("The python archive writer does not support the "
+                            "'{0}' codec. Expected one of: {1}".format(
+                            self.codec, ', '.join(self.codecs)))
+
+    def write(self, source, path, arcname=None):
+        '''
+        Archives the source directory as arcname, its basename by default.
+        The archive is written to path.partial and only renamed to path once
+        complete. Returns the sizes of the tar stream and of the archive.
+        '''
+        arcname = arcname or os.path.basename(os.path.normpath(source))
+        partial_path = '{0}.partial'.format(path)
+        try:
+            with open(partial_path, 'wb') as archive_file:
+                stream = CompressedBlockStream(archive_file, {
+                    'codec': self.codec,
+                    'level': self.level,
+                    'processes': self.processes,
+                    'block_size': self.block_size
+                })
+                try:
+                    self._write_tar(source, arcname, stream)
+                    stream.close()
+                finally:
+                    stream.terminate()
+            os.rename(partial_path, path)
+        finally:
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+        return {'tar_bytes': stream.input_bytes, 'size': stream.output_bytes}
+
+    def _write_tar(self, source, arcname, stream):
+        tar = tarfile.open(fileobj=stream, mode='w|', bufsize=READ_BUFFER_SIZE,
+                           format=tarfile.GNU_FORMAT)
+        for fullpath, member_name in self._walk(source, arcname):
+            self._add_member(tar, fullpath, member_name)
+        tar.close()
+
+    def _walk(self, path, arcname):
+        'Depth first, without following symlinks, in name order'
+        yield path, arcname
+        for name, is_directory in self._list_directory(path):
+            fullpath = os.path.join(path, name)
+            member_name = '{0}/{1}'.format(arcname, name)
+            if is_directory:
+                for item in self._walk(fullpath, member_name):
+                    yield item
+            else:
+                yield fullpath, member_name
+
+    def _list_directory(self, path):
+        'os.scandir where available, Python 3.5+, otherwise os.listdir'
+        if hasattr(os, 'scandir'):
+            entries = [(entry.name, entry.is_dir(follow_symlinks=False))
+                       for entry in os.scandir(path)]
+        else:
+            entries = []
+            for name in os.listdir(path):
+                fullpath = os.path.join(path, name)
+                entries.append((name, os.path.isdir(fullpath) and
+                                not os.path.islink(fullpath)))
+        return sorted(entries)
+
+    def _add_member(self, tar, fullpath, member_name):
+        '''
+        File contents are read through a large buffer. Sockets, which tar
+        can not archive either, are skipped.
+        '''
+        tarinfo = tar.gettarinfo(fullpath, member_name)
+        if tarinfo is None:
+            return
+        if not tarinfo.isreg():
+            tar.addfile(tarinfo)
+            return
+        with open(fullpath, 'rb', READ_BUFFER_SIZE) as member_file:
+            tar.addfile(tarinfo, member_file)
+
+
+class CompressedBlockStream:
+
+    '''
+    A write only file object that cuts what is written to it into blocks,
+    compresses them in a pool of processes and writes them in order to
+    fileobj. The pool is forked, so the compressing function is found even
+    when this module runs from stdin on the destination.
+    '''
+
+    def __init__(self, fileobj, options):
+        self.fileobj = fileobj
+        self.codec = options['codec']
+        self.level = options.get('level')
+        self.processes = max(int(options.get('processes') or 1), 1)
+        self.block_size = options['block_size']
+        self.buffer = []
+        self.buffered = 0
+        self.pending = collections.deque()
+        self.input_bytes = 0
+        self.output_bytes = 0
+        self.pool = None
+        if self.processes > 1 and self.codec != 'none':
+            self.pool = self._create_pool()
+
+    def _create_pool(self):
+        context = multiprocessing
+        if hasattr(multiprocessing, 'get_context') and \
+                'fork' in multiprocessing.get_all_start_methods():
+            context = multiprocessing.get_context('fork')
+        return context.Pool(self.processes)
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        self.input_bytes += len(data)
+        if self.buffered < self.block_size:
+            return
+        data = b''.join(self.buffer)
+        offset = 0
+        while len(data) - offset >= self.block_size:
+            self._submit(data[offset:offset + self.block_size])
+            offset += self.block_size
+        self.buffer = [data[offset:]]
+        self.buffered = len(data) - offset
+
+    def _submit(self, block):
+        if self.pool is None:
+            self._write_block(compress_block(block, self.codec, self.level))
+            return
+        self.pending.append(self.pool.apply_async(
+            compress_block, (block, self.codec, self.level)
+        ))
+        if len(self.pending) >= 2 * self.processes:
+            self._write_block(self.pending.popleft().get())
+
+    def _write_block(self, compressed):
+        self.fileobj.write(compressed)
+        self.output_bytes += len(compressed)
+
+    def close(self):
+        'Compresses and writes the last, partial block'
+        if self.buffered:
+            self._submit(b''.join(self.buffer))
+            self.buffer = []
+            self.buffered = 0
+        while self.pending:
+            self._write_block(self.pending.popleft().get())
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+        self.fileobj.flush()
+
+    def terminate(self):
+        'Stops the pool, if close was not reached'
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool.join()
+            self.pool = None
+
+
+def compress_block(block, codec, level=None):
+    'A complete bzip2 stream or gzip member, or the block as is for none'
+    if codec in BZIP2_CODECS:
+        return bz2.compress(block, int(level or 9))
+    if codec in GZIP_CODECS:
+        compressor = zlib.compressobj(int(level or 6), zlib.DEFLATED,
+                                      16 + zlib.MAX_WBITS)
+        return compressor.compress(block) + compressor.flush()
+    return block
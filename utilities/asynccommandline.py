@@ -0,0 +1,299 @@
+import errno
+import os
+import select
+import subprocess
+import threading
+import time
+from utilities.commandline import CommandLine, CommandResult
+from utilities.processreaper import ProcessReaper
+
+
+class AsyncCommandLine(CommandLine):
+
+    '''
+    Command line library with the same contract as
+    utilities.commandline.CommandLine, built for running many commands at
+    once from one Python process.
+
+    A single reactor thread multiplexes the pipes of every running child
+    with select and reaps them as they exit, so concurrent commands cost
+    one file descriptor pair each instead of a thread each. submit starts
+    a command and returns an AsyncCommand immediately; execute and run
+    submit and block until the result is ready. All may be called from any
+    thread. execute_lines, execute_stream, execute_queue and
+    execute_pipeline are CommandLine's.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pending = []
+        self.running = []
+        self.reactor = None
+        self.wakeup_read = None
+        self.wakeup_write = None
+
+    def execute(self, command, stdin=None, stdout=None, stderr=None,
+                return_boolean=False):
+        '''
+        Execute a command on the system. Return stdout on success, raise an
+        exception on failure. If return_boolean is True, return the boolean
+        value based on system exit code (zero:True, non-zero:False).
+        '''
+        async_command = self.submit(command, stdin=stdin, stdout=stdout,
+                                    stderr=stderr,
+                                    return_boolean=return_boolean)
+        return async_command.result()
+
+    def run(self, command, stdin=None, stdout=None, stderr=None):
+        '''
+        Execute a command on the system and return a CommandResult holding
+        its stdout, stderr, exit status, wall time and resource usage,
+        whether it succeeded or not.
+        '''
+        async_command = self.submit(command, stdin=stdin, stdout=stdout,
+                                    stderr=stderr, return_boolean=True)
+        async_command.wait()
+        return async_command.get_command_result()
+
+    def submit(self, command, stdin=None, stdout=None, stderr=None,
+               return_boolean=False):
+        '''
+        Start a command on the system without waiting for it. Return an
+        AsyncCommand whose result() behaves like execute.
+        '''
+        # Verify passed arguments
+        if not type(command) is list or len(command) == 0:
+            raise Exception('Submit method received invalid command argument. '
+                            'Should receive a list containing each command '
+                            'token as a string. Instead received: '
+                            '"{0}"'.format(command))
+
+        # Without close_fds, Python 2's default, a child started by another
+        # thread would inherit this command's pipes and hold its EOF back
+        named_args = { 'stdout':subprocess.PIPE, 'stderr':subprocess.PIPE,
+                       'close_fds':True }
+        if stdin:
+            named_args['stdin'] = stdin
+        if stdout:
+            named_args['stdout'] = stdout
+        if stderr:
+            named_args['stderr'] = stderr
+        process = subprocess.Popen(command, **named_args)
+        async_command = AsyncCommand(command, process, return_boolean)
+        with self.lock:
+            if self.wakeup_write is None:
+                self.wakeup_read, self.wakeup_write = os.pipe()
+            self.pending.append(async_command)
+            self._start_reactor()
+        os.write(self.wakeup_write, b'x')
+        return async_command
+
+    def wait(self, async_commands):
+        'Block until every given AsyncCommand has finished'
+        for async_command in async_commands:
+            async_command.wait()
+
+    def _start_reactor(self):
+        if self.reactor and self.reactor.is_alive():
+            return
+        self.reactor = threading.Thread(target=self._run_reactor)
+        self.reactor.daemon = True
+        self.reactor.start()
+
+    def _run_reactor(self):
+        while True:
+            with self.lock:
+                self.running.extend(self.pending)
+                self.pending = []
+                if not self.running:
+                    self.reactor = None
+                    return
+            try:
+                self._poll_once()
+            except Exception as error:
+                self._fail_running(error)
+
+    def _fail_running(self, error):
+        '''
+        An unexpected reactor error finishes the running commands with it,
+        instead of leaving their waiters blocked
+        '''
+        running, self.running = self.running, []
+        for async_command in running:
+            if not async_command.done():
+                async_command.fail(error)
+
+    def _poll_once(self):
+        '''
+        Wait for output from any child, or for a newly submitted command.
+        Children that closed their pipes but have not exited yet are
+        rechecked on a short timeout.
+        '''
+        readers = {self.wakeup_read: None}
+        for async_command in self.running:
+            for pipe in async_command.get_open_pipes():
+                readers[pipe.fileno()] = (async_command, pipe)
+        try:
+            readable, _, _ = select.select(list(readers), [], [], 0.05)
+        except select.error as error:
+            if error.args[0] == errno.EINTR:
+                return
+            raise
+        for fd in readable:
+            if fd == self.wakeup_read:
+                os.read(self.wakeup_read, 4096)
+                continue
+            async_command, pipe = readers[fd]
+            async_command.read_pipe(pipe)
+        for async_command in list(self.running):
+            if async_command.try_finish():
+                self.running.remove(async_command)
+
+
+class AsyncCommand:
+
+    'A running command submitted to AsyncCommandLine'
+
+    def __init__(self, command, process, return_boolean=False):
+        self.command = command
+        self.process = process
+        self.return_boolean = return_boolean
+        self.output = {}
+        self.open_pipes = []
+        pipes = [process.stdout, process.stderr] if process else []
+        for pipe in pipes:
+            if pipe:
+                self.output[pipe] = []
+                self.open_pipes.append(pipe)
+        self.finished = threading.Event()
+        self.callback_lock = threading.Lock()
+        self.callbacks = []
+        self.value = None
+        self.error = None
+        self.rusage = {}
+        self.started = time.time()
+        self.duration = None
+
+    @classmethod
+    def from_callable(cls, command, function, *args, **kwargs):
+        '''
+        Run function synchronously and wrap its return value or exception
+        in an already finished AsyncCommand.
+        '''
+        async_command = cls(command, None)
+        try:
+            value = function(*args, **kwargs)
+        except Exception as error:
+            async_command.fail(error)
+            return async_command
+        async_command.succeed(value)
+        return async_command
+
+    def done(self):
+        return self.finished.is_set()
+
+    def wait(self, timeout=None):
+        self.finished.wait(timeout)
+        return self.done()
+
+    def result(self, timeout=None):
+        '''
+        Return stdout on success, raise an exception on failure, or return
+        the success boolean if the command was submitted with
+        return_boolean.
+        '''
+        if not self.wait(timeout):
+            raise Exception('Timed out waiting for command '
+                            '"{0}"'.format(' '.join(self.command)))
+        if self.error:
+            raise self.error
+        return self.value
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback with this AsyncCommand once it has finished. Callbacks
+        run on the reactor thread, before any waiter is woken, and should not
+        block. An exception raised by a callback becomes the error result()
+        raises, unless the command had already failed.
+        '''
+        with self.callback_lock:
+            if self.callbacks is not None:
+                self.callbacks.append(callback)
+                return
+        callback(self)
+
+    def get_open_pipes(self):
+        return list(self.open_pipes)
+
+    def read_pipe(self, pipe):
+        chunk = os.read(pipe.fileno(), 65536)
+        if chunk:
+            self.output[pipe].append(chunk)
+        else:
+            pipe.close()
+            self.open_pipes.remove(pipe)
+
+    def try_finish(self):
+        if self.open_pipes:
+            return False
+        rusage = ProcessReaper().wait(self.process, block=False)
+        if rusage is None:
+            return False
+        self.rusage = rusage
+        self._set_result()
+        self._finish()
+        return True
+
+    def succeed(self, value):
+        'Finish with value, for work done outside the reactor'
+        self.value = value
+        self._finish()
+
+    def fail(self, error):
+        'Finish with error, whatever state the process is in'
+        self.error = error
+        self._finish()
+
+    def get_command_result(self):
+        'The finished command as a utilities.commandline.CommandResult'
+        return CommandResult(self.command,
+                             self._get_output(self.process.stdout),
+                             self._get_output(self.process.stderr),
+                             self.process.returncode, self.duration,
+                             self.rusage)
+
+    def _finish(self):
+        self.duration = time.time() - self.started
+        with self.callback_lock:
+            callbacks, self.callbacks = self.callbacks, None
+        try:
+            for callback in callbacks:
+                self._run_callback(callback)
+        finally:
+            self.finished.set()
+
+    def _run_callback(self, callback):
+        try:
+            callback(self)
+        except Exception as error:
+            if self.error is None:
+                self.error = error
+
+    def _set_result(self):
+        stdout = self._get_output(self.process.stdout)
+        stderr = self._get_output(self.process.stderr)
+        is_success = (self.process.returncode == 0)
+        if self.return_boolean:
+            self.value = is_success
+        elif is_success:
+            self.value = stdout
+        else:
+            self.error = Exception('Stdout: {0} | Stderr: {1}'.format(
+                stdout, stderr
+            ))
+            self.error.returncode = self.process.returncode
+
+    def _get_output(self, pipe):
+        if pipe not in self.output:
+            return None
+        return b''.join(self.output[pipe])
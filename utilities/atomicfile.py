@@ -0,0 +1,38 @@
+import os
+import stat
+import tempfile
+
+
+class AtomicFile:
+
+    '''
+    Writes a temporary file, fsyncs it, then renames it over the path, so
+    readers see either the previous or the new content, even after a crash.
+    The temporary file is created with mkstemp in the same directory, so
+    jobs writing the same path from threads of one process never share it.
+    Its name starts with a dot and ends in .tmp, so collectors matching on
+    the extension, like node_exporter's *.prom, ignore it.
+    '''
+
+    def write(self, path, content):
+        directory, name = os.path.split(os.path.abspath(path))
+        descriptor, temporary_path = tempfile.mkstemp(
+            prefix='.{0}.'.format(name), suffix='.tmp', dir=directory
+        )
+        try:
+            with os.fdopen(descriptor, 'w') as temporary_file:
+                temporary_file.write(content)
+                temporary_file.flush()
+                os.fsync(temporary_file.fileno())
+            os.chmod(temporary_path, self._get_mode(path))
+            os.rename(temporary_path, path)
+        finally:
+            if os.path.exists(temporary_path):
+                os.remove(temporary_path)
+
+    def _get_mode(self, path):
+        'The mode of the file replaced, readable by all for new files'
+        try:
+            return stat.S_IMODE(os.stat(path).st_mode)
+        except OSError:
+            return 0o644
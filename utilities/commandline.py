@@ -1,4 +1,10 @@
+import collections
+import os
 import subprocess
+import threading
+import time
+from utilities.pipeline import Pipeline
+from utilities.processreaper import ProcessReaper
 
 
 class CommandLine:
@@ -11,6 +17,15 @@ class CommandLine:
         is True, return the boolean value based on system exit code (zero:True,
         non-zero:False) and do not log any results.
         '''
+        result = self.run(command, stdin=stdin, stdout=stdout, stderr=stderr)
+        return result.get_value(return_boolean)
+
+    def run(self, command, stdin=None, stdout=None, stderr=None):
+        '''
+        Execute a command on the system and return a CommandResult holding
+        its stdout, stderr, exit status, wall time and resource usage,
+        whether it succeeded or not.
+        '''
         # Verify passed arguments
         if not type(command) is list or len(command) == 0:
             raise Exception('Execute method received invalid command argument. '
@@ -19,7 +34,8 @@ class CommandLine:
                             '"{0}"'.format(command))
 
         # Setup command
-        named_args = { 'stdout':subprocess.PIPE, 'stderr':subprocess.PIPE }
+        named_args = { 'stdout':subprocess.PIPE, 'stderr':subprocess.PIPE,
+                       'close_fds':True }
         if stdin:
             named_args['stdin'] = stdin
         if stdout:
@@ -27,21 +43,35 @@ class CommandLine:
         if stderr:
             named_args['stderr'] = stderr
 
-        # Initiate process and listen for completion. Determine success from
-        # return code
+        # Initiate process and read its output. The child is reaped with
+        # wait4 rather than by communicate, to keep its resource usage
+        started = time.time()
         process = subprocess.Popen(command, **named_args)
-        stdout, stderr = process.communicate()
-        is_success = (process.returncode == 0)
+        stdout, stderr = self._read_output(process)
+        rusage = ProcessReaper().wait(process)
+        duration = time.time() - started
+        return CommandResult(command, stdout, stderr, process.returncode,
+                             duration, rusage)
 
-        # Return a boolean if requested
-        if return_boolean:
-            return is_success
+    def _read_output(self, process):
+        output = {}
+        threads = []
+        for name, pipe in [('stdout', process.stdout),
+                           ('stderr', process.stderr)]:
+            if not pipe:
+                continue
+            thread = threading.Thread(target=self._read_pipe,
+                                      args=(pipe, name, output))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        return output.get('stdout'), output.get('stderr')
 
-        # Otherwise return stdout on success and raise an error on failure.
-        if is_success:
-            return stdout
-        else:
-            raise Exception('Stdout: {0} | Stderr: {1}'.format(stdout, stderr))
+    def _read_pipe(self, pipe, name, output):
+        output[name] = pipe.read()
+        pipe.close()
 
     def execute_queue(self, commands, return_boolean=False):
         '''
@@ -50,38 +80,176 @@ class CommandLine:
         list determines the order of the command: commands[0] | commands[1] |
         [...] | commands[n-1] | commands[n].
         Return stdout on success, raise an exception on failure, and log result
-        in either case. If return_boolean is True, return the boolean value
-        based on system exit code (zero:True, non-zero:False) and do not log
-        any results.
+        in either case. Success requires every command in the queue to exit
+        with zero, not just the last one. If return_boolean is True, return
+        the boolean value based on system exit codes (zero:True,
+        non-zero:False) and do not log any results.
+        '''
+        pipeline = self.execute_pipeline(commands)
+        return pipeline.get_value(return_boolean)
+
+    def execute_pipeline(self, commands, stdin=None, stdout=None):
+        '''
+        Execute multiple piped commands on the system and return the
+        finished utilities.pipeline.Pipeline, which holds the exit status,
+        duration, stderr and throughput of every stage.
+        '''
+        pipeline = Pipeline(commands, stdin=stdin, stdout=stdout)
+        pipeline.run()
+        return pipeline
+
+    def execute_lines(self, command, delimiter='\n', stdin=None,
+                      error_context_lines=50):
         '''
+        Execute a command on the system and lazily yield its stdout split on
+        delimiter, without the delimiter, as the output arrives. Memory use
+        is bounded by the longest record rather than by the total output.
+        Stderr is drained concurrently into a ring buffer holding the last
+        error_context_lines lines, which are included in the exception
+        raised on failure. If the caller stops iterating early, the process
+        is terminated.
+        '''
+        stream = self._stream(command, stdin, delimiter, error_context_lines)
+        for record in stream:
+            yield record
+
+    def execute_stream(self, command, callback, delimiter=None, stdin=None,
+                       error_context_lines=50):
+        '''
+        Execute a command on the system, passing stdout to callback as it
+        arrives: one call per record, a native string, when delimiter is
+        set, otherwise one call per raw chunk of bytes. Return True on success, raise an exception with
+        the most recent output as context on failure.
+        '''
+        stream = self._stream(command, stdin, delimiter, error_context_lines)
+        for record in stream:
+            callback(record)
+        return True
+
+    def _stream(self, command, stdin, delimiter, error_context_lines,
+                chunk_size=65536):
         # Verify passed arguments
-        if not type(commands) is list or len(commands) == 0:
-            raise Exception('Execute queue method received invalid commands '
-                            'argument. Should receive a list containing a '
-                            'sublist for each command. Instead received: '
-                            '"{0}"'.format(commands))
-
-        # Create process pipes
-        previous_command = None
-        for command in commands:
-            named_args = {'stdout':subprocess.PIPE, 'stderr':subprocess.PIPE}
-            if previous_command:
-                named_args['stdin'] = previous_command.stdout
-            previous_command = subprocess.Popen(command, **named_args)
-
-        # Set post process variables
-        stdout, stderr = previous_command.communicate()
-        is_success = (previous_command.returncode == 0)
-
-        # Return a boolean if requested
-        if return_boolean:
-            return is_success
+        if not type(command) is list or len(command) == 0:
+            raise Exception('Execute stream method received invalid command '
+                            'argument. Should receive a list containing each '
+                            'command token as a string. Instead received: '
+                            '"{0}"'.format(command))
 
-        # Otherwise return stdout on success and raise an error on failure.
-        if is_success:
-            return stdout
-        else:
-            raise Exception('Stdout: {0} | Stderr: {1}'.format(stdout, stderr))
+        # Drain stderr on a separate thread so a chatty stderr can not block
+        # the process while stdout is being consumed
+        named_args = {'stdout':subprocess.PIPE, 'stderr':subprocess.PIPE,
+                      'close_fds':True}
+        if stdin:
+            named_args['stdin'] = stdin
+        process = subprocess.Popen(command, **named_args)
+        stdout_context = collections.deque(maxlen=error_context_lines)
+        stderr_context = collections.deque(maxlen=error_context_lines)
+        stderr_thread = threading.Thread(target=self._drain_lines,
+                                         args=(process.stderr, stderr_context))
+        stderr_thread.daemon = True
+        stderr_thread.start()
+
+        # Read whatever is available instead of blocking for full chunks, so
+        # records reach the caller as soon as they are complete. os.read
+        # returns bytes, which are split on the encoded delimiter and only
+        # decoded once a record is complete, so a multibyte character split
+        # across two reads stays intact
+        is_complete = False
+        try:
+            stdout_fd = process.stdout.fileno()
+            if delimiter is not None:
+                byte_delimiter = self._encode(delimiter)
+            remainder = b''
+            while True:
+                chunk = os.read(stdout_fd, chunk_size)
+                if not chunk:
+                    break
+                if delimiter is None:
+                    stdout_context.append(self._decode(chunk))
+                    yield chunk
+                    continue
+                records = (remainder + chunk).split(byte_delimiter)
+                remainder = records.pop()
+                for record in records:
+                    record = self._decode(record)
+                    stdout_context.append(record)
+                    yield record
+            if remainder:
+                remainder = self._decode(remainder)
+                stdout_context.append(remainder)
+                yield remainder
+            is_complete = True
+        finally:
+            if not is_complete and process.poll() is None:
+                process.terminate()
+            process.stdout.close()
+            ProcessReaper().wait(process)
+            stderr_thread.join()
+            process.stderr.close()
+
+        if process.returncode != 0:
+            error = Exception('Stdout: {0} | Stderr: {1}'.format(
+                delimiter.join(stdout_context) if delimiter else
+                ''.join(stdout_context),
+                ''.join(self._decode(line) for line in stderr_context)
+            ))
+            error.returncode = process.returncode
+            raise error
+
+    def _drain_lines(self, pipe, ring_buffer):
+        for line in iter(pipe.readline, b''):
+            ring_buffer.append(line)
+
+    def _encode(self, text):
+        if isinstance(text, bytes):
+            return text
+        return text.encode('utf-8')
+
+    def _decode(self, data):
+        '''
+        Records are native strings, on Python 2 the bytes read as they are.
+        Undecodable bytes, like those of a filename in another encoding,
+        are kept as surrogates and round trip through os functions.
+        '''
+        if isinstance(data, str):
+            return data
+        return data.decode('utf-8', 'surrogateescape')
+
+
+class CommandResult:
+
+    '''
+    The outcome of one command run by CommandLine. rusage is the child's
+    resource usage as reported by wait4, see utilities.processreaper.
+    '''
+
+    def __init__(self, command, stdout, stderr, returncode, duration,
+                 rusage=None):
+        self.command = command
+        self.stdout = stdout
+        self.stderr = stderr
+        self.returncode = returncode
+        self.duration = duration
+        self.rusage = rusage or {}
+
+    def is_success(self):
+        return self.returncode == 0
+
+    def get_value(self, return_boolean=False):
+        '''
+        The value CommandLine.execute returns: the success boolean if
+        return_boolean is True, otherwise stdout on success. Raises an
+        exception carrying the returncode and this result on failure.
+        '''
+        if return_boolean:
+            return self.is_success()
+        if self.is_success():
+            return self.stdout
+        error = Exception('Stdout: {0} | Stderr: {1}'.format(self.stdout,
+                                                             self.stderr))
+        error.returncode = self.returncode
+        error.result = self
+        raise error
 
 
 if __name__ == "__main__":
@@ -0,0 +1,111 @@
+class CompressionCommand:
+
+    '''
+    Builds stream compressor commands for tar archives. Every command reads
+    the tar stream from stdin and writes the compressed stream to stdout.
+    Parallel codecs produce output readable by their single threaded
+    counterparts, so pbzip2 and lbzip2 archives keep the bzip2 extension.
+    '''
+
+    codecs = {
+        'bzip2': {
+            'command': ['bzip2', '-c'],
+            'extension': '.tar.bzip2',
+            'levels': range(1, 10)
+        },
+        'pbzip2': {
+            'command': ['pbzip2', '-c'],
+            'extension': '.tar.bzip2',
+            'levels': range(1, 10)
+        },
+        'lbzip2': {
+            'command': ['lbzip2', '-c'],
+            'extension': '.tar.bzip2',
+            'levels': range(1, 10)
+        },
+        'gzip': {
+            'command': ['gzip', '-c'],
+            'extension': '.tar.gz',
+            'levels': range(1, 10)
+        },
+        'pigz': {
+            'command': ['pigz', '-c'],
+            'extension': '.tar.gz',
+            'levels': range(1, 10)
+        },
+        'xz': {
+            'command': ['xz', '-c', '-T0'],
+            'extension': '.tar.xz',
+            'levels': range(0, 10)
+        },
+        'zstd': {
+            'command': ['zstd', '-c', '-q', '-T0'],
+            'extension': '.tar.zst',
+            'levels': range(1, 20)
+        },
+        'none': {
+            'command': [],
+            'extension': '.tar',
+            'levels': []
+        }
+    }
+
+    def create(self, options):
+        self._parse_options(options)
+        command = self._get_command()
+        return command
+
+    def create_command_string(self, options):
+        command_list = self.create(options)
+        command_string = ' '.join(command_list)
+        return command_string
+
+    def get_codec_names(self):
+        names = list(self.codecs)
+        names.sort()
+        return names
+
+    def get_extension(self, codec):
+        codec_settings = self._get_codec_settings(codec)
+        return codec_settings['extension']
+
+    def get_extensions(self):
+        '''
+        Every known archive extension, longest first so the most specific
+        one matches when stripping extensions from filenames.
+        '''
+        extensions = set(item['extension'] for item in self.codecs.values())
+        extensions = list(extensions)
+        extensions.sort(key=len, reverse=True)
+        return extensions
+
+    def _parse_options(self, options):
+        self.codec = options.get('codec', 'bzip2')
+        self.level = options.get('level', None)
+
+    def _get_command(self):
+        codec_settings = self._get_codec_settings(self.codec)
+        command = list(codec_settings['command'])
+        command = command + self._create_level_arg(codec_settings)
+        return command
+
+    def _get_codec_settings(self, codec):
+        if codec not in self.codecs:
+            raise Exception("Unknown compression codec '{0}'. Expected one "
+                            "of: {1}".format(codec,
+                            ', '.join(self.get_codec_names())))
+        return self.codecs[codec]
+
+    def _create_level_arg(self, codec_settings):
+        level = []
+        if self.level is None or self.level == '':
+            return level
+        levels = codec_settings['levels']
+        if not levels:
+            return level
+        if int(self.level) not in levels:
+            raise Exception("Invalid compression level '{0}' for codec "
+                            "'{1}'. Expected {2}-{3}".format(self.level,
+                            self.codec, levels[0], levels[-1]))
+        level.append('-{0}'.format(int(self.level)))
+        return level
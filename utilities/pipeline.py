@@ -0,0 +1,216 @@
+import collections
+import subprocess
+import threading
+import time
+from utilities.processreaper import ProcessReaper
+
+
+class Pipeline:
+
+    '''
+    Runs commands[0] | commands[1] | [...] | commands[n] with every stage
+    connected directly by OS pipes, so data moves between stages inside the
+    kernel and never passes through Python.
+
+    Unlike a bare chain of Popen calls, every stage's exit status is
+    checked, every stage's stderr is drained concurrently into a bounded
+    ring buffer so a chatty stage can not deadlock the pipeline, and the
+    parent closes its copies of the intermediate pipes as soon as the next
+    stage holds them, so an early exit downstream is seen upstream as
+    SIGPIPE instead of a hang.
+
+    On Linux the bytes each stage wrote are sampled from /proc/<pid>/io
+    while it runs, giving approximate per-stage throughput.
+    '''
+
+    def __init__(self, commands, stdin=None, stdout=None,
+                 error_context_lines=50):
+        self._verify_commands(commands)
+        self.commands = commands
+        self.stdin = stdin
+        self.stdout = stdout
+        self.error_context_lines = error_context_lines
+        self.stages = []
+        self.output = ''
+
+    def run(self):
+        '''
+        Run the pipeline to completion and return a list with one dictionary
+        per stage: command, returncode, duration, bytes_written,
+        bytes_per_second, rusage and stderr.
+        '''
+        self._start_stages()
+        self._start_drain_threads()
+        self._monitor_stages()
+        self._join_drain_threads()
+        return self.get_stages()
+
+    def is_success(self):
+        return all(stage['returncode'] == 0 for stage in self.stages)
+
+    def get_output(self):
+        return self.output
+
+    def get_value(self, return_boolean=False):
+        '''
+        The value CommandLine.execute_queue returns: the success boolean if
+        return_boolean is True, otherwise the output of the last stage on
+        success. Raises an exception naming the failed stages on failure.
+        '''
+        is_success = self.is_success()
+        if return_boolean:
+            return is_success
+        if is_success:
+            return self.get_output()
+        raise Exception('Stdout: {0} | Stderr: {1}'.format(
+            self.get_output(), self.get_error_message()
+        ))
+
+    def get_stages(self):
+        stages = []
+        for stage in self.stages:
+            stage_copy = stage.copy()
+            stage_copy['stderr'] = ''.join(stage['stderr'])
+            for key in ['process', 'started']:
+                stage_copy.pop(key)
+            stages.append(stage_copy)
+        return stages
+
+    def get_error_message(self):
+        failures = []
+        for index, stage in enumerate(self.get_stages()):
+            if stage['returncode'] == 0:
+                continue
+            failures.append('Stage {0} "{1}" exited {2}. Stderr: {3}'.format(
+                index, ' '.join(stage['command']), stage['returncode'],
+                stage['stderr']
+            ))
+        return ' | '.join(failures)
+
+    def _verify_commands(self, commands):
+        if not type(commands) is list or len(commands) == 0:
+            raise Exception('Pipeline received invalid commands argument. '
+                            'Should receive a list containing a sublist for '
+                            'each command. Instead received: '
+                            '"{0}"'.format(commands))
+
+    def _start_stages(self):
+        previous_stdout = self.stdin
+        last_index = len(self.commands) - 1
+        for index, command in enumerate(self.commands):
+            named_args = {'stdout':subprocess.PIPE, 'stderr':subprocess.PIPE,
+                          'close_fds':True}
+            if previous_stdout:
+                named_args['stdin'] = previous_stdout
+            if index == last_index and self.stdout:
+                named_args['stdout'] = self.stdout
+            try:
+                process = subprocess.Popen(command, **named_args)
+            except Exception:
+                self._stop_stages()
+                raise
+            # The new stage holds its own copy of the pipe now. Closing the
+            # parent's copy lets the upstream stage receive SIGPIPE if this
+            # stage exits early.
+            if index > 0:
+                previous_stdout.close()
+            previous_stdout = process.stdout
+            self.stages.append(self._create_stage(command, process))
+
+    def _stop_stages(self):
+        '''
+        Kills and reaps the stages already started, and closes their pipes,
+        when a later stage could not be started
+        '''
+        for stage in self.stages:
+            process = stage['process']
+            try:
+                process.kill()
+            except OSError:
+                pass
+            process.wait()
+            for pipe in [process.stdout, process.stderr]:
+                if pipe:
+                    pipe.close()
+
+    def _create_stage(self, command, process):
+        stage = {
+            'command': command,
+            'process': process,
+            'started': time.time(),
+            'returncode': None,
+            'duration': None,
+            'bytes_written': None,
+            'bytes_per_second': None,
+            'rusage': None,
+            'stderr': collections.deque(maxlen=self.error_context_lines)
+        }
+        return stage
+
+    def _start_drain_threads(self):
+        self.threads = []
+        for stage in self.stages:
+            process = stage['process']
+            self._start_thread(self._drain_lines,
+                               (process.stderr, stage['stderr']))
+        last_process = self.stages[-1]['process']
+        if last_process.stdout:
+            self._start_thread(self._read_output, (last_process.stdout,))
+
+    def _start_thread(self, target, args):
+        thread = threading.Thread(target=target, args=args)
+        thread.daemon = True
+        thread.start()
+        self.threads.append(thread)
+
+    def _drain_lines(self, pipe, ring_buffer):
+        for line in iter(pipe.readline, b''):
+            ring_buffer.append(line)
+        pipe.close()
+
+    def _read_output(self, pipe):
+        self.output = pipe.read()
+        pipe.close()
+
+    def _join_drain_threads(self):
+        for thread in self.threads:
+            thread.join()
+
+    def _monitor_stages(self):
+        '''
+        Poll the stages until all have exited, sampling their write counters
+        while they are alive. The interval starts small so short pipelines
+        return promptly, and backs off for long running ones.
+        '''
+        interval = 0.005
+        running = list(self.stages)
+        while running:
+            for stage in list(running):
+                process = stage['process']
+                self._sample_bytes_written(stage)
+                rusage = ProcessReaper().wait(process, block=False)
+                if rusage is None:
+                    continue
+                stage['rusage'] = rusage
+                self._finish_stage(stage)
+                running.remove(stage)
+            if running:
+                time.sleep(interval)
+                interval = min(interval * 2, 0.25)
+
+    def _sample_bytes_written(self, stage):
+        pid = stage['process'].pid
+        try:
+            with open('/proc/{0}/io'.format(pid)) as io_file:
+                for line in io_file:
+                    if line.startswith('wchar:'):
+                        stage['bytes_written'] = int(line.split()[1])
+        except (IOError, OSError, ValueError):
+            pass
+
+    def _finish_stage(self, stage):
+        stage['returncode'] = stage['process'].returncode
+        stage['duration'] = time.time() - stage['started']
+        if stage['bytes_written'] is not None and stage['duration'] > 0:
+            stage['bytes_per_second'] = (stage['bytes_written'] /
+                                         stage['duration'])
@@ -0,0 +1,59 @@
+import errno
+import os
+
+
+class ProcessReaper:
+
+    '''
+    Reaps subprocess.Popen children with os.wait4 instead of Popen.wait, so
+    the resource usage the kernel accounted to the child is kept: user and
+    system CPU time, peak resident memory, block I/O and context switches.
+    The exit status is stored on process.returncode exactly as Popen would.
+    '''
+
+    def wait(self, process, block=True):
+        '''
+        Reap process and return its resource usage as a dictionary. When
+        block is False, return None instead of waiting if the process is
+        still running. A process already reaped elsewhere returns an empty
+        dictionary, as its resource usage is no longer available.
+        '''
+        if process.returncode is not None:
+            return {}
+        options = 0 if block else os.WNOHANG
+        while True:
+            try:
+                pid, status, rusage = os.wait4(process.pid, options)
+                break
+            except OSError as error:
+                if error.errno == errno.EINTR:
+                    continue
+                if error.errno == errno.ECHILD:
+                    process.poll()
+                    return {} if process.returncode is not None else None
+                raise
+        if pid == 0:
+            return None
+        process.returncode = self._get_returncode(status)
+        return self._create_rusage(rusage)
+
+    def _get_returncode(self, status):
+        'Killed by a signal is a negative signal number, as in Popen'
+        if os.WIFSIGNALED(status):
+            return -os.WTERMSIG(status)
+        return os.WEXITSTATUS(status)
+
+    def _create_rusage(self, rusage):
+        '''
+        max_rss_kb is in kilobytes on Linux. block_input and block_output
+        count 512 byte blocks read and written by the filesystem.
+        '''
+        return {
+            'user_time': rusage.ru_utime,
+            'system_time': rusage.ru_stime,
+            'max_rss_kb': rusage.ru_maxrss,
+            'block_input': rusage.ru_inblock,
+            'block_output': rusage.ru_oublock,
+            'voluntary_context_switches': rusage.ru_nvcsw,
+            'involuntary_context_switches': rusage.ru_nivcsw
+        }
@@ -0,0 +1,388 @@
+#!/usr/bin/env python
+
+'''
+Runs a batch of backup operations on the backup destination in a single
+ssh session. BackupAgent pipes this file, preceded by the source of
+utilities/roundrobindate.py, to `ssh <host> python - <batch>`, where batch is
+the base64 encoded JSON of {"operations": [...]}. The results are written
+to stdout as JSON. Runs on Python 2.6+ and 3 with the standard library only.
+Local destinations, without a host, run the same operations in process.
+
+    python utilities/remotehelper.py < batch.json
+'''
+
+import base64
+import hashlib
+import json
+import os
+import platform
+import shutil
+import stat
+import subprocess
+import sys
+import time
+
+try:
+    from utilities.archivewriter import ParallelArchiveWriter
+    from utilities.roundrobindate import RoundRobinBackupClassifier, \
+                                        RoundRobinDate
+except ImportError:
+    # On the destination, the classes of utilities.roundrobindate and
+    # ParallelArchiveWriter are defined inline ahead of this module
+    pass
+
+
+class RemoteHelper:
+
+    '''
+    Operations, each a dictionary with an op key:
+
+        mkdir: path
+        archive: command, a shell command creating path, by way of
+                 path.partial, which is removed if the command fails
+        write_archive: source, arcname, path, codec, level, processes
+        list: path
+        fsync: paths
+        checksum: path, algorithm (sha256 by default)
+        sizes: paths
+        rename: source, path
+        remove: paths, delays, seconds to sleep after each removal
+        prune: path, prefix, extensions, retention, mode, trash_path, sizes
+
+    Every result holds op, success, error, skipped and duration, plus the
+    values of its operation. Once an operation fails the rest are skipped.
+    '''
+
+    def __init__(self):
+        self.operations = {
+            'mkdir': self.mkdir,
+            'archive': self.archive,
+            'write_archive': self.write_archive,
+            'list': self.list_entries,
+            'fsync': self.fsync,
+            'checksum': self.checksum,
+            'sizes': self.sizes,
+            'rename': self.rename,
+            'remove': self.remove,
+            'prune': self.prune
+        }
+
+    def run(self, batch):
+        results = []
+        is_failed = False
+        for operation in batch.get('operations', []):
+            result = {
+                'op': operation.get('op'),
+                'success': False,
+                'error': None,
+                'skipped': is_failed,
+                'duration': 0.0
+            }
+            if not is_failed:
+                started = time.time()
+                try:
+                    result.update(self._run_operation(operation))
+                    result['success'] = True
+                except Exception as error:
+                    result['error'] = str(error)
+                    is_failed = True
+                result['duration'] = time.time() - started
+            results.append(result)
+        return {'python': platform.python_version(), 'results': results}
+
+    def _run_operation(self, operation):
+        handler = self.operations.get(operation.get('op'))
+        if not handler:
+            raise Exception('Unknown remote helper operation '
+                            '"{0}"'.format(operation.get('op')))
+        return handler(operation) or {}
+
+    def mkdir(self, operation):
+        path = operation['path']
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def archive(self, operation):
+        process = subprocess.Popen(['/bin/sh', '-c', operation['command']],
+                                   stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE, close_fds=True)
+        stdout, stderr = process.communicate()
+        if process.returncode != 0:
+            partial_path = '{0}.partial'.format(operation['path'])
+            if os.path.exists(partial_path):
+                os.remove(partial_path)
+            raise Exception('Command exited {0}. Stderr: {1}'.format(
+                process.returncode, self._decode(stderr)[-2000:]
+            ))
+        return {'size': os.path.getsize(operation['path'])}
+
+    def write_archive(self, operation):
+        'Without external tools, see utilities.archivewriter'
+        writer = ParallelArchiveWriter({
+            'codec': operation.get('codec'),
+            'level': operation.get('level'),
+            'processes': operation.get('processes')
+        })
+        return writer.write(operation['source'], operation['path'],
+                            operation.get('arcname'))
+
+    def list_entries(self, operation):
+        return {'entries': self._list(operation['path'])}
+
+    def fsync(self, operation):
+        '''
+        Flushes the files, then their directories, so new and renamed
+        entries survive a crash of the backup server.
+        '''
+        directories = []
+        for path in operation['paths']:
+            self._fsync_path(path)
+            directory = os.path.dirname(os.path.abspath(path))
+            if directory not in directories:
+                directories.append(directory)
+        for directory in directories:
+            self._fsync_path(directory)
+
+    def _fsync_path(self, path):
+        descriptor = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(descriptor)
+        finally:
+            os.close(descriptor)
+
+    def checksum(self, operation):
+        algorithm = operation.get('algorithm') or 'sha256'
+        digest = hashlib.new(algorithm)
+        size = 0
+        with open(operation['path'], 'rb') as checked_file:
+            for chunk in iter(lambda: checked_file.read(1048576), b''):
+                digest.update(chunk)
+                size += len(chunk)
+        return {'algorithm': algorithm, 'checksum': digest.hexdigest(),
+                'size': size}
+
+    def sizes(self, operation):
+        'Directories are measured like du -sb, hardlinks counted once'
+        seen_inodes = set()
+        sizes = {}
+        for path in operation['paths']:
+            if os.path.isdir(path) and not os.path.islink(path):
+                sizes[path] = self._get_tree_size(path, seen_inodes)
+            else:
+                sizes[path] = os.lstat(path).st_size
+        return {'sizes': sizes}
+
+    def rename(self, operation):
+        os.rename(operation['source'], operation['path'])
+
+    def remove(self, operation):
+        '''
+        Removes the paths one at a time, sleeping the matching delay after
+        each. Paths that could not be removed are reported in failed instead
+        of failing the operation.
+        '''
+        delays = operation.get('delays') or []
+        removed = []
+        failed = []
+        for index, path in enumerate(operation['paths']):
+            try:
+                self._remove_path(path)
+                removed.append(path)
+            except (IOError, OSError) as error:
+                failed.append({'path': path, 'error': str(error)})
+            if index < len(delays) and delays[index] > 0:
+                time.sleep(delays[index])
+        return {'removed': removed, 'failed': failed}
+
+    def _remove_path(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+
+    def prune(self, operation):
+        '''
+        Lists, classifies and removes stale archives with the same
+        RoundRobinBackupClassifier as lib.backuparchivepruner. Partial
+        archives dated before today are removed too.
+        '''
+        entries = self._get_backups(operation)
+        backups = [backup for backup in entries if not backup['partial']]
+        options = self._get_round_robin_date_options(operation['retention'])
+        classifier = RoundRobinBackupClassifier(options)
+        stale_backups = classifier.get_stale_backups(backups)
+        today = RoundRobinDate(options).get_today()
+        stale_backups += [backup for backup in entries
+                          if backup['partial'] and backup['date'] < today]
+        if operation.get('sizes'):
+            self._add_sizes(entries)
+        removed, failed = self._remove(stale_backups, operation)
+        removed_paths = set(backup['fullpath'] for backup in removed)
+        retained = [backup for backup in backups
+                    if backup['fullpath'] not in removed_paths]
+        result = {
+            'removed': [backup['fullpath'] for backup in removed],
+            'failed': failed,
+            'pruned_count': len(removed),
+            'retained_count': len(retained)
+        }
+        if operation.get('sizes'):
+            result['pruned_bytes'] = sum(backup['size'] for backup in removed)
+            result['retained_bytes'] = sum(backup['size']
+                                           for backup in retained)
+        return result
+
+    def _get_backups(self, operation):
+        path = operation['path']
+        prefix = operation['prefix']
+        backups = []
+        for entry in self._list(path):
+            name = entry['name']
+            if prefix not in name:
+                continue
+            date = self._get_date(name[len(prefix):],
+                                  operation.get('extensions') or [])
+            if not RoundRobinBackupClassifier().is_backup_date(date):
+                continue
+            backups.append({
+                'fullpath': os.path.join(path, name),
+                'filename': name,
+                'date': date,
+                'incremental': '.incremental.' in name or
+                               name.endswith('.incremental'),
+                'directory': entry['type'] == 'd',
+                'size': entry['size'],
+                'partial': name.endswith('.partial')
+            })
+        return backups
+
+    def _get_date(self, filename, extensions):
+        for extension in extensions:
+            if filename.endswith(extension):
+                filename = filename[:-len(extension)]
+                break
+        return filename.split('.')[0]
+
+    def _get_round_robin_date_options(self, retention):
+        options = {
+            'days_to_retain': retention['days'],
+            'weeks_to_retain': retention['weeks'],
+            'months_to_retain': retention['months'],
+            'years_to_retain': retention['years']
+        }
+        if retention.get('current_date'):
+            options['current_date'] = retention['current_date']
+        return options
+
+    def _add_sizes(self, backups):
+        'Directories are measured like du -sb, hardlinks counted once'
+        seen_inodes = set()
+        for backup in backups:
+            if backup['directory']:
+                backup['size'] = self._get_tree_size(backup['fullpath'],
+                                                     seen_inodes)
+
+    def _get_tree_size(self, path, seen_inodes):
+        size = 0
+        for directory, names, filenames in os.walk(path):
+            for name in [None] + filenames:
+                fullpath = os.path.join(directory, name) if name else directory
+                try:
+                    status = os.lstat(fullpath)
+                except OSError:
+                    continue
+                inode = (status.st_dev, status.st_ino)
+                if inode in seen_inodes:
+                    continue
+                seen_inodes.add(inode)
+                size += status.st_size
+        return size
+
+    def _remove(self, backups, operation):
+        '''
+        In trash mode archives are renamed into the trash directory instead
+        of being deleted.
+        '''
+        trash_path = None
+        if operation.get('mode') == 'trash':
+            trash_path = operation['trash_path']
+            if not os.path.isdir(trash_path):
+                os.makedirs(trash_path)
+        removed = []
+        failed = []
+        for backup in backups:
+            fullpath = backup['fullpath']
+            try:
+                if trash_path:
+                    os.rename(fullpath, os.path.join(trash_path,
+                                                     backup['filename']))
+                else:
+                    self._remove_path(fullpath)
+                removed.append(backup)
+            except (IOError, OSError) as error:
+                failed.append({'path': fullpath, 'error': str(error)})
+        return removed, failed
+
+    def _list(self, path):
+        'os.scandir where available, Python 3.5+, otherwise os.listdir'
+        if hasattr(os, 'scandir'):
+            statuses = [(entry.name, entry.stat(follow_symlinks=False))
+                        for entry in os.scandir(path)]
+        else:
+            statuses = [(name, os.lstat(os.path.join(path, name)))
+                        for name in os.listdir(path)]
+        entries = []
+        for name, status in statuses:
+            entries.append({
+                'name': name,
+                'type': self._get_type(status.st_mode),
+                'size': status.st_size,
+                'mtime': status.st_mtime
+            })
+        return entries
+
+    def _get_type(self, mode):
+        'The type letters of find -printf %y'
+        if stat.S_ISDIR(mode):
+            return 'd'
+        if stat.S_ISLNK(mode):
+            return 'l'
+        if stat.S_ISREG(mode):
+            return 'f'
+        return 'o'
+
+    def _decode(self, output):
+        if isinstance(output, bytes) and not isinstance(output, str):
+            return output.decode('utf-8', 'replace')
+        return output
+
+
+def encode_batch(batch):
+    'The batch as a single shell-safe argument'
+    encoded = base64.b64encode(json.dumps(batch).encode('utf-8'))
+    return encoded.decode('ascii')
+
+
+def decode_batch(argument):
+    return json.loads(base64.b64decode(argument).decode('utf-8'))
+
+
+def main(arguments=None):
+    '''
+    Reads the batch from the first argument, base64 encoded, or as JSON
+    from stdin without arguments.
+    '''
+    if arguments is None:
+        arguments = sys.argv[1:]
+    if arguments:
+        batch = decode_batch(arguments[0])
+    else:
+        batch = json.load(sys.stdin)
+    output = RemoteHelper().run(batch)
+    sys.stdout.write(json.dumps(output))
+    sys.stdout.flush()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
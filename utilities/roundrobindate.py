@@ -1,7 +1,13 @@
 #!/usr/bin/env python
 
+import bisect
+import heapq
+import itertools
+import re
 from datetime import date, timedelta
 
+BACKUP_DATE_PATTERN = re.compile(r"^\d{4}-\d{2}-\d{2}$")
+
 
 class RoundRobinDate:
 
@@ -20,13 +26,14 @@ class RoundRobinDate:
             self.options_parser = RoundRobinDateOptionsParser()
         self.options_parser.set_options(options)
         self.options = self.options_parser.get_options()
+        self.first_dates = {}
 
     def get_options(self):
         return self.options.copy()
     
     def get_today(self):
         date_dict = self._generate_todays_date()
-        date_string = date_dict.keys()[0]
+        date_string = list(date_dict.keys())[0]
         return date_string
 
     def _generate_todays_date(self):
@@ -46,39 +53,128 @@ class RoundRobinDate:
 
     def _generate_dates(self):
         dates = {}
-        dates.update(self._generate_todays_date())
-        dates.update(self._generate_day_dates())
-        dates.update(self._generate_week_dates())
-        dates.update(self._generate_month_dates())
-        dates.update(self._generate_year_dates())
+        for retained_date in self.iter_retained_dates():
+            dates.update(self._generate_date_dict(retained_date))
         return dates
 
-    def _generate_day_dates(self):
-        dates = {}
+    def iter_retained_dates(self):
+        """
+        Lazily yields every retained date as a date object, newest first
+        and without duplicates. Each tier is generated on demand, so long
+        horizons cost nothing until they are consumed.
+        """
+        tiers = [
+            self._iter_tier(self.options["current_date"], None, 1),
+            self._iter_tier_dates("days_to_retain", self._get_first_day,
+                                  self._get_previous_day),
+            self._iter_tier_dates("weeks_to_retain", self._get_first_week,
+                                  self._get_previous_week),
+            self._iter_tier_dates("months_to_retain", self._get_first_month,
+                                  self._get_previous_month),
+            self._iter_tier_dates("years_to_retain", self._get_first_year,
+                                  self._get_previous_year)
+        ]
+        keyed_tiers = [((-tier_date.toordinal(), tier_date)
+                        for tier_date in tier) for tier in tiers]
+        previous_date = None
+        for _, retained_date in heapq.merge(*keyed_tiers):
+            if retained_date != previous_date:
+                yield retained_date
+            previous_date = retained_date
+
+    def _iter_tier_dates(self, retain_option, get_first, get_previous):
+        number_to_generate = self.options.get(retain_option)
+        if not number_to_generate:
+            return iter([])
+        first_date = get_first(self.options["current_date"])
+        return self._iter_tier(first_date, get_previous, number_to_generate)
+
+    def _iter_tier(self, first_date, get_previous, number_to_generate):
+        current_date = first_date
+        for i in itertools.count():
+            yield current_date
+            if i + 1 == number_to_generate:
+                return
+            try:
+                current_date = get_previous(current_date)
+            except (ValueError, OverflowError):
+                # Reached the first year the date type supports
+                return
+
+    def is_retained(self, input_date):
+        """
+        Whether input_date is one of the dates get_dates returns, decided
+        arithmetically in constant time without generating any dates.
+        """
+        return self.classify(input_date) is not None
+
+    def classify(self, input_date):
+        """
+        Returns the first tier that retains input_date, one of "today",
+        "day", "week", "month" or "year", or None if no tier does. Accepts
+        date objects and ISO 8601 strings.
+        """
+        input_date = RRDDateParser().parse(input_date)
         current_date = self.options["current_date"]
-        number_to_generate = self.options.get("days_to_retain")
-        for i in xrange(number_to_generate):
-            current_date = self._get_previous_day(current_date)
-            date_dict = self._generate_date_dict(current_date)
-            dates.update(date_dict)
-        return dates
+        if input_date == current_date:
+            return "today"
+        if input_date > current_date:
+            return None
+        if (current_date - input_date).days <= self.options["days_to_retain"]:
+            return "day"
+        if self._is_retained_week(input_date):
+            return "week"
+        if self._is_retained_month(input_date):
+            return "month"
+        if self._is_retained_year(input_date):
+            return "year"
+        return None
+
+    def _is_retained_week(self, input_date):
+        weeks_to_retain = self.options["weeks_to_retain"]
+        if not weeks_to_retain:
+            return False
+        first_week = self._get_first_date("week", self._get_first_week)
+        days_back = (first_week - input_date).days
+        return days_back >= 0 and days_back % 7 == 0 and \
+               days_back // 7 < weeks_to_retain
+
+    def _is_retained_month(self, input_date):
+        months_to_retain = self.options["months_to_retain"]
+        if not months_to_retain:
+            return False
+        first_month = self._get_first_date("month", self._get_first_month)
+        if input_date.day != first_month.day:
+            return False
+        months_back = (first_month.year - input_date.year) * 12 + \
+                      first_month.month - input_date.month
+        return 0 <= months_back < months_to_retain
+
+    def _is_retained_year(self, input_date):
+        years_to_retain = self.options["years_to_retain"]
+        if not years_to_retain:
+            return False
+        first_year = self._get_first_date("year", self._get_first_year)
+        if (input_date.month, input_date.day) != \
+                (first_year.month, first_year.day):
+            return False
+        return 0 <= first_year.year - input_date.year < years_to_retain
+
+    def _get_first_date(self, tier, get_first):
+        "The newest date of a tier, computed once per set of options"
+        if tier not in self.first_dates:
+            current_date = self.options["current_date"]
+            self.first_dates[tier] = get_first(current_date)
+        return self.first_dates[tier]
+
+    def _get_first_day(self, input_date):
+        return self._get_previous_day(input_date)
 
     def _get_previous_day(self, input_date):
         interval = timedelta(days=1)
         previous_day = input_date - interval
         return previous_day
 
-    def _generate_week_dates(self):
-        dates = {}
-        current_date = self.options["current_date"]
-        current_week_date = self._get_first_week(current_date)
-        number_to_generate = self.options.get("weeks_to_retain")
-        for i in xrange(number_to_generate):
-            date_dict = self._generate_date_dict(current_week_date)
-            dates.update(date_dict)
-            current_week_date = self._get_previous_week(current_week_date)
-        return dates
-
     def _get_first_week(self, input_date):
         """
         Picks a day of the week based on the backup_day_of_week value.
@@ -99,17 +195,6 @@ class RoundRobinDate:
         previous_week = input_date - interval
         return previous_week
 
-    def _generate_month_dates(self):
-        dates = {}
-        current_date = self.options["current_date"]
-        current_month_date = self._get_first_month(current_date)
-        number_to_generate = self.options.get("months_to_retain")
-        for i in xrange(number_to_generate):
-            date_dict = self._generate_date_dict(current_month_date)
-            dates.update(date_dict)
-            current_month_date = self._get_previous_month(current_month_date)
-        return dates
-
     def _get_first_month(self, input_date):
         day = self.options["backup_day_of_month"]
         month = input_date.month
@@ -131,17 +216,6 @@ class RoundRobinDate:
         previous_month = date(year, month, day)
         return previous_month
 
-    def _generate_year_dates(self):
-        dates = {}
-        current_date = self.options["current_date"]
-        current_year_date = self._get_first_year(current_date)
-        number_to_generate = self.options.get("years_to_retain")
-        for i in xrange(number_to_generate):
-            date_dict = self._generate_date_dict(current_year_date)
-            dates.update(date_dict)
-            current_year_date = self._get_previous_year(current_year_date)
-        return dates
-
     def _get_first_year(self, input_date):
         day = self.options["backup_day_of_month"]
         month = self.options["backup_month_of_year"]
@@ -166,6 +240,77 @@ class RoundRobinDate:
         return dates_list
 
 
+class RoundRobinBackupClassifier:
+
+    """
+    Sorts dated backups into kept and stale ones. Each backup is a
+    dictionary with at least a date, an ISO 8601 string, and an
+    incremental flag. Options are those of RoundRobinDate, whose anchor
+    date is set to the oldest backup.
+
+    Kept are the retained round-robin dates back to the oldest backup, the
+    oldest backup itself, and the full backup every kept incremental
+    backup was created against, the newest full backup on or before its
+    date. lib.backuparchivepruner and utilities.remotehelper both classify
+    with this class, so they always remove the same backups.
+    """
+
+    def __init__(self, options=""):
+        self.options = dict(options or {})
+
+    def is_backup_date(self, date_string):
+        "Files sharing the prefix that are not dated backups are ignored"
+        return bool(BACKUP_DATE_PATTERN.match(date_string))
+
+    def get_stale_backups(self, backups):
+        dates_to_keep = self.get_dates_to_keep(backups)
+        return [backup for backup in backups
+                if backup["date"] not in dates_to_keep]
+
+    def get_dates_to_keep(self, backups):
+        if not backups:
+            return set()
+        oldest_backup_date = min(backup["date"] for backup in backups)
+        dates_to_keep = self._get_retained_dates(oldest_backup_date)
+        dates_to_keep.update(self._get_full_backup_dates_required_by(
+            backups, dates_to_keep
+        ))
+        return dates_to_keep
+
+    def _get_retained_dates(self, oldest_backup_date):
+        """
+        Only retained dates back to the oldest backup are generated, so
+        long retention horizons cost nothing beyond the existing backups.
+        """
+        options = dict(self.options, anchor_date=oldest_backup_date)
+        dates = set([oldest_backup_date])
+        for retained_date in RoundRobinDate(options).iter_retained_dates():
+            date_string = retained_date.isoformat()
+            if date_string < oldest_backup_date:
+                break
+            dates.add(date_string)
+        return dates
+
+    def _get_full_backup_dates_required_by(self, backups, dates_to_keep):
+        """
+        An incremental backup can only be restored on top of the full
+        backup it was created against, so that one is kept even when the
+        round-robin dates alone would remove it.
+        """
+        full_dates = sorted(set(backup["date"] for backup in backups
+                                if not backup["incremental"]))
+        required_dates = set()
+        for backup in backups:
+            if not backup["incremental"]:
+                continue
+            if backup["date"] not in dates_to_keep:
+                continue
+            base_index = bisect.bisect_right(full_dates, backup["date"]) - 1
+            if base_index >= 0:
+                required_dates.add(full_dates[base_index])
+        return required_dates
+
+
 class RoundRobinDateOptionsParser:
 
     def __init__(self, custom_options=""):
@@ -260,7 +405,7 @@ class RoundRobinDateOptionsParser:
             "months_to_retain",
             "years_to_retain"
         ]
-        for key, value in self.options.iteritems():
+        for key, value in self.options.items():
             if key in options_with_numeric_values:
                 self.options[key] = int(value)
 
@@ -0,0 +1,37 @@
+import re
+
+
+class RsyncStatsParser:
+
+    '''
+    Parses the summary rsync prints with --stats. Byte counts are returned
+    as integers and the speedup as a float. Values missing from the output,
+    e.g. from an older rsync, are omitted.
+    '''
+
+    patterns = {
+        'files': r'^Number of files: ([\d,]+)',
+        'files_transferred': r'^Number of (?:regular )?files transferred: '
+                             r'([\d,]+)',
+        'total_file_size': r'^Total file size: ([\d,]+)',
+        'transferred_file_size': r'^Total transferred file size: ([\d,]+)',
+        'bytes_sent': r'^Total bytes sent: ([\d,]+)',
+        'bytes_received': r'^Total bytes received: ([\d,]+)',
+        'speedup': r'speedup is ([\d,.]+)'
+    }
+
+    def parse(self, output):
+        stats = {}
+        if not output:
+            return stats
+        for key, pattern in self.patterns.items():
+            match = re.search(pattern, output, re.MULTILINE)
+            if match:
+                stats[key] = self._parse_number(key, match.group(1))
+        return stats
+
+    def _parse_number(self, key, value):
+        value = value.replace(',', '')
+        if key == 'speedup':
+            return float(value)
+        return int(value)
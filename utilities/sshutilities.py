@@ -1,3 +1,8 @@
+import os
+import shutil
+import tempfile
+
+
 class SSHCommand:
 
     def create(self, options):
@@ -15,12 +20,14 @@ class SSHCommand:
         self.host = options.get('host', '')
         self.port = options.get('port', '')
         self.identity_file = options.get('identity_file', '')
+        self.control_path = options.get('control_path', '')
         self.subcommand = options.get('subcommand', '')
 
     def _get_command(self):
         args = self._get_args()
         command_pieces = ['ssh'] + args['target'] + args['port'] + \
-                         args['identity_file'] + args['subcommand']
+                         args['identity_file'] + args['control_path'] + \
+                         args['subcommand']
         filtered_command_pieces = [x for x in command_pieces if x]
         return filtered_command_pieces
 
@@ -29,6 +36,7 @@ class SSHCommand:
             'target': self._create_target_arg(),
             'port': self._create_port_arg(),
             'identity_file': self._create_identity_file_arg(),
+            'control_path': self._create_control_path_arg(),
             'subcommand': self._create_subcommand()
         }
         return args
@@ -55,19 +63,106 @@ class SSHCommand:
             identity.append('{0}'.format(self.identity_file))
         return identity
 
+    def _create_control_path_arg(self):
+        control_path = []
+        if self.control_path:
+            control_path.append('-o')
+            control_path.append('ControlPath={0}'.format(self.control_path))
+        return control_path
+
     def _create_subcommand(self):
         """
         Due to the way Python subprocess executes commands, subcommands like
         'ssh user@host "ls -la"' should not have the wrapping quote marks.
+        Quotes inside the subcommand are kept for the remote shell.
         """
         subcommand = []
         if self.subcommand:
-            without_wrapping_quotes = self.subcommand.replace('"', '')
-            without_wrapping_quotes = without_wrapping_quotes.replace("'", '')
+            without_wrapping_quotes = self.subcommand
+            if len(without_wrapping_quotes) > 1 and \
+                    without_wrapping_quotes[0] in '"\'' and \
+                    without_wrapping_quotes[0] == without_wrapping_quotes[-1]:
+                without_wrapping_quotes = without_wrapping_quotes[1:-1]
             subcommand.append(without_wrapping_quotes)
         return subcommand
 
 
+class SSHControlMaster:
+
+    '''
+    Manages a multiplexed OpenSSH master connection. Once opened, any SSH
+    command created with the same control_path option reuses the master's
+    authenticated session instead of negotiating a new one.
+    '''
+
+    def __init__(self, options):
+        self.options = options.copy()
+        self.control_dir = ''
+        self.control_path = ''
+
+    def open(self, command_line_library):
+        '''
+        The backgrounded master keeps the stdio it was started with, so it
+        gets /dev/null and a temporary file instead of the pipes the
+        command line library reads until EOF, which would never come.
+        '''
+        self.control_dir = tempfile.mkdtemp(prefix='rrbackup-ssh-')
+        self.control_path = os.path.join(self.control_dir, 'master')
+        command = self.get_open_command()
+        output = tempfile.TemporaryFile()
+        try:
+            with open(os.devnull, 'rb') as devnull:
+                command_line_library.execute(command, stdin=devnull,
+                                             stdout=output, stderr=output)
+        except Exception as error:
+            output.seek(0)
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = ''
+            self.control_path = ''
+            raise Exception('Could not open the SSH master connection: '
+                            '{0} {1}'.format(error, output.read().strip()))
+        finally:
+            output.close()
+        return self.control_path
+
+    def close(self, command_line_library):
+        if not self.control_path:
+            return
+        try:
+            command = self.get_close_command()
+            command_line_library.execute(command, return_boolean=True)
+        finally:
+            shutil.rmtree(self.control_dir, ignore_errors=True)
+            self.control_dir = ''
+            self.control_path = ''
+
+    def get_control_path(self):
+        return self.control_path
+
+    def get_open_command(self):
+        '''
+        The master authenticates, then forks into the background, -f,
+        without running a command, -N, and persists until explicitly
+        closed.
+        '''
+        options = self._get_ssh_command_options()
+        command = SSHCommand().create(options)
+        master_args = ['-o', 'ControlMaster=yes', '-o', 'ControlPersist=yes',
+                       '-f', '-N']
+        return command + master_args
+
+    def get_close_command(self):
+        options = self._get_ssh_command_options()
+        command = SSHCommand().create(options)
+        return command + ['-O', 'exit']
+
+    def _get_ssh_command_options(self):
+        options = self.options.copy()
+        options['control_path'] = self.control_path
+        options.pop('subcommand', None)
+        return options
+
+
 class SSHParser:
 
     def parse(self, ssh_string):
@@ -0,0 +1,143 @@
+import time
+
+
+class TimedCommandLine:
+
+    '''
+    Wraps a command line library and records the command, start time, wall
+    time, success and exit status of every command executed through it.
+    Exit statuses are known for failures raised by CommandLine and for
+    pipelines; otherwise returncode is 0 on success and None on failure.
+
+    When the wrapped library reports resource usage, like CommandLine's
+    run and execute_pipeline, the child's rusage is recorded as well, and
+    pipelines record every stage.
+    '''
+
+    def __init__(self, command_line_library):
+        self.cli = command_line_library
+        self.commands = []
+
+    def get_commands(self):
+        return [command.copy() for command in self.commands]
+
+    def execute(self, command, *args, **kwargs):
+        if hasattr(self.cli, 'run'):
+            return self._execute_result(command, *args, **kwargs)
+        started = time.time()
+        try:
+            result = self.cli.execute(command, *args, **kwargs)
+        except Exception as error:
+            self._record(command, started, False, self._get_returncode(error))
+            raise
+        success = result is not False
+        self._record(command, started, success)
+        return result
+
+    def _execute_result(self, command, stdin=None, stdout=None, stderr=None,
+                        return_boolean=False):
+        started = time.time()
+        try:
+            result = self.cli.run(command, stdin=stdin, stdout=stdout,
+                                  stderr=stderr)
+        except Exception:
+            self._record(command, started, False)
+            raise
+        self._record(command, started, result.is_success(), result.returncode,
+                     result.rusage)
+        return result.get_value(return_boolean)
+
+    def execute_lines(self, command, *args, **kwargs):
+        'Timed from the first record requested until the last is consumed'
+        started = time.time()
+        try:
+            for record in self.cli.execute_lines(command, *args, **kwargs):
+                yield record
+        except Exception as error:
+            self._record(command, started, False, self._get_returncode(error))
+            raise
+        self._record(command, started, True)
+
+    def execute_queue(self, commands, *args, **kwargs):
+        if hasattr(self.cli, 'execute_pipeline'):
+            return self._execute_pipeline_queue(commands, *args, **kwargs)
+        started = time.time()
+        try:
+            result = self.cli.execute_queue(commands, *args, **kwargs)
+        except Exception as error:
+            self._record(self._join_commands(commands), started, False,
+                         self._get_returncode(error))
+            raise
+        success = result is not False
+        self._record(self._join_commands(commands), started, success)
+        return result
+
+    def _execute_pipeline_queue(self, commands, return_boolean=False):
+        '''
+        The returncode of a pipeline is that of its first failed stage, as
+        with bash's pipefail.
+        '''
+        started = time.time()
+        try:
+            pipeline = self.cli.execute_pipeline(commands)
+        except Exception:
+            self._record(self._join_commands(commands), started, False)
+            raise
+        stages = pipeline.get_stages()
+        returncodes = [stage['returncode'] for stage in stages
+                       if stage['returncode'] != 0]
+        returncode = returncodes[0] if returncodes else 0
+        self._record(self._join_commands(commands), started,
+                     pipeline.is_success(), returncode)
+        self.commands[-1]['stages'] = [
+            {
+                'command': ' '.join(stage['command']),
+                'duration': stage['duration'],
+                'returncode': stage['returncode'],
+                'bytes_written': stage['bytes_written'],
+                'rusage': stage['rusage']
+            }
+            for stage in stages
+        ]
+        return pipeline.get_value(return_boolean)
+
+    def _submit(self, command, *args, **kwargs):
+        started = time.time()
+        async_command = self.cli.submit(command, *args, **kwargs)
+        def record(finished_command):
+            error = finished_command.error
+            success = error is None and finished_command.value is not False
+            returncode = 0 if success else self._get_returncode(error)
+            self._record(command, started, success, returncode,
+                         getattr(finished_command, 'rusage', None))
+        async_command.add_done_callback(record)
+        return async_command
+
+    def __getattr__(self, name):
+        '''
+        Other methods pass through untimed. submit is only offered when the
+        wrapped library supports it.
+        '''
+        attribute = getattr(self.cli, name)
+        if name == 'submit':
+            return self._submit
+        return attribute
+
+    def _join_commands(self, commands):
+        return [token for command in commands for token in command + ['|']][:-1]
+
+    def _get_returncode(self, error):
+        return getattr(error, 'returncode', None)
+
+    def _record(self, command, started, success, returncode=None,
+                rusage=None):
+        if success:
+            returncode = 0
+        self.commands.append({
+            'command': ' '.join(command),
+            'started': started,
+            'duration': time.time() - started,
+            'success': success,
+            'returncode': returncode,
+            'rusage': rusage or None
+        })